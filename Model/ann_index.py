@@ -0,0 +1,239 @@
+import argparse
+import json
+import os
+import random
+import time
+
+import numpy as np
+
+from embedding_index import EmbeddingIndex
+
+ANN_VERSION = 1
+
+
+class IVFIndex:
+    """
+    建立在 EmbeddingIndex 段落向量上的 IVF 近似最近鄰索引，可在整個語料中檢索而不需要候選清單
+    以 k-means 將段落分成 nlist 群，查詢時只計算與問題最接近的 nprobe 群內的段落，
+    每份文件取段落相似度最大值；nprobe 越大召回率越高、速度越慢
+    """
+    def __init__(self, embedding_index, centroids, list_offsets, list_rows, meta):
+        self.embedding_index = embedding_index
+        self.matrix = embedding_index.matrix
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_rows = list_rows
+        self.meta = meta
+
+        # 每一列所屬的文件編號，以及文件編號對應的 (category, id)
+        self.docs = []
+        self.row_doc = np.zeros(len(self.matrix), dtype=np.int32)
+        for category, table in embedding_index.table.items():
+            for id, (start, end) in table.items():
+                self.row_doc[start:end] = len(self.docs)
+                self.docs.append((category, id))
+        self.doc_index = {doc: i for i, doc in enumerate(self.docs)}
+        self.doc_category = np.array([category for category, _ in self.docs])
+
+    @staticmethod
+    def paths(index_dir, name='biencoder'):
+        return (os.path.join(index_dir, f"{name}_ivf.npz"),
+                os.path.join(index_dir, f"{name}_ivf.json"))
+
+    @staticmethod
+    def read_meta(index_dir, name='biencoder'):
+        _, meta_path = IVFIndex.paths(index_dir, name)
+        if not os.path.isfile(meta_path):
+            return None
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    @staticmethod
+    def is_valid(meta, embedding_meta):
+        """ 段落向量索引重建（模型、切段參數或列數不同）後，IVF 索引即失效 """
+        return (meta is not None and embedding_meta is not None
+                and meta.get("version") == ANN_VERSION
+                and all(meta.get(key) == embedding_meta.get(key)
+                        for key in ("model_name", "length", "overlap", "rows")))
+
+    @classmethod
+    def load(cls, index_dir, embedding_index, name='biencoder'):
+        """ 載入索引，若不存在或已失效則回傳 None """
+        meta = cls.read_meta(index_dir, name)
+        if not cls.is_valid(meta, embedding_index.meta):
+            print(f"Warning: ANN index in '{index_dir}' is missing or stale, "
+                  f"run build_index.py with --ann to rebuild it.")
+            return None
+        ivf_path, _ = cls.paths(index_dir, name)
+        with np.load(ivf_path) as data:
+            return cls(embedding_index, data["centroids"], data["list_offsets"], data["list_rows"], meta)
+
+    @classmethod
+    def build(cls, index_dir, embedding_index, nlist=None, iterations=20, train_size=None,
+              batch_size=65536, seed=0, name='biencoder'):
+        """
+        以球面 k-means（內積相似度）將段落向量分群並寫入索引
+        nlist 預設為 4 * sqrt(段落數)；只取 train_size 列（預設 nlist * 64）訓練群心
+        """
+        matrix = embedding_index.matrix
+        rows = len(matrix)
+        nlist = min(nlist or max(1, int(4 * np.sqrt(rows))), rows)
+        rng = np.random.default_rng(seed)
+        train_size = min(train_size or nlist * 64, rows)
+        train = np.asarray(matrix[np.sort(rng.choice(rows, train_size, replace=False))], dtype=np.float32)
+
+        centroids = train[rng.choice(train_size, nlist, replace=False)].copy()
+        for _ in range(iterations):
+            assign = (train @ centroids.T).argmax(axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, train)
+            counts = np.bincount(assign, minlength=nlist)
+            # 空群以隨機段落重新初始化
+            empty = counts == 0
+            sums[empty] = train[rng.choice(train_size, int(empty.sum()))]
+            centroids = sums / np.maximum(np.linalg.norm(sums, axis=1, keepdims=True), 1e-12)
+
+        assign = np.empty(rows, dtype=np.int32)
+        for start in range(0, rows, batch_size):
+            block = np.asarray(matrix[start:start + batch_size], dtype=np.float32)
+            assign[start:start + len(block)] = (block @ centroids.T).argmax(axis=1)
+        list_rows = np.argsort(assign, kind='stable').astype(np.int32)
+        list_offsets = np.zeros(nlist + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assign, minlength=nlist), out=list_offsets[1:])
+
+        ivf_path, meta_path = cls.paths(index_dir, name)
+        tmp_path = ivf_path + '.tmp.npz'
+        np.savez(tmp_path, centroids=centroids.astype(np.float32),
+                 list_offsets=list_offsets, list_rows=list_rows)
+        os.replace(tmp_path, ivf_path)
+
+        meta = {"version": ANN_VERSION, "nlist": nlist, "iterations": iterations,
+                "train_size": train_size}
+        meta.update({key: embedding_index.meta[key] for key in ("model_name", "length", "overlap", "rows")})
+        with open(meta_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        return cls(embedding_index, meta=meta, centroids=centroids.astype(np.float32),
+                   list_offsets=list_offsets, list_rows=list_rows)
+
+    def _allowed_docs(self, category=None, candidates=None):
+        """ 依類別與候選文件 [(category, id)] 過濾，回傳允許的文件遮罩，不過濾時為 None """
+        if category is None and candidates is None:
+            return None
+        if candidates is not None:
+            allowed = np.zeros(len(self.docs), dtype=bool)
+            allowed[[self.doc_index[(c, str(id))] for c, id in candidates
+                     if (c, str(id)) in self.doc_index]] = True
+        else:
+            allowed = np.ones(len(self.docs), dtype=bool)
+        if category is not None:
+            allowed &= self.doc_category == category
+        return allowed
+
+    def _top_docs(self, rows, query_embedding, k):
+        """ 計算列的相似度，每份文件取最大值後回傳前 k 份 [(category, id, score)] """
+        if len(rows) == 0:
+            return []
+        scores = np.asarray(self.matrix[rows], dtype=np.float32) @ query_embedding
+        order = np.argsort(-scores, kind='stable')
+        docs = self.row_doc[rows][order]
+        _, first = np.unique(docs, return_index=True)
+        first = np.sort(first)[:k]
+        return [(*self.docs[docs[i]], float(scores[order[i]])) for i in first]
+
+    def search(self, query_embedding, k=10, nprobe=8, category=None, candidates=None, exact_threshold=4096):
+        """
+        回傳與問題最相似的前 k 份文件 [(category, id, score)]
+        category / candidates 可限制檢索範圍；過濾後的段落數不超過 exact_threshold 時直接精確計算
+        """
+        query_embedding = np.asarray(query_embedding, dtype=np.float32).reshape(-1)
+        allowed = self._allowed_docs(category, candidates)
+        if allowed is not None:
+            allowed_rows = allowed[self.row_doc]
+            if allowed_rows.sum() <= exact_threshold:
+                return self._top_docs(np.flatnonzero(allowed_rows), query_embedding, k)
+
+        centroid_scores = self.centroids @ query_embedding
+        nprobe = min(nprobe, len(self.centroids))
+        probe = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+        rows = np.concatenate([self.list_rows[self.list_offsets[i]:self.list_offsets[i + 1]] for i in probe])
+        if allowed is not None:
+            rows = rows[allowed_rows[rows]]
+        return self._top_docs(np.sort(rows), query_embedding, k)
+
+    def exact_search(self, query_embedding, k=10, category=None, candidates=None):
+        """ 計算所有（過濾後）段落的精確結果，用於檢查召回率 """
+        query_embedding = np.asarray(query_embedding, dtype=np.float32).reshape(-1)
+        allowed = self._allowed_docs(category, candidates)
+        if allowed is None:
+            rows = np.arange(len(self.matrix))
+        else:
+            rows = np.flatnonzero(allowed[self.row_doc])
+        return self._top_docs(rows, query_embedding, k)
+
+
+def recall_at_k(index, query_embeddings, categories, k=5, nprobe=8):
+    """
+    比較 IVF 與精確檢索的前 k 份文件，回傳 (平均 recall@k, 每題平均毫秒數)
+    """
+    recalls = []
+    elapsed = 0
+    for query_embedding, category in zip(query_embeddings, categories):
+        exact = {(c, id) for c, id, _ in index.exact_search(query_embedding, k, category)}
+        start = time.perf_counter()
+        approx = {(c, id) for c, id, _ in index.search(query_embedding, k, nprobe, category)}
+        elapsed += time.perf_counter() - start
+        recalls.append(len(exact & approx) / max(len(exact), 1))
+    return float(np.mean(recalls)), elapsed / max(len(recalls), 1) * 1000
+
+
+if __name__ == "__main__":
+    from retrieval import BiEncorderRetriever, add_chunking_arguments, build_chunker, paragraph_settings
+
+    parser = argparse.ArgumentParser(
+        description='Check recall@k of the IVF index against exact search.')
+    parser.add_argument('--index_dir', type=str,
+                        required=True, help='索引路徑（由 build_index.py 產生）')
+    parser.add_argument('--strategy', type=str, default='biencoder', choices=['biencoder', 'flag'],
+                        help='索引所屬的檢索策略')
+    parser.add_argument('--model_name', type=str, required=True,
+                        help='編碼問題的模型名稱，需與建立索引時相同')
+    parser.add_argument('--question_path', type=str, default=None,
+                        help='以題目作為查詢；未指定時隨機取段落向量作為查詢')
+    parser.add_argument('--num_queries', type=int, default=200,
+                        help='未指定題目時的查詢數')
+    parser.add_argument('--k', type=int, default=5,
+                        help='比較前 k 份文件')
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32],
+                        help='要比較的 nprobe 值')
+    parser.add_argument('--by_category', action='store_true',
+                        help='依題目的 category 限制檢索範圍')
+    add_chunking_arguments(parser)
+
+    args = parser.parse_args()
+
+    _, length, overlap = paragraph_settings(build_chunker(args))
+    embedding_index = EmbeddingIndex.load(args.index_dir, args.model_name, length, overlap,
+                                          name=args.strategy)
+    if embedding_index is None:
+        parser.error("段落向量索引不存在或已失效，請先執行 build_index.py")
+    index = IVFIndex.load(args.index_dir, embedding_index, name=args.strategy)
+    if index is None:
+        parser.error("IVF 索引不存在或已失效，請先執行 build_index.py --ann")
+
+    if args.question_path:
+        with open(args.question_path, 'r', encoding='utf-8') as f:
+            questions = json.load(f).get("questions", [])
+        framework = 'flag' if args.strategy == 'flag' else 'sentence-transformers'
+        encoder = BiEncorderRetriever(args.model_name, framework=framework)
+        query_embeddings = encoder._encode([question["query"] for question in questions])
+        categories = [question.get("category") if args.by_category else None for question in questions]
+    else:
+        rows = random.Random(0).sample(range(len(index.matrix)), min(args.num_queries, len(index.matrix)))
+        query_embeddings = np.asarray(index.matrix[sorted(rows)], dtype=np.float32)
+        categories = [index.docs[index.row_doc[row]][0] if args.by_category else None for row in sorted(rows)]
+
+    print(f"rows: {len(index.matrix)}  nlist: {index.meta['nlist']}  queries: {len(query_embeddings)}")
+    print(f"{'nprobe':>8}{f'recall@{args.k}':>12}{'ms/query':>12}")
+    for nprobe in args.nprobe:
+        recall, ms = recall_at_k(index, query_embeddings, categories, args.k, nprobe)
+        print(f"{nprobe:>8}{recall:>12.4f}{ms:>12.3f}")
@@ -0,0 +1,321 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import zlib
+
+import numpy as np
+
+from data_interface import MyDataset
+from load_client import run_load
+from retrieval import (BM25Retriever, BiEncorderRetriever, CachedRetriever, MultiVectorRetriever,
+                       RerankRetriever, Retriever)
+from score_cache import ScoreCache
+from server import RetrievalServer
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Preprocess'))
+from faq_text_concate import process_faq_data  # noqa: E402
+from pack_corpus import pack_corpus  # noqa: E402
+
+METHODS = ('retrieve', 'retrieve_by_paragraph', 'retrieve_by_paragraph_with_summary')
+STRATEGIES = ('bm25', 'biencoder', 'reranker', 'multivector')
+
+
+class StubEncoder:
+    """
+    可重現的假 bi-encoder：以字元 bigram 雜湊成固定維度的向量，介面與 SentenceTransformer.encode 相同
+    """
+    def __init__(self, dim=256):
+        self.dim = dim
+
+    def encode(self, sentences, normalize_embeddings=True, **kwargs):
+        single = isinstance(sentences, str)
+        if single:
+            sentences = [sentences]
+        embedding = np.zeros((len(sentences), self.dim), dtype=np.float32)
+        for i, sentence in enumerate(sentences):
+            for j in range(len(sentence) - 1):
+                embedding[i, zlib.crc32(sentence[j:j + 2].encode('utf-8')) % self.dim] += 1
+        if normalize_embeddings:
+            embedding /= np.maximum(np.linalg.norm(embedding, axis=1, keepdims=True), 1e-12)
+        return embedding[0] if single else embedding
+
+
+class StubMultiVectorEncoder:
+    """
+    可重現的假多向量編碼器：每個非空白字元為一個 token，向量由該字元與下一個字元的 bigram 雜湊而成，
+    介面與 BGEM3FlagModel.encode(return_colbert_vecs=True) 相同
+    """
+    def __init__(self, dim=64):
+        self.dim = dim
+
+    def encode(self, sentences, return_colbert_vecs=True, **kwargs):
+        colbert_vecs = []
+        for sentence in sentences:
+            chars = [char for char in sentence if not char.isspace()]
+            vectors = np.zeros((len(chars), self.dim), dtype=np.float32)
+            rows = np.arange(len(chars))
+            np.add.at(vectors, (rows, [zlib.crc32(char.encode('utf-8')) % self.dim for char in chars]), 1)
+            np.add.at(vectors, (rows[:-1], [zlib.crc32(''.join(chars[j:j + 2]).encode('utf-8')) % self.dim
+                                            for j in range(len(chars) - 1)]), 1)
+            vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+            colbert_vecs.append(vectors)
+        return {"colbert_vecs": colbert_vecs}
+
+
+class StubReranker:
+    """
+    可重現的假 cross-encoder：以問題與段落共同的字元 bigram 比例計分，介面與 FlagReranker.compute_score 相同
+    """
+    def compute_score(self, sentence_pairs, batch_size=256, normalize=False, **kwargs):
+        scores = []
+        for query, paragraph in sentence_pairs:
+            query_bigrams = {query[i:i + 2] for i in range(len(query) - 1)}
+            paragraph_bigrams = {paragraph[i:i + 2] for i in range(len(paragraph) - 1)}
+            overlap = len(query_bigrams & paragraph_bigrams) / max(len(query_bigrams), 1)
+            score = 8 * overlap - 4
+            scores.append(1 / (1 + np.exp(-score)) if normalize else score)
+        if len(scores) == 1:
+            return scores[0]
+        return scores
+
+
+def generate_corpus(work_dir, num_docs, doc_length, num_faq, num_questions, candidates, seed):
+    """
+    產生與 Preprocess/Data 相同結構的合成語料，以及 questions_example.json 格式的題目
+    """
+    rng = random.Random(seed)
+    chars = [chr(0x4e00 + i) for i in range(3000)]
+    words = [''.join(rng.choice(chars) for _ in range(rng.randint(1, 4))) for _ in range(5000)]
+
+    def make_text(length):
+        text = []
+        size = 0
+        while size < length:
+            word = rng.choice(words) + rng.choice(['', '', '', '，', '。'])
+            text.append(word)
+            size += len(word)
+        return ''.join(text)
+
+    data_dir = os.path.join(work_dir, 'Data')
+    corpus = {}
+    for category in ('finance', 'insurance'):
+        os.makedirs(os.path.join(data_dir, category), exist_ok=True)
+        corpus[category] = {}
+        for id in range(num_docs):
+            text = make_text(rng.randint(doc_length // 2, doc_length * 3 // 2))
+            corpus[category][id] = text
+            with open(os.path.join(data_dir, category, f"{id}_text.txt"), 'w', encoding='utf-8') as f:
+                f.write(text)
+            with open(os.path.join(data_dir, category, f"{id}_text_summary.txt"), 'w', encoding='utf-8') as f:
+                f.write(text[:len(text) // 10] + '\n')
+
+    faq_source = {str(id): [{"question": make_text(20) + '?', "answers": [make_text(60)]}
+                            for _ in range(rng.randint(1, 4))]
+                  for id in range(num_faq)}
+    faq_source_path = os.path.join(work_dir, 'pid_map_content.json')
+    with open(faq_source_path, 'w', encoding='utf-8') as f:
+        json.dump(faq_source, f, ensure_ascii=False)
+    corpus['faq'] = {int(id): ''.join(item['question'] + '、'.join(item['answers']) for item in value)
+                     for id, value in faq_source.items()}
+
+    questions = []
+    for qid in range(1, num_questions + 1):
+        category = rng.choice(['finance', 'insurance', 'faq'])
+        source = rng.sample(sorted(corpus[category]), min(candidates, len(corpus[category])))
+        answer_text = corpus[category][rng.choice(source)]
+        start = rng.randrange(max(len(answer_text) - 30, 1))
+        questions.append({"qid": qid, "source": source,
+                          "query": answer_text[start:start + rng.randint(10, 30)] + '？',
+                          "category": category})
+    questions_path = os.path.join(work_dir, 'questions.json')
+    with open(questions_path, 'w', encoding='utf-8') as f:
+        json.dump({"questions": questions}, f, ensure_ascii=False)
+    return data_dir, faq_source_path, questions_path
+
+
+def build_strategy(name):
+    if name == 'bm25':
+        return BM25Retriever()
+    if name == 'biencoder':
+        return BiEncorderRetriever('stub', model=StubEncoder())
+    if name == 'multivector':
+        return MultiVectorRetriever('stub', model=StubMultiVectorEncoder())
+    return RerankRetriever('stub', reranker=StubReranker())
+
+
+def summarize_latency(name, latencies, extra=None):
+    latencies = np.asarray(latencies)
+    result = {
+        "name": name,
+        "questions": len(latencies),
+        "total_s": float(latencies.sum()),
+        "qps": float(len(latencies) / latencies.sum()) if latencies.sum() > 0 else None,
+        "p50_ms": float(np.percentile(latencies, 50) * 1000),
+        "p95_ms": float(np.percentile(latencies, 95) * 1000),
+    }
+    result.update(extra or {})
+    return result
+
+
+def measure(name, func, items, trace_memory=True):
+    """
+    逐一計時每個項目，另外再以 tracemalloc 跑一次量測記憶體峰值（避免影響計時）
+    """
+    latencies = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for item in items:
+            start = time.perf_counter()
+            func(item)
+            latencies.append(time.perf_counter() - start)
+
+        extra = {}
+        if trace_memory:
+            tracemalloc.start()
+            for item in items:
+                func(item)
+            extra["peak_mem_mb"] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            tracemalloc.stop()
+    return summarize_latency(name, latencies, extra)
+
+
+def run_server_check(dataset, questions, work_dir, concurrency=8):
+    """
+    以 reranker 加上分數快取啟動檢索服務（Unix socket），送出所有題目兩次（第一次未命中快取、第二次命中），
+    確認答案與直接呼叫 retrieve_by_paragraph 相同；快取由主執行緒建立、在模型執行緒使用，與 server.py 相同
+    """
+    expected = {question["qid"]: Retriever(build_strategy('reranker')).retrieve_by_paragraph(
+                    dataset.load_sample(dict(question)))
+                for question in questions}
+
+    cache = ScoreCache(os.path.join(work_dir, 'server_scores.db'))
+    retriever = Retriever(CachedRetriever(build_strategy('reranker'), cache, 'stub'))
+    server = RetrievalServer(dataset, retriever)
+    socket_path = os.path.join(work_dir, 'server.sock')
+    loop = asyncio.new_event_loop()
+    task = loop.create_task(server.serve(unix_socket=socket_path))
+
+    def serve():
+        with contextlib.suppress(asyncio.CancelledError):
+            loop.run_until_complete(task)
+        # 結束仍在等待的連線處理，避免關閉事件迴圈時留下未完成的 task
+        pending = asyncio.all_tasks(loop)
+        for pending_task in pending:
+            pending_task.cancel()
+        loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+
+    thread = threading.Thread(target=serve, daemon=True)
+    with contextlib.redirect_stdout(io.StringIO()):
+        thread.start()
+        while not os.path.exists(socket_path):
+            time.sleep(0.01)
+
+    client_args = argparse.Namespace(unix_socket=socket_path, concurrency=concurrency)
+    results = []
+    try:
+        for name in ('cold', 'warm'):
+            answers, latencies, _ = run_load(client_args, questions)
+            mismatches = [answer["qid"] for answer in answers if answer["retrieve"] != expected[answer["qid"]]]
+            if mismatches:
+                raise RuntimeError(f"server[{name}] answers differ from retrieve_by_paragraph for qid {mismatches[:10]}")
+            results.append(summarize_latency(f"server[reranker+score_cache, {name}]", latencies))
+    finally:
+        loop.call_soon_threadsafe(task.cancel)
+        thread.join()
+        loop.close()
+        cache.close()
+    return results
+
+
+def run_benchmark(args):
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='retrieval_bench_')
+    data_dir, faq_source_path, questions_path = generate_corpus(
+        work_dir, args.num_docs, args.doc_length, args.num_faq, args.num_questions,
+        args.candidates, args.seed)
+    results = {"config": vars(args), "preprocess": [], "dataset": [], "retrieval": []}
+
+    # 前處理
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        process_faq_data(faq_source_path, os.path.join(data_dir, 'faq.json'))
+        results["preprocess"].append({"name": "faq_text_concate", "total_s": time.perf_counter() - start})
+
+    # 讀取資料：逐檔讀取與打包語料檔
+    for name in ('files', 'corpus_store'):
+        if name == 'corpus_store':
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                pack_corpus(data_dir)
+                results["preprocess"].append({"name": "pack_corpus", "total_s": time.perf_counter() - start})
+        dataset = MyDataset(questions_path, data_dir)
+        results["dataset"].append(measure(f"MyDataset[{name}]",
+                                          lambda i: dataset.__getitem__(i, 'True'),
+                                          range(len(dataset)), args.trace_memory))
+
+    samples = [dataset.__getitem__(i, 'True') for i in range(len(dataset))]
+    for strategy_name in args.strategies:
+        retriever = Retriever(build_strategy(strategy_name))
+        for method in args.methods:
+            results["retrieval"].append(measure(f"{strategy_name}.{method}",
+                                                getattr(retriever, method),
+                                                samples, args.trace_memory))
+
+    if args.server_check:
+        with open(questions_path, 'r', encoding='utf-8') as f:
+            questions = json.load(f)["questions"]
+        results["server"] = run_server_check(dataset, questions, work_dir)
+    return results
+
+
+def print_table(results):
+    print(f"{'name':<50}{'qps':>10}{'p50 ms':>10}{'p95 ms':>10}{'peak MB':>10}")
+    for result in results["dataset"] + results["retrieval"] + results.get("server", []):
+        peak = result.get("peak_mem_mb")
+        print(f"{result['name']:<50}{result['qps'] or 0:>10.1f}{result['p50_ms']:>10.2f}"
+              f"{result['p95_ms']:>10.2f}{peak if peak is not None else float('nan'):>10.2f}")
+    for result in results["preprocess"]:
+        print(f"{result['name']:<50}{result['total_s']:>10.3f} s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Offline retrieval benchmark on a synthetic corpus with stub models.')
+    parser.add_argument('--output', type=str, default='benchmark.json',
+                        help='輸出結果的 json 路徑，可用來比較不同版本')
+    parser.add_argument('--work_dir', type=str, default=None,
+                        help='產生合成語料的資料夾，預設使用暫存資料夾')
+    parser.add_argument('--num_docs', type=int, default=200,
+                        help='finance 與 insurance 各自的文件數')
+    parser.add_argument('--doc_length', type=int, default=3000,
+                        help='文件的平均字數')
+    parser.add_argument('--num_faq', type=int, default=200,
+                        help='FAQ 數量')
+    parser.add_argument('--num_questions', type=int, default=100,
+                        help='題目數')
+    parser.add_argument('--candidates', type=int, default=8,
+                        help='每題的候選文件數')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='產生語料的亂數種子')
+    parser.add_argument('--strategies', type=str, nargs='+', default=list(STRATEGIES), choices=STRATEGIES,
+                        help='要量測的檢索策略')
+    parser.add_argument('--methods', type=str, nargs='+', default=list(METHODS), choices=METHODS,
+                        help='要量測的 Retriever 方法')
+    parser.add_argument('--no_trace_memory', dest='trace_memory', action='store_false',
+                        help='不量測記憶體峰值')
+    parser.add_argument('--no_server_check', dest='server_check', action='store_false',
+                        help='不啟動檢索服務（reranker + 分數快取）檢查答案與延遲')
+
+    args = parser.parse_args()
+
+    results = run_benchmark(args)
+    print_table(results)
+    with open(args.output, 'w', encoding='utf8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=4)
@@ -0,0 +1,195 @@
+import json
+import os
+from collections import Counter
+
+import numpy as np
+
+INDEX_VERSION = 1
+
+
+class BM25Index:
+    """
+    全語料的 BM25 倒排索引
+    以 CSR 格式儲存 列(文件或段落) x 詞 的詞頻矩陣，並保存每列長度與全域 IDF，
+    table 記錄 {category: {id: [start, end]}} 每份文件對應的列範圍。
+    length 為 None 時每份文件為一列，否則每個段落為一列
+    """
+    def __init__(self, vocab, indptr, indices, data, doc_len, idf, meta):
+        self.vocab = vocab
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.doc_len = doc_len
+        self.idf = idf
+        self.meta = meta
+        self.table = meta["table"]
+
+    @staticmethod
+    def paths(index_dir, name='bm25'):
+        return (os.path.join(index_dir, f"{name}.npz"),
+                os.path.join(index_dir, f"{name}.json"))
+
+    @staticmethod
+    def read_meta(index_dir, name='bm25'):
+        _, meta_path = BM25Index.paths(index_dir, name)
+        if not os.path.isfile(meta_path):
+            return None
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    @staticmethod
+    def is_valid(meta, length, overlap):
+        """ 切段參數不同時，索引即失效 """
+        return (meta is not None
+                and meta.get("version") == INDEX_VERSION
+                and meta.get("length") == length
+                and meta.get("overlap") == overlap)
+
+    @classmethod
+    def load(cls, index_dir, length=None, overlap=None, name='bm25'):
+        """ 載入索引，若不存在或已失效則回傳 None """
+        meta = cls.read_meta(index_dir, name)
+        if not cls.is_valid(meta, length, overlap):
+            print(f"Warning: BM25 index '{name}' in '{index_dir}' is missing or stale, "
+                  f"falling back to per-question BM25.")
+            return None
+        arrays_path, _ = cls.paths(index_dir, name)
+        with np.load(arrays_path) as arrays:
+            return cls({term: i for i, term in enumerate(meta["vocab"])},
+                       arrays["indptr"], arrays["indices"], arrays["data"],
+                       arrays["doc_len"], arrays["idf"], meta)
+
+    @classmethod
+    def build(cls, index_dir, corpus, tokenize, split=None, length=None, overlap=None,
+              epsilon=0.25, name='bm25'):
+        """
+        斷詞並建立整個語料的倒排索引
+        corpus: 產生 (category, id, text) 的可迭代物件
+        tokenize: 斷詞函式，需與查詢時相同（jieba.cut_for_search）
+        split: 切段函式 split(text, length, overlap)，length 為 None 時不切段
+        """
+        os.makedirs(index_dir, exist_ok=True)
+        arrays_path, meta_path = cls.paths(index_dir, name)
+
+        vocab = {}
+        indptr = [0]
+        indices = []
+        data = []
+        doc_len = []
+        table = {}
+        for category, id, text in corpus:
+            start = len(doc_len)
+            if length is None:
+                rows = [text]
+            else:
+                rows = split(text, length, overlap) if text else []
+            for row in rows:
+                tokens = list(tokenize(row))
+                for term, freq in Counter(tokens).items():
+                    indices.append(vocab.setdefault(term, len(vocab)))
+                    data.append(freq)
+                indptr.append(len(indices))
+                doc_len.append(len(tokens))
+            table.setdefault(category, {})[id] = [start, len(doc_len)]
+
+        indices = np.asarray(indices, dtype=np.int32)
+        df = np.bincount(indices, minlength=len(vocab))
+        idf = _okapi_idf(df, len(doc_len), epsilon)
+        np.savez(arrays_path,
+                 indptr=np.asarray(indptr, dtype=np.int64),
+                 indices=indices,
+                 data=np.asarray(data, dtype=np.int32),
+                 doc_len=np.asarray(doc_len, dtype=np.int32),
+                 idf=idf)
+
+        meta = {
+            "version": INDEX_VERSION,
+            "length": length,
+            "overlap": overlap,
+            "rows": len(doc_len),
+            "avgdl": float(np.mean(doc_len)) if doc_len else 0.0,
+            "vocab": list(vocab),
+            "table": table,
+        }
+        with open(meta_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        return cls.load(index_dir, length, overlap, name)
+
+    def score_rows(self, query_tokens, rows, k1=1.5, b=0.75, epsilon=0.25, idf_scope='candidates'):
+        """
+        以一次稀疏列收集計算 query 對指定列的 BM25 分數
+        idf_scope='candidates' 時 IDF 與平均長度只以這些列計算，與對候選文件建立 BM25Okapi 相同；
+        'global' 則使用整個語料的 IDF
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        if len(rows) == 0:
+            return np.zeros(0)
+
+        # 收集候選列的所有非零項
+        starts = self.indptr[rows]
+        counts = self.indptr[rows + 1] - starts
+        offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+        positions = offsets + np.arange(counts.sum())
+        row_of = np.repeat(np.arange(len(rows)), counts)
+        terms = self.indices[positions]
+        tf = self.data[positions]
+
+        doc_len = self.doc_len[rows]
+        if idf_scope == 'candidates':
+            avgdl = doc_len.mean()
+            unique_terms, df = np.unique(terms, return_counts=True)
+            idf_values = _okapi_idf(df, len(rows), epsilon)
+        else:
+            avgdl = self.meta["avgdl"]
+            unique_terms = np.arange(len(self.idf))
+            idf_values = self.idf
+        if avgdl == 0:
+            return np.zeros(len(rows))
+
+        # 查詢詞可能重複出現，重複的詞分數累加
+        query_counter = Counter(self.vocab[token] for token in query_tokens if token in self.vocab)
+        if not query_counter:
+            return np.zeros(len(rows))
+        query_terms = np.fromiter(query_counter.keys(), dtype=np.int64)
+        query_weight = np.fromiter(query_counter.values(), dtype=np.float64)
+
+        pos = np.searchsorted(unique_terms, query_terms)
+        pos = np.minimum(pos, len(unique_terms) - 1)
+        found = unique_terms[pos] == query_terms
+        weight = np.zeros(len(unique_terms))
+        weight[pos[found]] = query_weight[found] * idf_values[pos[found]]
+
+        term_weight = weight[np.searchsorted(unique_terms, terms)]
+        mask = term_weight != 0
+        tf = tf[mask]
+        denom = tf + k1 * (1 - b + b * doc_len[row_of[mask]] / avgdl)
+        contrib = term_weight[mask] * tf * (k1 + 1) / denom
+        return np.bincount(row_of[mask], weights=contrib, minlength=len(rows))
+
+    def score(self, query_tokens, category, source_id, **kwargs):
+        """
+        回傳每份候選文件的分數（段落索引時取段落最高分），
+        不在索引中的文件不參與 IDF 計算且分數為 0
+        """
+        category_table = self.table.get(category, {})
+        ranges = [category_table.get(str(id)) for id in source_id]
+        rows = [row for r in ranges if r for row in range(r[0], r[1])]
+        row_scores = self.score_rows(query_tokens, rows, **kwargs)
+
+        scores = []
+        i = 0
+        for r in ranges:
+            n = r[1] - r[0] if r else 0
+            scores.append(float(row_scores[i:i + n].max()) if n else 0)
+            i += n
+        return scores
+
+
+def _okapi_idf(df, corpus_size, epsilon):
+    """ 與 rank_bm25.BM25Okapi 相同的 IDF，負值以 epsilon * 平均 IDF 取代 """
+    if len(df) == 0:
+        return np.zeros(0)
+    idf = np.log(corpus_size - df + 0.5) - np.log(df + 0.5)
+    eps = epsilon * idf.mean()
+    idf[idf < 0] = eps
+    return idf
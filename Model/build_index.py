@@ -0,0 +1,225 @@
+import argparse
+
+import jieba
+
+from bm25_index import BM25Index
+from data_interface import corpus_fingerprint, iter_reference_corpus
+from embedding_index import EmbeddingIndex
+from ann_index import IVFIndex
+from quantized_index import QUANTIZERS, QuantizedIndex
+from multivector_index import MultiVectorIndex
+from dedup_index import DedupIndex
+from faq_index import FAQ_LENGTH, FAQPairIndex, iter_faq_questions, load_faq_pairs, split_questions
+from retrieval import (BiEncorderRetriever, MultiVectorRetriever, add_chunking_arguments, build_chunker,
+                       paragraph_settings)
+
+
+def build_embedding_index(args):
+    """
+    將 finance / insurance / FAQ 的每個段落編碼一次，存成 mmap 向量索引
+    """
+    chunker = build_chunker(args)
+    split, length, overlap = paragraph_settings(chunker)
+    meta = EmbeddingIndex.read_meta(args.index_dir, args.strategy)
+    if not args.force and EmbeddingIndex.is_valid(meta, args.model_name, length, overlap):
+        print(f"Index '{args.strategy}' in '{args.index_dir}' is up to date, skipping.")
+        if args.ann or args.quantize:
+            index = EmbeddingIndex.load(args.index_dir, args.model_name, length, overlap, name=args.strategy)
+            if args.ann:
+                build_ann_index(args, index)
+            for kind in args.quantize:
+                build_quantized_index(args, index, kind)
+        return
+
+    framework = 'flag' if args.strategy == 'flag' else 'sentence-transformers'
+    model = BiEncorderRetriever(args.model_name, framework=framework).model
+
+    def encode(paragraphs):
+        return model.encode(paragraphs, normalize_embeddings=True)
+
+    index = EmbeddingIndex.build(args.index_dir, iter_reference_corpus(args.source_dir),
+                                 encode, split, args.model_name, length, overlap, dtype=args.dtype,
+                                 batch_size=args.batch_size, name=args.strategy)
+    print(f"Successfully built index with {index.meta['rows']} paragraphs "
+          f"to '{args.index_dir}'.")
+    if chunker is not None:
+        print(chunker.report(args.batch_size))
+    if args.ann:
+        build_ann_index(args, index)
+    for kind in args.quantize:
+        build_quantized_index(args, index, kind)
+
+
+def build_ann_index(args, embedding_index):
+    """
+    在段落向量上建立 IVF 近似最近鄰索引，讓沒有候選清單的題目可以檢索整個語料
+    """
+    if not args.force and IVFIndex.is_valid(IVFIndex.read_meta(args.index_dir, args.strategy),
+                                            embedding_index.meta):
+        print(f"ANN index '{args.strategy}' in '{args.index_dir}' is up to date, skipping.")
+        return
+    index = IVFIndex.build(args.index_dir, embedding_index, nlist=args.nlist,
+                           iterations=args.kmeans_iterations, name=args.strategy)
+    print(f"Successfully built ANN index with {index.meta['nlist']} lists "
+          f"to '{args.index_dir}'.")
+
+
+def build_quantized_index(args, embedding_index, kind):
+    """
+    將段落向量量化成 int8 或 PQ 編碼，查詢時常駐記憶體的只有量化向量
+    """
+    if not args.force and QuantizedIndex.is_valid(QuantizedIndex.read_meta(args.index_dir, kind, args.strategy),
+                                                  embedding_index.meta):
+        print(f"{kind} index '{args.strategy}' in '{args.index_dir}' is up to date, skipping.")
+        return
+    index = QuantizedIndex.build(args.index_dir, embedding_index, kind, subspaces=args.pq_subspaces,
+                                 iterations=args.kmeans_iterations, name=args.strategy)
+    memory = index.memory_report()
+    print(f"Successfully built {kind} index to '{args.index_dir}': "
+          f"{memory['quantized_bytes'] / 2**20:.2f} MiB, "
+          f"{memory['compression_vs_float32']:.1f}x smaller than float32.")
+
+
+def build_multivector_index(args):
+    """
+    將每個段落編碼一次成 bge-m3 的 token 向量，查詢時只需編碼問題再計算 MaxSim
+    """
+    chunker = build_chunker(args)
+    split, length, overlap = paragraph_settings(chunker)
+    meta = MultiVectorIndex.read_meta(args.index_dir)
+    if not args.force and MultiVectorIndex.is_valid(meta, args.model_name, length, overlap):
+        print(f"Index 'multivector' in '{args.index_dir}' is up to date, skipping.")
+        return
+
+    strategy = MultiVectorRetriever(args.model_name, batch_size=args.batch_size)
+    index = MultiVectorIndex.build(args.index_dir, iter_reference_corpus(args.source_dir),
+                                   strategy._encode, split, args.model_name, length, overlap,
+                                   dtype=args.dtype, batch_size=args.batch_size)
+    print(f"Successfully built index with {index.meta['rows']} paragraphs and "
+          f"{index.meta['tokens']} token vectors to '{args.index_dir}'.")
+    if chunker is not None:
+        print(chunker.report(args.batch_size))
+
+
+def build_dedup_index(args):
+    """
+    找出語料中完全相同的段落，加上 --dedup_near 時再以 MinHash 找出近似重複的段落，檢索時每題只需計算代表段落
+    """
+    split, length, overlap = paragraph_settings(build_chunker(args))
+    fingerprint = corpus_fingerprint(args.source_dir)
+    threshold = args.dedup_threshold if args.dedup_near else None
+    meta = DedupIndex.read_meta(args.index_dir)
+    if (not args.force and DedupIndex.is_valid(meta, length, overlap, fingerprint)
+            and meta.get("threshold") == threshold):
+        print(f"Index 'dedup' in '{args.index_dir}' is up to date, skipping.")
+        return
+    index = DedupIndex.build(args.index_dir, iter_reference_corpus(args.source_dir), split, length, overlap,
+                             fingerprint, threshold=threshold)
+    print(index.build_report())
+
+
+def build_faq_pair_index(args):
+    """
+    以 faq_text_concate.py 輸出的問答配對，建立每個 FAQ 問題一列的 BM25 詞頻與（指定 --faq_model_name 時）問題向量
+    """
+    pairs_path = FAQPairIndex.pairs_path(args.source_dir)
+    faq_pairs = load_faq_pairs(pairs_path)
+    if not args.force and BM25Index.is_valid(BM25Index.read_meta(args.index_dir, 'bm25_faq_questions'),
+                                             FAQ_LENGTH, None):
+        print(f"Index 'bm25_faq_questions' in '{args.index_dir}' is up to date, skipping.")
+    else:
+        index = BM25Index.build(args.index_dir, iter_faq_questions(faq_pairs), jieba.cut_for_search,
+                                split_questions, FAQ_LENGTH, None, name='bm25_faq_questions')
+        print(f"Successfully built index 'bm25_faq_questions' with {index.meta['rows']} questions "
+              f"to '{args.index_dir}'.")
+
+    if not args.faq_model_name:
+        return
+    if not args.force and EmbeddingIndex.is_valid(EmbeddingIndex.read_meta(args.index_dir, 'faq_questions'),
+                                                  args.faq_model_name, FAQ_LENGTH, None):
+        print(f"Index 'faq_questions' in '{args.index_dir}' is up to date, skipping.")
+        return
+    model = BiEncorderRetriever(args.faq_model_name).model
+
+    def encode(questions):
+        return model.encode(questions, normalize_embeddings=True)
+
+    index = EmbeddingIndex.build(args.index_dir, iter_faq_questions(faq_pairs), encode, split_questions,
+                                 args.faq_model_name, FAQ_LENGTH, None, dtype=args.dtype,
+                                 batch_size=args.batch_size, name='faq_questions')
+    print(f"Successfully built index 'faq_questions' with {index.meta['rows']} questions "
+          f"to '{args.index_dir}'.")
+
+
+def build_bm25_index(args):
+    """
+    建立段落粒度的 BM25 倒排索引（retrieval.py 與 server.py 都以段落計分，不需要整份文件的索引）
+    """
+    split, length, overlap = paragraph_settings(build_chunker(args))
+    name = 'bm25_paragraph'
+    meta = BM25Index.read_meta(args.index_dir, name)
+    if not args.force and BM25Index.is_valid(meta, length, overlap):
+        print(f"Index '{name}' in '{args.index_dir}' is up to date, skipping.")
+        return
+    index = BM25Index.build(args.index_dir, iter_reference_corpus(args.source_dir),
+                            jieba.cut_for_search, split,
+                            length, overlap, name=name)
+    print(f"Successfully built index '{name}' with {index.meta['rows']} rows "
+          f"to '{args.index_dir}'.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Build retrieval index for the reference corpus.')
+    parser.add_argument('--source_dir', type=str,
+                        required=True, help='讀取參考資料路徑（前處理後的 Data 資料夾）')
+    parser.add_argument('--index_dir', type=str,
+                        required=True, help='輸出索引的資料夾路徑')
+    parser.add_argument('--strategy', type=str, default='biencoder', choices=['bm25', 'biencoder', 'flag', 'multivector'],
+                        help='要建立索引的檢索策略')
+    parser.add_argument('--model_name', type=str, default=None,
+                        help='編碼使用的模型名稱，需與 retrieval.py 相同（bm25 不需要）')
+    parser.add_argument('--dtype', type=str, default='float16', choices=['float16', 'float32'],
+                        help='向量儲存的精度')
+    parser.add_argument('--batch_size', type=int, default=256,
+                        help='每次編碼的段落數')
+    parser.add_argument('--ann', action='store_true',
+                        help='另外建立 IVF 近似最近鄰索引，供沒有候選清單的題目檢索整個語料（biencoder / flag）')
+    parser.add_argument('--nlist', type=int, default=None,
+                        help='IVF 的群數，預設為 4 * sqrt(段落數)')
+    parser.add_argument('--kmeans_iterations', type=int, default=20,
+                        help='IVF 分群與 PQ 訓練的 k-means 迭代次數')
+    parser.add_argument('--quantize', type=str, nargs='*', default=[], choices=list(QUANTIZERS),
+                        help='另外建立量化的段落向量索引：int8 純量量化或 pq 乘積量化（biencoder / flag）')
+    parser.add_argument('--pq_subspaces', type=int, default=None,
+                        help='PQ 切分的段數（每列佔用的 bytes），需整除向量維度，預設為維度 / 8')
+    parser.add_argument('--dedup', action='store_true',
+                        help='另外建立重複段落的對應表，供 retrieval.py --dedup 使用')
+    parser.add_argument('--dedup_near', action='store_true',
+                        help='對應表也合併近似重複的段落（只差在數字等細節的段落也會被合併，可能影響答案）')
+    parser.add_argument('--dedup_threshold', type=float, default=0.8,
+                        help='加上 --dedup_near 時，兩段文字 MinHash 估計的 Jaccard 相似度不低於此值時視為近似重複')
+    parser.add_argument('--faq_pairs', action='store_true',
+                        help='另外以 source_dir 中的 faq_pairs.json 建立 FAQ 問題粒度的索引，供 retrieval.py --faq_pairs 使用')
+    parser.add_argument('--faq_model_name', type=str, default=None,
+                        help='FAQ 問題向量的模型名稱；未指定時只建立問題的 BM25 索引')
+    parser.add_argument('--force', action='store_true',
+                        help='即使索引仍有效也重新建立')
+    add_chunking_arguments(parser)
+
+    args = parser.parse_args()
+
+    # 只指定 --dedup / --faq_pairs 而沒有 --model_name 時，只建立這兩種索引
+    if args.strategy != 'bm25' and not args.model_name and not (args.dedup or args.faq_pairs):
+        parser.error("當選擇非 'bm25' 策略時，必須指定 --model_name")
+
+    if args.dedup:
+        build_dedup_index(args)
+    if args.faq_pairs:
+        build_faq_pair_index(args)
+    if args.strategy == 'bm25':
+        build_bm25_index(args)
+    elif args.strategy == 'multivector' and args.model_name:
+        build_multivector_index(args)
+    elif args.model_name:
+        build_embedding_index(args)
@@ -0,0 +1,130 @@
+import threading
+from collections import deque, namedtuple
+
+import numpy as np
+
+from instrumentation import instrumented, metrics
+
+SENTENCE_ENDINGS = '。！？'
+
+# 段落在原文中的字元範圍與 token 數，需要文字時再以 text[start:end] 取出
+Span = namedtuple('Span', ['start', 'end', 'tokens'])
+
+
+class TokenChunker:
+    """
+    依模型 tokenizer 的 token 數切段，段落盡量結束在句尾（。！？），
+    相鄰段落重疊約 overlap_tokens 個 token，重疊部分盡量從句首開始
+    沒有 tokenizer 時以每個非空白字元為一個 token
+    切段統計只保留最近 max_recorded 段的 token 數（長時間執行的服務不會無限增加），段數與 token 總數另外累計
+    """
+    def __init__(self, tokenizer=None, max_tokens=384, overlap_tokens=64, min_fill=0.5, name='chars',
+                 max_recorded=100_000):
+        if overlap_tokens >= max_tokens:
+            raise ValueError("overlap_tokens must be smaller than max_tokens")
+        self.tokenizer = tokenizer
+        self.max_tokens = max_tokens
+        self.overlap_tokens = overlap_tokens
+        self.min_fill = min_fill
+        # 索引以 signature 判斷切段方式是否相同
+        self.signature = f"tokens:{max_tokens}:{name}"
+        self.lengths = deque(maxlen=max_recorded)
+        self.chunks = 0
+        self.tokens = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_pretrained(cls, model_name, **kwargs):
+        from transformers import AutoTokenizer
+        return cls(AutoTokenizer.from_pretrained(model_name), name=model_name, **kwargs)
+
+    def token_offsets(self, text):
+        """ 回傳每個 token 在原文中的 (start, end) """
+        if self.tokenizer is None:
+            return [(i, i + 1) for i, char in enumerate(text) if not char.isspace()]
+        encoding = self.tokenizer(text, add_special_tokens=False, return_offsets_mapping=True,
+                                  verbose=False)
+        return [(start, end) for start, end in encoding["offset_mapping"] if end > start]
+
+    @instrumented('chunking')
+    def spans(self, text):
+        offsets = self.token_offsets(text)
+        n = len(offsets)
+        sentence_end = [text[end - 1] in SENTENCE_ENDINGS for _, end in offsets]
+        min_tokens = max(1, int(self.max_tokens * self.min_fill))
+
+        spans = []
+        start = 0
+        while start < n:
+            end = min(start + self.max_tokens, n)
+            if end < n:
+                # 由後往前找句尾，但段落至少要有 min_tokens 個 token
+                for j in range(end, start + min_tokens, -1):
+                    if sentence_end[j - 1]:
+                        end = j
+                        break
+            spans.append(Span(offsets[start][0], offsets[end - 1][1], end - start))
+            if end >= n:
+                break
+            next_start = max(end - self.overlap_tokens, start + 1)
+            for j in range(next_start, end):
+                if sentence_end[j - 1]:
+                    next_start = j
+                    break
+            start = next_start
+
+        metrics.count('paragraphs', len(spans))
+        with self._lock:
+            self.lengths.extend(span.tokens for span in spans)
+            self.chunks += len(spans)
+            self.tokens += sum(span.tokens for span in spans)
+        return spans
+
+    def split(self, text):
+        """ 與 split_by_length_with_overlap 相同，回傳段落字串列表 """
+        return [text[span.start:span.end] for span in self.spans(text)]
+
+    def report(self, batch_size=32):
+        """ padding 比例以最近保留的段落計算，段數與 token 數為全部累計 """
+        with self._lock:
+            lengths = list(self.lengths)
+            chunks, tokens = self.chunks, self.tokens
+        report = padding_report(lengths, batch_size, pad_to=self.max_tokens)
+        report.update(chunks=chunks, tokens=tokens, mean_tokens=tokens / chunks if chunks else 0.0)
+        return report
+
+
+def length_buckets(lengths, batch_size):
+    """
+    依長度排序後每 batch_size 個分成一批，回傳每批在原列表中的位置，
+    同一批長度相近，padding 到批內最長時浪費最少
+    """
+    order = np.argsort(np.asarray(lengths), kind='stable')
+    return [order[start:start + batch_size].tolist() for start in range(0, len(order), batch_size)]
+
+
+def padding_ratio(lengths, batches, pad_to=None):
+    """ padding token 佔所有計算 token 的比例；pad_to 為固定長度，否則 padding 到批內最長 """
+    lengths = np.asarray(lengths)
+    if len(lengths) == 0:
+        return 0.0
+    total = sum(len(batch) * (pad_to or int(lengths[batch].max())) for batch in batches)
+    return float(1 - lengths.sum() / total)
+
+
+def padding_report(lengths, batch_size=32, pad_to=None):
+    """
+    比較三種批次方式的 padding 比例：固定長度、依原順序分批、依長度分桶
+    """
+    arrival = [list(range(start, min(start + batch_size, len(lengths))))
+               for start in range(0, len(lengths), batch_size)]
+    report = {
+        "chunks": len(lengths),
+        "tokens": int(np.sum(lengths)) if lengths else 0,
+        "mean_tokens": float(np.mean(lengths)) if lengths else 0.0,
+        "padding_arrival_order": padding_ratio(lengths, arrival),
+        "padding_length_buckets": padding_ratio(lengths, length_buckets(lengths, batch_size)),
+    }
+    if pad_to:
+        report["padding_fixed_length"] = padding_ratio(lengths, arrival, pad_to)
+    return report
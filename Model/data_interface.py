@@ -1,21 +1,151 @@
+import hashlib
 import json
+import mmap
 import os
-from torch.utils.data import Dataset
+from functools import lru_cache
 
-class MyDataset(Dataset):
+from instrumentation import instrumented, metrics
+
+CORPUS_CATEGORIES = ('finance', 'insurance')
+CORPUS_VERSION = 2
+
+
+class CorpusStore:
+    """
+    以 mmap 讀取 Preprocess/pack_corpus.py 打包的語料檔
+    corpus.bin 為所有文字的 UTF-8 內容，corpus.json 記錄 {category: {kind: {id: [offset, length]}}}，
+    kind 為 text 或 summary（FAQ 為 category 'faq' 的 text）。解碼後的字串以 LRU 快取
+    """
+    def __init__(self, reference_path, entries, cache_size=1024, name='corpus'):
+        self.entries = entries
+        self.file = open(os.path.join(reference_path, f"{name}.bin"), 'rb')
+        try:
+            self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # 空檔案無法 mmap
+            self.buffer = b''
+        self.get = lru_cache(maxsize=cache_size)(self._read)
+
+    @staticmethod
+    def exists(reference_path, name='corpus'):
+        return (os.path.isfile(os.path.join(reference_path, f"{name}.json"))
+                and os.path.isfile(os.path.join(reference_path, f"{name}.bin")))
+
+    @staticmethod
+    def source_files(reference_path):
+        """ 回傳打包來源檔案 {相對路徑: [大小, 修改時間(ns)]}，與 pack_corpus.py 記錄的格式相同 """
+        sources = {}
+        for category in CORPUS_CATEGORIES:
+            base_path = os.path.join(reference_path, category)
+            if not os.path.isdir(base_path):
+                continue
+            for file in os.listdir(base_path):
+                if file.endswith('_text.txt') or file.endswith('_text_summary.txt'):
+                    stat = os.stat(os.path.join(base_path, file))
+                    sources[f"{category}/{file}"] = [stat.st_size, stat.st_mtime_ns]
+        faq_path = os.path.join(reference_path, 'faq.json')
+        if os.path.isfile(faq_path):
+            stat = os.stat(faq_path)
+            sources['faq.json'] = [stat.st_size, stat.st_mtime_ns]
+        return sources
+
+    @staticmethod
+    def is_valid(meta, reference_path):
+        """ 來源檔案有新增、刪除或大小、修改時間不同時，語料檔即過期 """
+        return (meta.get("version") == CORPUS_VERSION
+                and meta.get("sources") == CorpusStore.source_files(reference_path))
+
+    @classmethod
+    def load(cls, reference_path, cache_size=1024, name='corpus'):
+        """ 開啟打包的語料檔，不存在或已過期時回傳 None（改讀原始檔案） """
+        if not cls.exists(reference_path, name):
+            return None
+        with open(os.path.join(reference_path, f"{name}.json"), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        if not cls.is_valid(meta, reference_path):
+            print(f"Warning: Packed corpus in '{reference_path}' is stale, reading the source files instead; "
+                  f"rerun Preprocess/pack_corpus.py to repack it.")
+            return None
+        return cls(reference_path, meta["entries"], cache_size, name)
+
+    def ids(self, category, kind='text'):
+        return list(self.entries.get(category, {}).get(kind, {}))
+
+    def _read(self, category, kind, id):
+        """ 回傳文件內容，不存在時回傳 None """
+        entry = self.entries.get(category, {}).get(kind, {}).get(str(id))
+        if entry is None:
+            return None
+        offset, length = entry
+        return self.buffer[offset:offset + length].decode('utf-8')
+
+
+def corpus_fingerprint(reference_path):
+    """ 以來源檔案的大小與修改時間計算語料指紋，供索引判斷建立後語料是否有變動 """
+    sources = json.dumps(CorpusStore.source_files(reference_path), sort_keys=True)
+    return hashlib.sha1(sources.encode('utf-8')).hexdigest()
+
+
+def iter_reference_corpus(reference_path):
+    """
+    依序走訪前處理後的所有參考資料，產生 (category, id, text)
+    有打包的語料檔時直接讀取，否則 finance / insurance 讀取 {id}_text.txt，FAQ 讀取 faq.json
+    """
+    store = CorpusStore.load(reference_path, cache_size=0)
+    if store is not None:
+        for category in CORPUS_CATEGORIES + ('faq',):
+            for id in sorted((id for id in store.ids(category) if id.isdigit()), key=int):
+                yield category, id, store.get(category, 'text', id)
+        return
+
+    for category in CORPUS_CATEGORIES:
+        base_path = os.path.join(reference_path, category)
+        if not os.path.isdir(base_path):
+            print(f"Error: Reference folder '{base_path}' not found.")
+            continue
+        ids = sorted(int(file[:-len('_text.txt')]) for file in os.listdir(base_path)
+                     if file.endswith('_text.txt') and file[:-len('_text.txt')].isdigit())
+        for id in ids:
+            with open(os.path.join(base_path, f"{id}_text.txt"), 'r', encoding='utf-8') as f:
+                yield category, str(id), f.read()
+
+    faq_path = os.path.join(reference_path, 'faq.json')
+    if os.path.isfile(faq_path):
+        with open(faq_path, 'r', encoding='utf-8') as f:
+            for key, value in json.load(f).items():
+                yield 'faq', str(key), value
+    else:
+        print(f"Error: FAQ file '{faq_path}' not found.")
+
+
+class MyDataset:
     """
     讀取訓練資料，轉存成 Dataset 類別
     """
-    def __init__(self, questions_path, reference_path, ground_truths_path=None):
+    def __init__(self, questions_path, reference_path, ground_truths_path=None, cache_size=1024):
         self.source_faq = {}
         self.questions_path = questions_path
         self.reference_path = reference_path
 
-        # 讀取問題資料
-        with open(questions_path, 'r', encoding='utf-8') as f:
-            questions = json.load(f).get("questions", [])
+        # 讀取問題資料，questions_path 為 None 時只讀取參考資料（供檢索服務使用）
+        questions = []
+        if questions_path is not None:
+            with open(questions_path, 'r', encoding='utf-8') as f:
+                questions = json.load(f).get("questions", [])
         self.data = questions
 
+        # 讀取標準答案 {qid: {"qid", "retrieve", "category"}}，供評估使用
+        self.ground_truths = {}
+        if ground_truths_path is not None:
+            with open(ground_truths_path, 'r', encoding='utf-8') as f:
+                self.ground_truths = {answer["qid"]: answer
+                                      for answer in json.load(f).get("ground_truths", [])}
+
+        # 有打包的語料檔時以 mmap 讀取，不需要逐一開檔與解析 faq.json
+        self.store = CorpusStore.load(reference_path, cache_size=cache_size)
+        if self.store is not None:
+            return
+
         # 讀取 FAQ 資料
         faq_path = os.path.join(reference_path, 'faq.json')
         if os.path.isfile(faq_path):
@@ -31,14 +161,19 @@ class MyDataset(Dataset):
         if index < 0 or index >= len(self.data):
             raise IndexError("Index out of range")
 
-        sample = self.data[index]
-        category = sample["category"]
-        source_id = sample["source"]
+        return self.load_sample(dict(self.data[index]), is_use_summary)
+
+    @instrumented('dataset.getitem')
+    def load_sample(self, sample, is_use_summary='False'):
+        """ 依 sample 的 category 與 source 讀入參考資料內容，寫回 sample 後回傳 """
+        category = sample.get("category")
+        # 沒有候選清單的題目（以近似最近鄰索引檢索）不需要讀取參考資料
+        source_id = sample.get("source") or []
 
         source_context = []
         summary_context = []
 
-        if category != "faq":
+        if source_id and category != "faq":
             base_path = os.path.join(self.reference_path, category)
 
             for id in source_id:
@@ -46,26 +181,41 @@ class MyDataset(Dataset):
                 summary_file_path = os.path.join(base_path, f"{id}_text_summary.txt")
                 
                 # 讀取主檔案
-                text = self.read_file(file_path)
+                text = self.read_source(category, 'text', id, file_path)
                 if text:
                     source_context.append(text)
                 if is_use_summary == 'True':
                     # 讀取摘要檔案
-                    summary_text = self.read_file(summary_file_path)
+                    summary_text = self.read_source(category, 'summary', id, summary_file_path)
                     if summary_text:
                         summary_context.append(summary_text)
         else:
             # 處理 FAQ 類別
             for id in source_id:
-                context = self.source_faq.get(str(id), "")
+                if self.store is not None:
+                    context = self.store.get('faq', 'text', str(id)) or ""
+                else:
+                    context = self.source_faq.get(str(id), "")
                 source_context.append(context)
 
         sample["source_context"] = source_context
+        if metrics.enabled:
+            metrics.count('documents', len(source_context))
+            metrics.count('characters_read', sum(map(len, source_context)))
         if is_use_summary == 'True':
             sample["source_summary_context"] = summary_context
         
         return sample
 
+    def read_source(self, category, kind, id, file_path):
+        """ 有打包的語料檔時從中讀取，否則讀取原始檔案 """
+        if self.store is None:
+            return self.read_file(file_path)
+        text = self.store.get(category, kind, str(id))
+        if text is None:
+            print(f"檔案 {file_path} 不存在，跳過此檔案。")
+        return text
+
     def read_file(self, file_path):
         """ 讀取檔案內容並處理錯誤 """
         try:
@@ -0,0 +1,219 @@
+import hashlib
+import json
+import os
+import zlib
+
+import numpy as np
+
+DEDUP_VERSION = 2
+MERSENNE_PRIME = (1 << 31) - 1
+
+
+def text_key(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:20]
+
+
+class MinHasher:
+    """
+    以字元 shingle（預設連續 5 個非空白字元）計算 MinHash 簽章，
+    兩段文字簽章相同位置的比例即為其 shingle 集合 Jaccard 相似度的估計
+    """
+    def __init__(self, num_perm=128, shingle_size=5, seed=0):
+        rng = np.random.default_rng(seed)
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.a = rng.integers(1, MERSENNE_PRIME, num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, MERSENNE_PRIME, num_perm, dtype=np.uint64)
+
+    def signature(self, text):
+        text = ''.join(text.split())
+        size = min(self.shingle_size, len(text))
+        shingles = {text[i:i + size] for i in range(len(text) - size + 1)} if text else set()
+        if not shingles:
+            return np.full(self.num_perm, MERSENNE_PRIME, dtype=np.uint64)
+        hashes = np.fromiter((zlib.crc32(shingle.encode('utf-8')) for shingle in shingles),
+                             dtype=np.uint64, count=len(shingles)) % MERSENNE_PRIME
+        return ((np.outer(self.a, hashes) + self.b[:, None]) % MERSENNE_PRIME).min(axis=1)
+
+
+def near_duplicates(texts, hasher, threshold=0.8, bands=16):
+    """
+    依序處理每段文字，回傳每段的代表段落位置（自己就是代表時為自己）與 (完全相同數, 近似重複數)
+    完全相同的文字直接對應；threshold 不為 None 時，其餘以 LSH（簽章切成 bands 段，任一段相同即為候選）
+    找出候選代表，估計的 Jaccard 相似度不低於 threshold 時對應到最相似的代表。只與代表比較，不會經由中間段落串連
+    """
+    rows = hasher.num_perm // bands
+    buckets = [{} for _ in range(bands)]
+    signatures = {}
+    exact = {}
+    canonical = list(range(len(texts)))
+    exact_duplicates = 0
+    near = 0
+    for i, text in enumerate(texts):
+        key = text_key(text)
+        if key in exact:
+            canonical[i] = exact[key]
+            exact_duplicates += 1
+            continue
+        if threshold is None:
+            exact[key] = i
+            continue
+
+        signature = hasher.signature(text)
+        band_keys = [signature[band * rows:(band + 1) * rows].tobytes() for band in range(bands)]
+        candidates = {j for band, band_key in enumerate(band_keys) for j in buckets[band].get(band_key, ())}
+        best, best_similarity = None, threshold
+        for j in sorted(candidates):
+            similarity = float((signatures[j] == signature).mean())
+            if similarity >= best_similarity:
+                best, best_similarity = j, similarity
+        if best is not None:
+            canonical[i] = exact[key] = best
+            near += 1
+            continue
+
+        exact[key] = i
+        signatures[i] = signature
+        for band, band_key in enumerate(band_keys):
+            buckets[band].setdefault(band_key, []).append(i)
+    return canonical, (exact_duplicates, near)
+
+
+class DedupIndex:
+    """
+    語料中重複與近似重複段落的對應表
+    以段落文字的雜湊對應到代表段落，檢索時近似重複的段落換成代表段落，同一題中每個代表段落只計算一次分數，
+    再將分數分給所有包含它的文件；完全相同的段落本來就只計算一次，不需記錄。
+    近似重複只在建立時指定 threshold 才會合併（只差在數字等細節的段落可能被合併），預設只統計完全相同的段落；
+    切段參數或語料不同時對應表即失效
+    """
+    def __init__(self, meta):
+        self.meta = meta
+        self.chunks = meta["chunks"]
+        self.canonical_texts = meta["canonical"]
+        self.stats = {"paragraphs": 0, "distinct": 0, "scored": 0}
+
+    @staticmethod
+    def path(index_dir, name='dedup'):
+        return os.path.join(index_dir, f"{name}.json")
+
+    @staticmethod
+    def read_meta(index_dir, name='dedup'):
+        meta_path = DedupIndex.path(index_dir, name)
+        if not os.path.isfile(meta_path):
+            return None
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    @staticmethod
+    def is_valid(meta, length, overlap, fingerprint):
+        """ 切段參數或語料指紋（來源檔案的大小與修改時間）不同時，對應表即失效 """
+        return (meta is not None
+                and meta.get("version") == DEDUP_VERSION
+                and meta.get("length") == length
+                and meta.get("overlap") == overlap
+                and meta.get("fingerprint") == fingerprint)
+
+    @classmethod
+    def load(cls, index_dir, length, overlap, fingerprint, name='dedup'):
+        """ 載入對應表，若不存在或已失效則回傳 None """
+        meta = cls.read_meta(index_dir, name)
+        if not cls.is_valid(meta, length, overlap, fingerprint):
+            print(f"Warning: Dedup index in '{index_dir}' is missing or stale, "
+                  f"run build_index.py with --dedup to rebuild it.")
+            return None
+        return cls(meta)
+
+    @classmethod
+    def build(cls, index_dir, corpus, split, length, overlap, fingerprint, threshold=None, num_perm=128,
+              bands=16, shingle_size=5, name='dedup'):
+        """
+        切段後找出重複（threshold 不為 None 時包含近似重複）的段落，並另外統計重複的文件數
+        corpus: 產生 (category, id, text) 的可迭代物件
+        split: 切段函式 split(text, length, overlap)，需與檢索時相同
+        fingerprint: 語料指紋，載入時與目前語料比對
+        """
+        os.makedirs(index_dir, exist_ok=True)
+        hasher = MinHasher(num_perm, shingle_size)
+
+        documents = []
+        paragraphs = []
+        for category, id, text in corpus:
+            if text:
+                documents.append(text)
+                paragraphs.extend(split(text, length, overlap))
+        if not paragraphs:
+            raise ValueError("No paragraphs to deduplicate.")
+
+        canonical, (exact_duplicates, near) = near_duplicates(paragraphs, hasher, threshold, bands)
+        document_canonical, _ = near_duplicates(documents, hasher, threshold, bands)
+
+        # 只記錄近似重複的段落：段落的雜湊 -> 代表段落編號，代表段落本身也對應到自己
+        slots = {}
+        chunks = {}
+        for i, j in enumerate(canonical):
+            if paragraphs[i] != paragraphs[j]:
+                slot = slots.setdefault(j, len(slots))
+                chunks[text_key(paragraphs[j])] = slot
+                chunks[text_key(paragraphs[i])] = slot
+        canonical_texts = [None] * len(slots)
+        for j, slot in slots.items():
+            canonical_texts[slot] = paragraphs[j]
+
+        unique = set(canonical)
+        total_characters = sum(map(len, paragraphs))
+        unique_characters = sum(len(paragraphs[j]) for j in unique)
+        stats = {
+            "documents": len(documents),
+            "duplicate_documents": sum(i != j for i, j in enumerate(document_canonical)),
+            "paragraphs": len(paragraphs),
+            "exact_duplicates": exact_duplicates,
+            "near_duplicates": near,
+            "unique_paragraphs": len(unique),
+            "characters": total_characters,
+            "unique_characters": unique_characters,
+            "eliminated_ratio": 1 - unique_characters / max(total_characters, 1),
+        }
+        meta = {
+            "version": DEDUP_VERSION,
+            "length": length,
+            "overlap": overlap,
+            "fingerprint": fingerprint,
+            "threshold": threshold,
+            "num_perm": num_perm,
+            "bands": bands,
+            "shingle_size": shingle_size,
+            "stats": stats,
+            "chunks": chunks,
+            "canonical": canonical_texts,
+        }
+        with open(cls.path(index_dir, name), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        return cls(meta)
+
+    def canonical(self, paragraph):
+        """ 回傳段落所屬群組的代表段落，沒有重複時回傳原段落 """
+        slot = self.chunks.get(text_key(paragraph))
+        return paragraph if slot is None else self.canonical_texts[slot]
+
+    def record(self, paragraphs, distinct, scored):
+        """ paragraphs: 段落總數；distinct: 去除完全相同後的段落數；scored: 換成代表段落後實際計算的段落數 """
+        self.stats["paragraphs"] += paragraphs
+        self.stats["distinct"] += distinct
+        self.stats["scored"] += scored
+
+    def build_report(self):
+        """ 回傳建立對應表時統計的重複數量與可省下的模型計算量 """
+        stats = self.meta["stats"]
+        kind = "near duplicates" if self.meta["threshold"] is not None else "near duplicates (disabled)"
+        return (f"Dedup: {stats['paragraphs']} paragraphs, {stats['exact_duplicates']} exact and "
+                f"{stats['near_duplicates']} {kind}, {stats['unique_paragraphs']} unique; "
+                f"{stats['eliminated_ratio']:.1%} of encoded characters eliminated; "
+                f"{stats['duplicate_documents']} of {stats['documents']} documents are duplicates")
+
+    def report(self):
+        """ 回傳檢索時近似重複對應額外省下的段落計算數；完全相同的段落不論有無對應表都只計算一次 """
+        saved = self.stats["distinct"] - self.stats["scored"]
+        return (f"Dedup: {self.stats['paragraphs']} paragraphs, {self.stats['distinct']} distinct "
+                f"(exact duplicates are always scored once), scored {self.stats['scored']}, "
+                f"near-duplicate mapping saved {saved} ({saved / max(self.stats['distinct'], 1):.1%})")
@@ -0,0 +1,123 @@
+import json
+import os
+
+import numpy as np
+
+from chunking import length_buckets
+
+INDEX_VERSION = 1
+
+
+class EmbeddingIndex:
+    """
+    預先計算好的段落向量索引
+    向量以 .npy 存成一個 (段落數, 維度) 的矩陣，查詢時以 mmap 開啟，
+    並以 {category: {id: [start, end]}} 的表格對應每份文件所屬的列範圍
+    """
+    def __init__(self, matrix, meta):
+        self.matrix = matrix
+        self.meta = meta
+        self.table = meta["table"]
+
+    @staticmethod
+    def paths(index_dir, name='biencoder'):
+        return (os.path.join(index_dir, f"{name}.npy"),
+                os.path.join(index_dir, f"{name}.json"))
+
+    @staticmethod
+    def read_meta(index_dir, name='biencoder'):
+        _, meta_path = EmbeddingIndex.paths(index_dir, name)
+        if not os.path.isfile(meta_path):
+            return None
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    @staticmethod
+    def is_valid(meta, model_name, length, overlap):
+        """ 模型名稱或切段參數不同時，索引即失效 """
+        return (meta is not None
+                and meta.get("version") == INDEX_VERSION
+                and meta.get("model_name") == model_name
+                and meta.get("length") == length
+                and meta.get("overlap") == overlap)
+
+    @classmethod
+    def load(cls, index_dir, model_name, length, overlap, name='biencoder'):
+        """ 載入索引，若不存在或已失效則回傳 None """
+        meta = cls.read_meta(index_dir, name)
+        if not cls.is_valid(meta, model_name, length, overlap):
+            print(f"Warning: Embedding index in '{index_dir}' is missing or stale, "
+                  f"falling back to on-the-fly encoding.")
+            return None
+        matrix_path, _ = cls.paths(index_dir, name)
+        matrix = np.load(matrix_path, mmap_mode='r')
+        return cls(matrix, meta)
+
+    @classmethod
+    def build(cls, index_dir, corpus, encode, split, model_name, length, overlap,
+              dtype='float16', batch_size=256, name='biencoder'):
+        """
+        對整個語料的每個段落做一次編碼並寫入索引
+        corpus: 產生 (category, id, text) 的可迭代物件
+        encode: 將字串列表編碼成已正規化向量的函式
+        split: 切段函式 split(text, length, overlap)
+        """
+        os.makedirs(index_dir, exist_ok=True)
+        matrix_path, meta_path = cls.paths(index_dir, name)
+
+        # 先切段以得知總列數與每份文件的列範圍
+        paragraphs = []
+        table = {}
+        for category, id, text in corpus:
+            start = len(paragraphs)
+            if text:
+                paragraphs.extend(split(text, length, overlap))
+            table.setdefault(category, {})[id] = [start, len(paragraphs)]
+
+        if not paragraphs:
+            raise ValueError("No paragraphs to index.")
+
+        # 依長度分桶編碼，同一批的段落長度相近，減少 padding；結果寫回原本的列
+        batches = length_buckets([len(paragraph) for paragraph in paragraphs], batch_size)
+        first = np.asarray(encode([paragraphs[i] for i in batches[0]]))
+        dim = first.shape[1]
+        tmp_path = matrix_path + '.tmp.npy'
+        matrix = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype,
+                                           shape=(len(paragraphs), dim))
+        matrix[batches[0]] = first
+        for batch in batches[1:]:
+            matrix[batch] = np.asarray(encode([paragraphs[i] for i in batch]))
+        matrix.flush()
+        del matrix
+        os.replace(tmp_path, matrix_path)
+
+        meta = {
+            "version": INDEX_VERSION,
+            "model_name": model_name,
+            "length": length,
+            "overlap": overlap,
+            "dtype": dtype,
+            "dim": dim,
+            "rows": len(paragraphs),
+            "table": table,
+        }
+        with open(meta_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        return cls.load(index_dir, model_name, length, overlap, name)
+
+    def rows(self, category, id):
+        """ 回傳該文件所有段落向量（mmap 上的切片，不複製） """
+        start, end = self.table.get(category, {}).get(str(id), (0, 0))
+        return self.matrix[start:end]
+
+    def score(self, query_embedding, category, source_id):
+        """ 每份候選文件取段落相似度最大值，無段落的文件為 0 """
+        query_embedding = np.asarray(query_embedding, dtype=np.float32).reshape(-1)
+        scores = []
+        for id in source_id:
+            rows = self.rows(category, id)
+            if len(rows) == 0:
+                scores.append(0)
+                continue
+            scores.append(float((rows @ query_embedding).max()))
+        return scores
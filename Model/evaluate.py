@@ -0,0 +1,167 @@
+import argparse
+import itertools
+import json
+import time
+
+from tqdm import tqdm
+
+from data_interface import MyDataset
+from instrumentation import metrics
+from retrieval import (BiEncorderRetriever, BM25Retriever, CachedRetriever, MultiVectorRetriever, RerankRetriever,
+                       Retriever, PARAGRAPH_LENGTH, PARAGRAPH_OVERLAP)
+from score_cache import ScoreCache
+
+COST_COUNTERS = ('score_cache_misses', 'score_cache_hits', 'paragraphs')
+
+
+def parse_strategy(spec):
+    """ 'reranker:BAAI/bge-reranker-v2-m3' -> ('reranker', 'BAAI/bge-reranker-v2-m3') """
+    name, _, model_name = spec.partition(':')
+    if name not in ('bm25', 'biencoder', 'flag', 'reranker', 'multivector'):
+        raise argparse.ArgumentTypeError(f"unknown strategy '{name}'")
+    if name != 'bm25' and not model_name:
+        raise argparse.ArgumentTypeError(f"strategy '{name}' needs a model name, e.g. {name}:BAAI/bge-m3")
+    return name, model_name or None
+
+
+def parse_threshold(value):
+    return None if value.lower() == 'none' else float(value)
+
+
+def build_strategy(name, model_name, cache, batch_size=256):
+    """ 建立檢索策略，模型分數透過快取計算，參數組合之間共用已計算的段落分數 """
+    if name == 'bm25':
+        return BM25Retriever()
+    if name == 'reranker':
+        strategy = RerankRetriever(model_name, batch_size=batch_size)
+    elif name == 'multivector':
+        strategy = MultiVectorRetriever(model_name, batch_size=batch_size)
+    else:
+        framework = 'flag' if name == 'flag' else 'sentence-transformers'
+        strategy = BiEncorderRetriever(model_name, framework=framework)
+    return CachedRetriever(strategy, cache, f"{name}:{model_name}")
+
+
+def rank_sources(retriever, sample, summary_threshold):
+    """ 回傳依分數排序的候選文件 id；使用 summary 時，summary 選出的答案排在第一 """
+    score = retriever._score_source_context(sample)
+    ranking = [sample["source"][i] for i in sorted(range(len(score)), key=lambda i: -score[i])]
+    if summary_threshold is not None:
+        answer = retriever._rerank_with_summary(sample, score)
+        ranking.remove(answer)
+        ranking.insert(0, answer)
+    return ranking
+
+
+def evaluate_config(retriever, samples, ground_truths, summary_threshold):
+    """
+    計算各類別與整體的 precision@1（即比賽的正確率）與 MRR
+    """
+    per_category = {}
+    for sample in samples:
+        ranking = rank_sources(retriever, dict(sample), summary_threshold)
+        answer = ground_truths[sample["qid"]]["retrieve"]
+        reciprocal_rank = 1 / (ranking.index(answer) + 1) if answer in ranking else 0
+        for category in (sample["category"], 'all'):
+            entry = per_category.setdefault(category, {"questions": 0, "correct": 0, "mrr": 0.0})
+            entry["questions"] += 1
+            entry["correct"] += int(ranking[0] == answer)
+            entry["mrr"] += reciprocal_rank
+    for entry in per_category.values():
+        entry["precision"] = entry.pop("correct") / entry["questions"]
+        entry["mrr"] /= entry["questions"]
+    return per_category
+
+
+def run_grid(args):
+    dataset = MyDataset(args.question_path, args.source_dir, args.ground_truths_path)
+    use_summary = any(threshold is not None for threshold in args.summary_thresholds)
+    samples = [dataset.__getitem__(i, 'True' if use_summary else 'False')
+               for i in tqdm(range(len(dataset)), desc='loading')
+               if dataset.data[i]["qid"] in dataset.ground_truths]
+    if not samples:
+        raise ValueError("No question has a ground truth.")
+
+    metrics.enable()
+    cache = ScoreCache(args.score_cache, args.score_cache_size)
+    results = []
+    for name, model_name in args.strategies:
+        strategy = build_strategy(name, model_name, cache, args.batch_size)
+        # 相同切段的設定排在一起，只有新的切段方式需要模型計算，其餘從快取取得分數
+        for length, overlap, threshold in itertools.product(
+                args.paragraph_lengths, args.paragraph_overlaps, args.summary_thresholds):
+            if overlap >= length:
+                continue
+            retriever = Retriever(strategy, paragraph_length=length, paragraph_overlap=overlap,
+                                  summary_threshold=threshold if threshold is not None else 0.9)
+            before = {counter: metrics.counters.get(counter, 0) for counter in COST_COUNTERS}
+            start = time.perf_counter()
+            per_category = evaluate_config(retriever, samples, dataset.ground_truths, threshold)
+            elapsed = time.perf_counter() - start
+            cost = {counter: metrics.counters.get(counter, 0) - before[counter] for counter in COST_COUNTERS}
+            config = {"strategy": name, "model_name": model_name, "paragraph_length": length,
+                      "paragraph_overlap": overlap, "summary_threshold": threshold}
+            results.append({"config": config, "metrics": per_category, "seconds": elapsed,
+                            "model_pairs": cost["score_cache_misses"],
+                            "cached_pairs": cost["score_cache_hits"],
+                            "paragraphs": cost["paragraphs"]})
+            print(f"{config} precision={per_category['all']['precision']:.4f} "
+                  f"mrr={per_category['all']['mrr']:.4f} {elapsed:.1f}s")
+    cache.close()
+
+    results.sort(key=lambda result: (-result["metrics"]["all"]["precision"],
+                                     -result["metrics"]["all"]["mrr"], result["seconds"]))
+    return results
+
+
+def print_table(results, categories=('insurance', 'finance', 'faq')):
+    header = f"{'rank':>4}  {'strategy':<32}{'len':>5}{'ovl':>5}{'thr':>6}{'P@1':>8}{'MRR':>8}"
+    header += ''.join(f"{category[:7] + ' P@1':>14}" for category in categories)
+    header += f"{'seconds':>10}{'model pairs':>13}{'cached':>10}"
+    print(header)
+    for rank, result in enumerate(results, 1):
+        config = result["config"]
+        strategy = config["strategy"] + (f":{config['model_name']}" if config["model_name"] else '')
+        threshold = config["summary_threshold"]
+        line = (f"{rank:>4}  {strategy[:31]:<32}{config['paragraph_length']:>5}{config['paragraph_overlap']:>5}"
+                f"{threshold if threshold is not None else '-':>6}"
+                f"{result['metrics']['all']['precision']:>8.4f}{result['metrics']['all']['mrr']:>8.4f}")
+        for category in categories:
+            entry = result["metrics"].get(category)
+            line += f"{entry['precision'] if entry else float('nan'):>14.4f}"
+        line += f"{result['seconds']:>10.1f}{result['model_pairs']:>13}{result['cached_pairs']:>10}"
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Evaluate retrieval configurations against ground truths.')
+    parser.add_argument('--question_path', type=str,
+                        required=True, help='讀取發布題目路徑')
+    parser.add_argument('--ground_truths_path', type=str,
+                        required=True, help='讀取標準答案路徑（ground_truths_example.json 格式）')
+    parser.add_argument('--source_dir', type=str,
+                        required=True, help='讀取參考資料路徑')
+    parser.add_argument('--output', type=str, default='evaluation.json',
+                        help='輸出每個參數組合結果的 json 路徑')
+    parser.add_argument('--strategies', type=parse_strategy, nargs='+', default=[('bm25', None)],
+                        help='要比較的策略，非 bm25 需附模型名稱，例如 reranker:BAAI/bge-reranker-v2-m3')
+    parser.add_argument('--paragraph_lengths', type=int, nargs='+', default=[PARAGRAPH_LENGTH],
+                        help='要比較的段落字數')
+    parser.add_argument('--paragraph_overlaps', type=int, nargs='+', default=[PARAGRAPH_OVERLAP],
+                        help='要比較的段落重疊字數')
+    parser.add_argument('--summary_thresholds', type=parse_threshold, nargs='+', default=[None],
+                        help='要比較的 summary 門檻，none 表示不使用 summary')
+    parser.add_argument('--batch_size', type=int, default=256,
+                        help='模型每次計算的配對數')
+    parser.add_argument('--score_cache', type=str, default='cache/eval_scores.db',
+                        help='段落分數快取路徑，重複評估時只需計算新的段落')
+    parser.add_argument('--score_cache_size', type=int, default=5_000_000,
+                        help='分數快取最多保留的配對數')
+
+    args = parser.parse_args()
+
+    results = run_grid(args)
+    print_table(results)
+    with open(args.output, 'w', encoding='utf8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=4)
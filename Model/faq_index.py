@@ -0,0 +1,64 @@
+import json
+import os
+
+from bm25_index import BM25Index
+from embedding_index import EmbeddingIndex
+
+# 索引以 length 判斷切段方式，問答配對索引每列為一個 FAQ 問題
+FAQ_LENGTH = 'faq_questions'
+
+
+def load_faq_pairs(pairs_path):
+    """ 讀取 faq_text_concate.py 輸出的問答配對，回傳 {faq_id: [{"question", "answer"}]} """
+    with open(pairs_path, 'r', encoding='utf-8') as f:
+        pairs = json.load(f)["pairs"]
+    faq_pairs = {}
+    for pair in pairs:
+        faq_pairs.setdefault(str(pair["faq_id"]), []).append(pair)
+    return faq_pairs
+
+
+def iter_faq_questions(faq_pairs):
+    """ 每個 FAQ id 產生一筆 ('faq', id, 以換行相接的問題)，搭配 split_questions 每個問題為一列 """
+    for faq_id, pairs in faq_pairs.items():
+        yield 'faq', faq_id, '\n'.join(' '.join(pair["question"].split()) for pair in pairs)
+
+
+def split_questions(text, length=None, overlap=None):
+    return [question for question in text.split('\n') if question]
+
+
+class FAQPairIndex:
+    """
+    FAQ 問答配對粒度的索引：每個問題的向量與 BM25 詞頻各自為一列，表格記錄每個 FAQ id 的問題列範圍
+    查詢時只需編碼題目（或斷詞）後查表，每個 FAQ id 取其所有問題的最高分，不需對合併後的 FAQ 全文切段計分
+    有 encode 時以向量查詢，否則以問題的 BM25 查詢
+    """
+    def __init__(self, bm25, embedding=None, encode=None, tokenize=None):
+        self.bm25 = bm25
+        self.embedding = embedding
+        self.encode = encode
+        self.tokenize = tokenize
+
+    @staticmethod
+    def pairs_path(source_dir):
+        return os.path.join(source_dir, 'faq_pairs.json')
+
+    @classmethod
+    def load(cls, index_dir, model_name=None, encode=None, tokenize=None):
+        """ 載入索引，若不存在或已失效則回傳 None；指定 model_name 但向量索引失效時改用 BM25 """
+        bm25 = BM25Index.load(index_dir, FAQ_LENGTH, None, name='bm25_faq_questions')
+        embedding = None
+        if model_name is not None:
+            embedding = EmbeddingIndex.load(index_dir, model_name, FAQ_LENGTH, None, name='faq_questions')
+        if embedding is None and bm25 is None:
+            print(f"Warning: FAQ pair index in '{index_dir}' is missing or stale, "
+                  f"run build_index.py with --faq_pairs to rebuild it.")
+            return None
+        return cls(bm25, embedding, encode if embedding is not None else None, tokenize)
+
+    def score(self, query, source_id):
+        """ 每個候選 FAQ id 取其問題的最高分，不在索引中的 id 為 0 """
+        if self.encode is not None:
+            return self.embedding.score(self.encode(query), 'faq', source_id)
+        return self.bm25.score(self.tokenize(query), 'faq', source_id)
@@ -0,0 +1,142 @@
+import bisect
+import contextlib
+import functools
+import json
+import threading
+import time
+
+# 延遲直方圖的上界（秒），與 Prometheus 預設相近
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Metrics:
+    """
+    記錄各階段耗時與計數，未啟用時所有紀錄函式都直接返回
+    管線、服務與分片模式會從多個執行緒同時記錄，更新與輸出都在鎖內進行
+    """
+    def __init__(self):
+        self.enabled = False
+        self.stages = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+
+    def record(self, stage, seconds):
+        if not self.enabled:
+            return
+        with self._lock:
+            entry = self.stages.get(stage)
+            if entry is None:
+                entry = self.stages[stage] = {"count": 0, "total": 0.0, "max": 0.0,
+                                              "buckets": [0] * (len(BUCKETS) + 1)}
+            entry["count"] += 1
+            entry["total"] += seconds
+            entry["max"] = max(entry["max"], seconds)
+            entry["buckets"][bisect.bisect_left(BUCKETS, seconds)] += 1
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def snapshot(self):
+        """ 回傳 (stages, counters) 的複本，輸出時不受其他執行緒同時更新影響 """
+        with self._lock:
+            stages = {stage: dict(entry, buckets=list(entry["buckets"])) for stage, entry in self.stages.items()}
+            return stages, dict(self.counters)
+
+    def report(self):
+        stages_snapshot, counters = self.snapshot()
+        stages = {}
+        for stage, entry in sorted(stages_snapshot.items()):
+            stages[stage] = {
+                "count": entry["count"],
+                "total_s": entry["total"],
+                "mean_ms": entry["total"] / entry["count"] * 1000,
+                "max_ms": entry["max"] * 1000,
+                "histogram": {str(le): n for le, n in zip(BUCKETS + ('+Inf',), entry["buckets"])},
+            }
+        return {"stages": stages, "counters": dict(sorted(counters.items()))}
+
+    def export_json(self, path):
+        with open(path, 'w', encoding='utf8') as f:
+            json.dump(self.report(), f, ensure_ascii=False, indent=4)
+
+    def export_prometheus(self, path):
+        """ 輸出 Prometheus text format，可交給 node_exporter 的 textfile collector """
+        stages, counters = self.snapshot()
+        lines = ["# HELP retrieval_stage_seconds Time spent in each retrieval stage.",
+                 "# TYPE retrieval_stage_seconds histogram"]
+        for stage, entry in sorted(stages.items()):
+            cumulative = 0
+            for le, n in zip(BUCKETS + ('+Inf',), entry["buckets"]):
+                cumulative += n
+                lines.append(f'retrieval_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+            lines.append(f'retrieval_stage_seconds_sum{{stage="{stage}"}} {entry["total"]}')
+            lines.append(f'retrieval_stage_seconds_count{{stage="{stage}"}} {entry["count"]}')
+        for name, value in sorted(counters.items()):
+            lines.append(f"# TYPE retrieval_{name}_total counter")
+            lines.append(f"retrieval_{name}_total {value}")
+        with open(path, 'w', encoding='utf8') as f:
+            f.write('\n'.join(lines) + '\n')
+
+
+metrics = Metrics()
+
+
+def instrumented(stage):
+    """
+    記錄函式耗時的裝飾器，未啟用時只多一次旗標判斷
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not metrics.enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                metrics.record(stage, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+class StartupProfile:
+    """
+    記錄啟動階段（匯入模組、載入模型、讀取資料）的耗時，供 --profile_startup 輸出
+    巢狀的階段會縮排顯示，總計只加總最外層
+    """
+    def __init__(self):
+        self.stages = []
+        self.depth = 0
+
+    def add(self, name, seconds):
+        self.stages.append([name, seconds, self.depth])
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        entry = [name, 0.0, self.depth]
+        self.stages.append(entry)
+        self.depth += 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            entry[1] = time.perf_counter() - start
+            self.depth -= 1
+
+    def report(self):
+        names = ['  ' * depth + name for name, _, depth in self.stages]
+        width = max([len(name) for name in names] + [5])
+        lines = [f"{name:<{width}}  {seconds * 1000:>10.1f} ms"
+                 for name, (_, seconds, _) in zip(names, self.stages)]
+        total = sum(seconds for _, seconds, depth in self.stages if depth == 0)
+        lines.append(f"{'total':<{width}}  {total * 1000:>10.1f} ms")
+        return '\n'.join(lines)
+
+
+startup = StartupProfile()
@@ -0,0 +1,119 @@
+import argparse
+import http.client
+import json
+import socket
+import threading
+import time
+
+import numpy as np
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """ 透過 Unix socket 連線的 HTTPConnection """
+    def __init__(self, path):
+        super().__init__('localhost')
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+def connect(args):
+    if args.unix_socket:
+        return UnixHTTPConnection(args.unix_socket)
+    return http.client.HTTPConnection(args.host, args.port)
+
+
+def run_load(args, questions):
+    """
+    以 args.concurrency 個執行緒（各自一條 keep-alive 連線）送出所有題目，
+    回傳 (答案, 每題延遲, 總耗時)
+    """
+    answers = [None] * len(questions)
+    latencies = [None] * len(questions)
+    next_index = iter(range(len(questions)))
+    lock = threading.Lock()
+    errors = []
+
+    def worker():
+        try:
+            send_all(connect(args))
+        except Exception as e:
+            errors.append(e)
+
+    def send_all(conn):
+        while True:
+            with lock:
+                i = next(next_index, None)
+            if i is None:
+                break
+            question = questions[i]
+            body = json.dumps({"qid": question["qid"], "query": question["query"],
+                               "source": question["source"], "category": question["category"]},
+                              ensure_ascii=False).encode('utf-8')
+            start = time.perf_counter()
+            conn.request('POST', '/retrieve', body, {"Content-Type": "application/json"})
+            response = conn.getresponse()
+            result = json.loads(response.read())
+            latencies[i] = time.perf_counter() - start
+            if response.status != 200:
+                raise RuntimeError(f"qid {question['qid']}: {result}")
+            answers[i] = {"qid": question["qid"], "retrieve": result["retrieve"]}
+        conn.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(args.concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return answers, latencies, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Load generator for server.py, reports QPS and latency.')
+    parser.add_argument('--question_path', type=str,
+                        required=True, help='讀取發布題目路徑')
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='服務位址')
+    parser.add_argument('--port', type=int, default=8000,
+                        help='服務埠號')
+    parser.add_argument('--unix_socket', type=str, default=None,
+                        help='改為連線到 Unix socket 的路徑')
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help='同時送出請求的連線數')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='重複送出題目的次數')
+    parser.add_argument('--compare_path', type=str, default=None,
+                        help='retrieval.py 輸出的答案路徑，比對服務的答案是否相同')
+    parser.add_argument('--output_path', type=str, default=None,
+                        help='輸出服務回傳答案的路徑')
+
+    args = parser.parse_args()
+
+    with open(args.question_path, 'r', encoding='utf-8') as f:
+        questions = json.load(f).get("questions", [])
+
+    answers, latencies, elapsed = run_load(args, questions * args.repeat)
+    latencies = np.asarray(latencies)
+    print(f"requests: {len(latencies)}  concurrency: {args.concurrency}  "
+          f"QPS: {len(latencies) / elapsed:.1f}")
+    print(f"latency p50: {np.percentile(latencies, 50) * 1000:.2f} ms  "
+          f"p95: {np.percentile(latencies, 95) * 1000:.2f} ms  "
+          f"p99: {np.percentile(latencies, 99) * 1000:.2f} ms")
+
+    answers = answers[:len(questions)]
+    if args.compare_path:
+        with open(args.compare_path, 'r', encoding='utf-8') as f:
+            expected = {answer["qid"]: answer["retrieve"] for answer in json.load(f)["answers"]}
+        mismatches = [answer["qid"] for answer in answers if expected.get(answer["qid"]) != answer["retrieve"]]
+        print(f"mismatches with {args.compare_path}: {len(mismatches)}"
+              + (f" (qid {mismatches[:10]})" if mismatches else ""))
+
+    if args.output_path:
+        with open(args.output_path, 'w', encoding='utf8') as f:
+            json.dump({"answers": answers}, f, ensure_ascii=False, indent=4)
@@ -0,0 +1,124 @@
+import importlib
+import json
+import os
+import re
+import shutil
+import time
+
+from instrumentation import startup
+
+# 後端名稱 -> (模組, 類別, 建構參數, 儲存函式, 從 warm cache 載入後的處理)，模組在第一次載入模型時才匯入
+BACKENDS = {}
+
+WARM_CACHE_VERSION = 1
+
+
+def register_backend(name, module_name, class_name, save=None, cached_load=None, **kwargs):
+    """
+    註冊模型後端；save(model, path) 將模型與 tokenizer 存成 safetensors，
+    未提供時該後端不使用 warm cache；cached_load(model) 在從 warm cache 載入後呼叫，回傳處理後的模型
+    """
+    BACKENDS[name] = (module_name, class_name, kwargs, save, cached_load)
+
+
+def _save_sentence_transformer(model, path):
+    model.save(path, safe_serialization=True)
+
+
+def _half_on_gpu(model):
+    """
+    SentenceTransformer 載入時會將 fp16 權重轉回預設的 float32，在 GPU 上轉回 fp16 計算；
+    CPU 上許多運算不支援或很慢的 fp16，仍以 float32 計算（warm cache 只減少讀取的資料量）
+    """
+    if model.device.type == 'cuda':
+        model = model.half()
+    return model
+
+
+def _save_flag(model, path):
+    model.model.save_pretrained(path, safe_serialization=True)
+    model.tokenizer.save_pretrained(path)
+
+
+register_backend('sentence-transformers', 'sentence_transformers', 'SentenceTransformer',
+                 save=_save_sentence_transformer, cached_load=_half_on_gpu, trust_remote_code=True)
+register_backend('flag', 'FlagEmbedding', 'FlagModel', save=_save_flag,
+                 query_instruction_for_retrieval="为这个句子生成表示以用于检索相关文章：", use_fp16=True)
+register_backend('flag-reranker', 'FlagEmbedding', 'FlagReranker', save=_save_flag, use_fp16=True)
+# BGEM3FlagModel 另有 colbert / sparse 的線性層權重，不使用 warm cache
+register_backend('flag-m3', 'FlagEmbedding', 'BGEM3FlagModel', use_fp16=True)
+
+
+def warm_cache_path(cache_dir, backend, model_name):
+    return os.path.join(cache_dir, backend, re.sub(r'[^\w.-]+', '--', model_name) + '-fp16')
+
+
+def _is_complete(path, backend, model_name):
+    meta_path = os.path.join(path, 'warm_cache.json')
+    if not os.path.isfile(meta_path):
+        return False
+    with open(meta_path, 'r', encoding='utf-8') as f:
+        meta = json.load(f)
+    return (meta.get("version") == WARM_CACHE_VERSION
+            and meta.get("backend") == backend
+            and meta.get("model_name") == model_name)
+
+
+def _convert_to_fp16(path):
+    """ 將資料夾內所有 safetensors 權重的 float32 張量轉為 float16 """
+    file_paths = [os.path.join(root, file) for root, _, files in os.walk(path)
+                  for file in files if file.endswith('.safetensors')]
+    if not file_paths:
+        return
+
+    import torch
+    from safetensors.torch import load_file, save_file
+
+    for file_path in file_paths:
+        tensors = {name: tensor.half() if tensor.dtype == torch.float32 else tensor
+                   for name, tensor in load_file(file_path).items()}
+        save_file(tensors, file_path, metadata={"format": "pt"})
+
+
+def _save_warm_cache(model, save, path, backend, model_name):
+    """ 先寫到暫存資料夾，轉換完成後才換成正式路徑，避免中斷時留下不完整的 cache """
+    tmp_path = path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    save(model, tmp_path)
+    _convert_to_fp16(tmp_path)
+    with open(os.path.join(tmp_path, 'warm_cache.json'), 'w', encoding='utf-8') as f:
+        json.dump({"version": WARM_CACHE_VERSION, "backend": backend, "model_name": model_name,
+                   "dtype": "float16", "created": time.time()}, f, ensure_ascii=False)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+
+
+def load_model(backend, model_name, cache_dir=None):
+    """
+    匯入後端並載入模型，耗時記錄在 startup profile
+    指定 cache_dir 時，第一次載入後將權重轉成 fp16 safetensors 存入 cache，之後直接從本機載入
+    """
+    module_name, class_name, kwargs, save, cached_load = BACKENDS[backend]
+    with startup.stage(f"import {module_name}"):
+        model_class = getattr(importlib.import_module(module_name), class_name)
+
+    path = model_name
+    cached = False
+    if cache_dir and save is not None:
+        cache_path = warm_cache_path(cache_dir, backend, model_name)
+        cached = _is_complete(cache_path, backend, model_name)
+        if cached:
+            path = cache_path
+
+    with startup.stage(f"load {backend} '{model_name}'" + (" (warm cache)" if cached else "")):
+        model = model_class(path, **kwargs)
+        if cached and cached_load is not None:
+            model = cached_load(model)
+
+    if cache_dir and save is not None and not cached:
+        try:
+            with startup.stage(f"save warm cache '{model_name}'"):
+                _save_warm_cache(model, save, cache_path, backend, model_name)
+        except Exception as e:
+            print(f"Warning: Failed to save warm cache for '{model_name}': {e}")
+    return model
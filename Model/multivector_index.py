@@ -0,0 +1,153 @@
+import json
+import os
+
+import numpy as np
+
+from chunking import length_buckets
+
+MULTIVECTOR_VERSION = 1
+
+
+def maxsim(query_vectors, tokens, ranges):
+    """
+    ColBERT 的 MaxSim 分數：問題每個 token 與段落所有 token 的最大相似度取平均
+    tokens 為所有段落 token 向量相接的矩陣（可為 mmap），ranges 為每個段落在其中的 [start, end)；
+    所有段落的 token 一次與問題相乘，再以 reduceat 取每段最大值，沒有 token 的段落為 0
+    """
+    scores = np.zeros(len(ranges), dtype=np.float32)
+    lengths = np.array([end - start for start, end in ranges], dtype=np.int64)
+    nonempty = np.flatnonzero(lengths)
+    if len(nonempty) == 0 or len(query_vectors) == 0:
+        return scores
+    rows = np.concatenate([np.arange(*ranges[i]) for i in nonempty])
+    similarity = np.asarray(tokens[rows], dtype=np.float32) @ np.asarray(query_vectors, dtype=np.float32).T
+    offsets = np.concatenate([[0], np.cumsum(lengths[nonempty])[:-1]])
+    scores[nonempty] = np.maximum.reduceat(similarity, offsets, axis=0).mean(axis=1)
+    return scores
+
+
+class MultiVectorIndex:
+    """
+    預先計算好的段落 token 向量索引（ColBERT / bge-m3 多向量）
+    所有段落的 token 向量依段落順序相接存成 .npy 並以 mmap 開啟，offsets[i]:offsets[i + 1] 為第 i 段的 token，
+    同一份文件的段落相鄰，讀取一份文件只需一段連續的區塊；文件對應的段落範圍與 EmbeddingIndex 的表格相同
+    """
+    def __init__(self, tokens, offsets, meta):
+        self.tokens = tokens
+        self.offsets = offsets
+        self.meta = meta
+        self.table = meta["table"]
+
+    @staticmethod
+    def paths(index_dir, name='multivector'):
+        return (os.path.join(index_dir, f"{name}_tokens.npy"),
+                os.path.join(index_dir, f"{name}_offsets.npy"),
+                os.path.join(index_dir, f"{name}.json"))
+
+    @staticmethod
+    def read_meta(index_dir, name='multivector'):
+        _, _, meta_path = MultiVectorIndex.paths(index_dir, name)
+        if not os.path.isfile(meta_path):
+            return None
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    @staticmethod
+    def is_valid(meta, model_name, length, overlap):
+        """ 模型名稱或切段參數不同時，索引即失效 """
+        return (meta is not None
+                and meta.get("version") == MULTIVECTOR_VERSION
+                and meta.get("model_name") == model_name
+                and meta.get("length") == length
+                and meta.get("overlap") == overlap)
+
+    @classmethod
+    def load(cls, index_dir, model_name, length, overlap, name='multivector'):
+        """ 載入索引，若不存在或已失效則回傳 None """
+        meta = cls.read_meta(index_dir, name)
+        if not cls.is_valid(meta, model_name, length, overlap):
+            print(f"Warning: Multi-vector index in '{index_dir}' is missing or stale, "
+                  f"falling back to on-the-fly encoding.")
+            return None
+        tokens_path, offsets_path, _ = cls.paths(index_dir, name)
+        return cls(np.load(tokens_path, mmap_mode='r'), np.load(offsets_path), meta)
+
+    @classmethod
+    def build(cls, index_dir, corpus, encode, split, model_name, length, overlap,
+              dtype='float16', batch_size=256, name='multivector'):
+        """
+        對整個語料的每個段落編碼一次 token 向量並寫入索引
+        corpus: 產生 (category, id, text) 的可迭代物件
+        encode: 將字串列表編碼成 token 向量矩陣列表（已正規化）的函式
+        split: 切段函式 split(text, length, overlap)
+        """
+        os.makedirs(index_dir, exist_ok=True)
+        tokens_path, offsets_path, meta_path = cls.paths(index_dir, name)
+
+        paragraphs = []
+        table = {}
+        for category, id, text in corpus:
+            start = len(paragraphs)
+            if text:
+                paragraphs.extend(split(text, length, overlap))
+            table.setdefault(category, {})[id] = [start, len(paragraphs)]
+
+        if not paragraphs:
+            raise ValueError("No paragraphs to index.")
+
+        # 依長度分桶編碼，token 數在編碼後才知道，先依編碼順序寫入暫存檔，再依段落順序重排
+        raw_path = tokens_path + '.raw'
+        raw_ranges = [None] * len(paragraphs)
+        position = 0
+        dim = None
+        with open(raw_path, 'wb') as f:
+            for batch in length_buckets([len(paragraph) for paragraph in paragraphs], batch_size):
+                for i, vectors in zip(batch, encode([paragraphs[i] for i in batch])):
+                    vectors = np.asarray(vectors, dtype=dtype).reshape(len(vectors), -1)
+                    dim = vectors.shape[1] if vectors.size else dim
+                    f.write(vectors.tobytes())
+                    raw_ranges[i] = (position, position + len(vectors))
+                    position += len(vectors)
+
+        offsets = np.zeros(len(paragraphs) + 1, dtype=np.int64)
+        np.cumsum([end - start for start, end in raw_ranges], out=offsets[1:])
+        raw = np.memmap(raw_path, dtype=dtype, mode='r', shape=(position, dim))
+        tmp_path = tokens_path + '.tmp.npy'
+        tokens = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=(position, dim))
+        for i, (start, end) in enumerate(raw_ranges):
+            tokens[offsets[i]:offsets[i + 1]] = raw[start:end]
+        tokens.flush()
+        del tokens, raw
+        os.replace(tmp_path, tokens_path)
+        os.remove(raw_path)
+        np.save(offsets_path, offsets)
+
+        meta = {
+            "version": MULTIVECTOR_VERSION,
+            "model_name": model_name,
+            "length": length,
+            "overlap": overlap,
+            "dtype": dtype,
+            "dim": dim,
+            "rows": len(paragraphs),
+            "tokens": int(position),
+            "table": table,
+        }
+        with open(meta_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        return cls.load(index_dir, model_name, length, overlap, name)
+
+    def score(self, query_vectors, category, source_id):
+        """ 每份候選文件取段落 MaxSim 最大值，無段落的文件為 0 """
+        table = self.table.get(category, {})
+        doc_rows = [table.get(str(id), (0, 0)) for id in source_id]
+        ranges = [(self.offsets[row], self.offsets[row + 1]) for start, end in doc_rows for row in range(start, end)]
+        paragraph_score = maxsim(query_vectors, self.tokens, ranges)
+
+        scores = []
+        i = 0
+        for start, end in doc_rows:
+            n = end - start
+            scores.append(float(paragraph_score[i:i + n].max()) if n else 0)
+            i += n
+        return scores
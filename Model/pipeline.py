@@ -0,0 +1,66 @@
+import json
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from tqdm import tqdm
+
+
+def run_pipeline(dataset, retriever, is_use_summary='False', stream_path=None,
+                 threads=4, prefetch=64, max_batch=16):
+    """
+    串流檢索管線
+    背景執行緒依序讀取樣本並切段，放入有上限的佇列；
+    主執行緒（模型）每次取出已準備好的樣本組成一批計算，結果立即寫入 jsonl。
+    回傳的答案依資料集順序排列
+    """
+    pending = queue.Queue(maxsize=prefetch)
+
+    def prepare(index):
+        return retriever.prepare(dataset.__getitem__(index, is_use_summary))
+
+    def produce(executor):
+        # 佇列滿時會阻塞，避免預先讀入過多樣本
+        for index in range(len(dataset)):
+            pending.put(executor.submit(prepare, index))
+        pending.put(None)
+
+    answers = []
+    stream = open(stream_path, 'w', encoding='utf8') if stream_path else None
+    try:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            producer = threading.Thread(target=produce, args=(executor,), daemon=True)
+            producer.start()
+            with tqdm(total=len(dataset)) as progress:
+                done = False
+                while not done:
+                    # 至少等待一題，再把已經準備好的題目一起放進同一批
+                    futures = [pending.get()]
+                    while futures[-1] is not None and len(futures) < max_batch:
+                        try:
+                            future = pending.queue[0]
+                        except IndexError:
+                            break
+                        if future is not None and not future.done():
+                            break
+                        futures.append(pending.get())
+                    if futures[-1] is None:
+                        futures.pop()
+                        done = True
+                    if not futures:
+                        continue
+
+                    samples = [future.result() for future in futures]
+                    for sample, ans in zip(samples, retriever.retrieve_by_paragraph_batch(samples)):
+                        answer = {"qid": sample["qid"], "retrieve": ans}
+                        answers.append(answer)
+                        if stream:
+                            stream.write(json.dumps(answer, ensure_ascii=False) + '\n')
+                    if stream:
+                        stream.flush()
+                    progress.update(len(samples))
+            producer.join()
+    finally:
+        if stream:
+            stream.close()
+    return answers
@@ -0,0 +1,310 @@
+import argparse
+import json
+import os
+import random
+import time
+
+import numpy as np
+
+from embedding_index import EmbeddingIndex
+
+QUANTIZED_VERSION = 1
+
+
+class ScalarQuantizer:
+    """
+    int8 純量量化：每個維度以訓練資料的最大絕對值決定 scale，向量存成 round(x / scale)
+    查詢向量保持 float，先乘上 scale 再與 int8 向量做內積（非對稱計算），不需解碼
+    """
+    kind = 'int8'
+    code_dtype = np.int8
+
+    def __init__(self, scale):
+        self.scale = scale
+
+    @classmethod
+    def train(cls, train, **kwargs):
+        return cls((np.abs(train).max(axis=0) / 127).clip(min=1e-12).astype(np.float32))
+
+    def encode(self, block):
+        return np.clip(np.rint(block / self.scale), -127, 127).astype(self.code_dtype)
+
+    def score(self, query_embedding, codes):
+        return codes.astype(np.float32) @ (query_embedding * self.scale)
+
+    def arrays(self):
+        return {"scale": self.scale}
+
+
+class ProductQuantizer:
+    """
+    乘積量化：將向量切成 subspaces 段，每段以 k-means 學 256 個中心，向量存成每段最近中心的編號（每段 1 byte）
+    查詢時先算出問題每段與所有中心的內積表，段落分數為查表相加（非對稱距離計算）
+    """
+    kind = 'pq'
+    code_dtype = np.uint8
+
+    def __init__(self, codebooks):
+        # (subspaces, 中心數, 每段維度)
+        self.codebooks = codebooks
+
+    @classmethod
+    def train(cls, train, subspaces=None, iterations=20, seed=0, **kwargs):
+        dim = train.shape[1]
+        subspaces = subspaces or max(1, dim // 8)
+        if dim % subspaces:
+            raise ValueError(f"embedding dim {dim} is not divisible by {subspaces} subspaces")
+        rng = np.random.default_rng(seed)
+        centers = min(256, len(train))
+        parts = train.reshape(len(train), subspaces, -1)
+        codebooks = np.stack([_kmeans(np.ascontiguousarray(parts[:, j]), centers, iterations, rng)
+                              for j in range(subspaces)])
+        return cls(codebooks.astype(np.float32))
+
+    def encode(self, block):
+        parts = block.reshape(len(block), len(self.codebooks), -1)
+        codes = np.empty((len(block), len(self.codebooks)), dtype=self.code_dtype)
+        # 最近中心：||x - c||^2 = ||c||^2 - 2 x·c + ||x||^2，最後一項與中心無關
+        for j, codebook in enumerate(self.codebooks):
+            part = np.ascontiguousarray(parts[:, j])
+            codes[:, j] = ((codebook ** 2).sum(axis=1)[None] - 2 * part @ codebook.T).argmin(axis=1)
+        return codes
+
+    def score(self, query_embedding, codes):
+        table = np.einsum('jcd,jd->jc', self.codebooks, query_embedding.reshape(len(self.codebooks), -1))
+        return table[np.arange(len(self.codebooks)), codes].sum(axis=1)
+
+    def arrays(self):
+        return {"codebooks": self.codebooks}
+
+
+QUANTIZERS = {quantizer.kind: quantizer for quantizer in (ScalarQuantizer, ProductQuantizer)}
+
+
+def _kmeans(data, centers, iterations, rng):
+    """ 歐氏距離的 k-means，空群以隨機資料重新初始化 """
+    centroids = data[rng.choice(len(data), centers, replace=False)].copy()
+    for _ in range(iterations):
+        assign = ((centroids ** 2).sum(axis=1)[None] - 2 * data @ centroids.T).argmin(axis=1)
+        # 每段維度很小，逐維 bincount 比 np.add.at 快得多
+        sums = np.stack([np.bincount(assign, weights=data[:, d], minlength=centers)
+                         for d in range(data.shape[1])], axis=1)
+        counts = np.bincount(assign, minlength=centers)
+        empty = counts == 0
+        centroids = (sums / np.maximum(counts, 1)[:, None]).astype(np.float32)
+        centroids[empty] = data[rng.choice(len(data), int(empty.sum()))]
+    return centroids
+
+
+class QuantizedIndex:
+    """
+    EmbeddingIndex 段落向量的量化版本，提供與 EmbeddingIndex 相同的 score，可直接取代給 BiEncorderRetriever 使用
+    量化向量常駐記憶體，候選段落先以量化向量計算近似分數，分數最高的 rescore_k 段再從 mmap 的
+    float 向量精確重算；rescore_k 為 0 時只使用近似分數
+    """
+    def __init__(self, embedding_index, quantizer, codes, meta, rescore_k=32):
+        self.embedding_index = embedding_index
+        self.table = embedding_index.table
+        self.quantizer = quantizer
+        self.codes = codes
+        self.meta = meta
+        self.rescore_k = rescore_k
+
+    @staticmethod
+    def paths(index_dir, kind, name='biencoder'):
+        return (os.path.join(index_dir, f"{name}_{kind}.npz"),
+                os.path.join(index_dir, f"{name}_{kind}.json"))
+
+    @staticmethod
+    def read_meta(index_dir, kind, name='biencoder'):
+        _, meta_path = QuantizedIndex.paths(index_dir, kind, name)
+        if not os.path.isfile(meta_path):
+            return None
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    @staticmethod
+    def is_valid(meta, embedding_meta):
+        """ 段落向量索引重建（模型、切段參數或列數不同）後，量化索引即失效 """
+        return (meta is not None and embedding_meta is not None
+                and meta.get("version") == QUANTIZED_VERSION
+                and all(meta.get(key) == embedding_meta.get(key)
+                        for key in ("model_name", "length", "overlap", "rows")))
+
+    @classmethod
+    def load(cls, index_dir, embedding_index, kind, name='biencoder', rescore_k=32):
+        """ 載入索引，若不存在或已失效則回傳 None """
+        meta = cls.read_meta(index_dir, kind, name)
+        if not cls.is_valid(meta, embedding_index.meta):
+            print(f"Warning: {kind} quantized index in '{index_dir}' is missing or stale, "
+                  f"run build_index.py with --quantize {kind} to rebuild it.")
+            return None
+        path, _ = cls.paths(index_dir, kind, name)
+        with np.load(path) as data:
+            quantizer = QUANTIZERS[kind](**{key: data[key] for key in data.files if key != "codes"})
+            return cls(embedding_index, quantizer, data["codes"], meta, rescore_k)
+
+    @classmethod
+    def build(cls, index_dir, embedding_index, kind, subspaces=None, iterations=20, train_size=65536,
+              batch_size=65536, seed=0, name='biencoder'):
+        """
+        以 train_size 列訓練量化參數後，分批量化全部段落向量並寫入索引
+        """
+        matrix = embedding_index.matrix
+        rows = len(matrix)
+        rng = np.random.default_rng(seed)
+        train_size = min(train_size, rows)
+        train = np.asarray(matrix[np.sort(rng.choice(rows, train_size, replace=False))], dtype=np.float32)
+        quantizer = QUANTIZERS[kind].train(train, subspaces=subspaces, iterations=iterations, seed=seed)
+
+        codes = np.concatenate([quantizer.encode(np.asarray(matrix[start:start + batch_size], dtype=np.float32))
+                                for start in range(0, rows, batch_size)])
+
+        path, meta_path = cls.paths(index_dir, kind, name)
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, **quantizer.arrays(), codes=codes)
+        os.replace(tmp_path, path)
+
+        meta = {"version": QUANTIZED_VERSION, "kind": kind, "train_size": train_size}
+        if kind == 'pq':
+            meta.update({"subspaces": len(quantizer.codebooks), "iterations": iterations})
+        meta.update({key: embedding_index.meta[key] for key in ("model_name", "length", "overlap", "rows")})
+        with open(meta_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        return cls(embedding_index, quantizer, codes, meta)
+
+    def score(self, query_embedding, category, source_id):
+        """ 每份候選文件取段落相似度最大值，無段落的文件為 0 """
+        query_embedding = np.asarray(query_embedding, dtype=np.float32).reshape(-1)
+        table = self.table.get(category, {})
+        ranges = [table.get(str(id), (0, 0)) for id in source_id]
+        rows = np.concatenate([np.arange(start, end) for start, end in ranges]) if ranges else np.array([], int)
+        if len(rows) == 0:
+            return [0] * len(source_id)
+
+        row_score = self.quantizer.score(query_embedding, self.codes[rows])
+        if self.rescore_k > 0:
+            top = np.argsort(-row_score, kind='stable')[:self.rescore_k]
+            # mmap 上的 fancy index 只讀取需要的列
+            exact_rows = np.asarray(self.embedding_index.matrix[rows[top]], dtype=np.float32)
+            row_score[top] = exact_rows @ query_embedding
+
+        scores = []
+        i = 0
+        for start, end in ranges:
+            n = end - start
+            scores.append(float(row_score[i:i + n].max()) if n else 0)
+            i += n
+        return scores
+
+    def memory_report(self):
+        """ 比較常駐記憶體中的量化向量與 float 向量矩陣的大小（bytes） """
+        matrix = self.embedding_index.matrix
+        quantized = self.codes.nbytes + sum(array.nbytes for array in self.quantizer.arrays().values())
+        return {
+            "rows": len(matrix),
+            "float32_bytes": int(matrix.shape[0] * matrix.shape[1] * 4),
+            "stored_float_bytes": int(matrix.nbytes),
+            "quantized_bytes": int(quantized),
+            "compression_vs_float32": matrix.shape[0] * matrix.shape[1] * 4 / quantized,
+        }
+
+
+def compare_with_float(index, queries, rescore_ks):
+    """
+    以 float 索引的結果為基準，回傳每個 rescore_k 的
+    (答案一致率, 候選文件分數的平均絕對誤差, 每題平均毫秒數)
+    queries: [(query_embedding, category, source_id)]
+    """
+    exact = [index.embedding_index.score(query_embedding, category, source_id)
+             for query_embedding, category, source_id in queries]
+    results = []
+    for rescore_k in rescore_ks:
+        index.rescore_k = rescore_k
+        agree = []
+        errors = []
+        elapsed = 0
+        for (query_embedding, category, source_id), exact_score in zip(queries, exact):
+            start = time.perf_counter()
+            score = index.score(query_embedding, category, source_id)
+            elapsed += time.perf_counter() - start
+            agree.append(int(np.argmax(score)) == int(np.argmax(exact_score)))
+            errors.append(np.abs(np.asarray(score) - np.asarray(exact_score)).mean())
+        results.append((rescore_k, float(np.mean(agree)), float(np.mean(errors)),
+                        elapsed / max(len(queries), 1) * 1000))
+    return results
+
+
+def float_ms_per_query(embedding_index, queries):
+    start = time.perf_counter()
+    for query_embedding, category, source_id in queries:
+        embedding_index.score(query_embedding, category, source_id)
+    return (time.perf_counter() - start) / max(len(queries), 1) * 1000
+
+
+if __name__ == "__main__":
+    from retrieval import BiEncorderRetriever, add_chunking_arguments, build_chunker, paragraph_settings
+
+    parser = argparse.ArgumentParser(
+        description='Report memory savings and accuracy of quantized embeddings against the float index.')
+    parser.add_argument('--index_dir', type=str,
+                        required=True, help='索引路徑（由 build_index.py 產生）')
+    parser.add_argument('--strategy', type=str, default='biencoder', choices=['biencoder', 'flag'],
+                        help='索引所屬的檢索策略')
+    parser.add_argument('--model_name', type=str, required=True,
+                        help='編碼問題的模型名稱，需與建立索引時相同')
+    parser.add_argument('--quantize', type=str, nargs='+', default=['int8', 'pq'], choices=list(QUANTIZERS),
+                        help='要比較的量化方式')
+    parser.add_argument('--question_path', type=str, default=None,
+                        help='以題目與其候選文件作為查詢；未指定時隨機取段落向量作為查詢')
+    parser.add_argument('--num_queries', type=int, default=200,
+                        help='未指定題目時的查詢數')
+    parser.add_argument('--num_candidates', type=int, default=20,
+                        help='未指定題目時每題從同類別隨機抽取的候選文件數')
+    parser.add_argument('--rescore_k', type=int, nargs='+', default=[0, 8, 32, 128],
+                        help='要比較的 float 重算段落數')
+    add_chunking_arguments(parser)
+
+    args = parser.parse_args()
+
+    _, length, overlap = paragraph_settings(build_chunker(args))
+    embedding_index = EmbeddingIndex.load(args.index_dir, args.model_name, length, overlap,
+                                          name=args.strategy)
+    if embedding_index is None:
+        parser.error("段落向量索引不存在或已失效，請先執行 build_index.py")
+
+    if args.question_path:
+        with open(args.question_path, 'r', encoding='utf-8') as f:
+            questions = [question for question in json.load(f).get("questions", []) if question.get("source")]
+        framework = 'flag' if args.strategy == 'flag' else 'sentence-transformers'
+        encoder = BiEncorderRetriever(args.model_name, framework=framework)
+        query_embeddings = encoder._encode([question["query"] for question in questions])
+        queries = [(query_embedding, question["category"], question["source"])
+                   for query_embedding, question in zip(query_embeddings, questions)]
+    else:
+        rng = random.Random(0)
+        docs = [(category, id) for category, table in embedding_index.table.items()
+                for id, (start, end) in table.items() if end > start]
+        queries = []
+        for category, id in rng.sample(docs, min(args.num_queries, len(docs))):
+            start, end = embedding_index.table[category][id]
+            others = [other for other in embedding_index.table[category] if other != id]
+            source_id = rng.sample(others, min(args.num_candidates - 1, len(others))) + [id]
+            rng.shuffle(source_id)
+            queries.append((np.asarray(embedding_index.matrix[rng.randrange(start, end)], dtype=np.float32),
+                            category, source_id))
+
+    print(f"rows: {len(embedding_index.matrix)}  dim: {embedding_index.matrix.shape[1]}  "
+          f"queries: {len(queries)}  float ms/query: {float_ms_per_query(embedding_index, queries):.3f}")
+    for kind in args.quantize:
+        index = QuantizedIndex.load(args.index_dir, embedding_index, kind, name=args.strategy)
+        if index is None:
+            continue
+        memory = index.memory_report()
+        print(f"\n{kind}: {memory['quantized_bytes'] / 2**20:.2f} MiB resident "
+              f"(float32 {memory['float32_bytes'] / 2**20:.2f} MiB, "
+              f"stored {memory['stored_float_bytes'] / 2**20:.2f} MiB, "
+              f"{memory['compression_vs_float32']:.1f}x smaller)")
+        print(f"{'rescore_k':>10}{'agreement':>12}{'score MAE':>12}{'ms/query':>12}")
+        for rescore_k, agreement, error, ms in compare_with_float(index, queries, args.rescore_k):
+            print(f"{rescore_k:>10}{agreement:>12.4f}{error:>12.5f}{ms:>12.3f}")
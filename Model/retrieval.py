@@ -1,16 +1,103 @@
+import time
+_IMPORT_START = time.perf_counter()
+
 import argparse
+import hashlib
 import json
 import os
+import tempfile
 from abc import ABC, abstractmethod
 
 import jieba  # 用於中文文本分詞
+import numpy as np
 from tqdm import tqdm
 from rank_bm25 import BM25Okapi  # 使用BM25演算法進行文件檢索
-from sentence_transformers import SentenceTransformer
-from FlagEmbedding import FlagModel
-from FlagEmbedding import FlagReranker
 
-from data_interface import MyDataset
+from data_interface import MyDataset, corpus_fingerprint
+from pipeline import run_pipeline
+from sharding import remove_checkpoints, run_sharded
+from bm25_index import BM25Index
+from embedding_index import EmbeddingIndex
+from ann_index import IVFIndex
+from quantized_index import QuantizedIndex
+from multivector_index import MultiVectorIndex, maxsim
+from dedup_index import DedupIndex
+from faq_index import FAQPairIndex
+from chunking import TokenChunker
+from score_cache import ScoreCache
+from model_registry import load_model
+from instrumentation import instrumented, metrics, startup
+
+# 模型框架（torch、sentence_transformers、FlagEmbedding）在建立策略時才由 model_registry 匯入
+startup.add('import retrieval modules', time.perf_counter() - _IMPORT_START)
+
+# 段落切分的長度與重疊字數，建立索引時也使用相同設定
+PARAGRAPH_LENGTH = 450
+PARAGRAPH_OVERLAP = 100
+JIEBA_CACHE_VERSION = 1
+
+
+@instrumented('chunking')
+def split_by_length_with_overlap(text, length=100, overlap=20):
+    """
+    將文本按照指定的長度和重疊進行分割
+    """
+    paragraphs = []
+    i = 0
+    while i < len(text):
+        paragraphs.append(text[i:i+length])
+        i += length - overlap
+    metrics.count('paragraphs', len(paragraphs))
+    return paragraphs
+
+
+def initialize_jieba(cache_dir=None):
+    """
+    載入 jieba 詞典。jieba 內建的 marshal 快取每次啟動需要約 1 秒，
+    改將詞頻表存成 npz（以換行相接的詞與詞頻陣列），之後只需切開字串並建立 dict；
+    詞典檔或 jieba 版本不同時改用 jieba 原本的載入方式並重新建立
+    """
+    tokenizer = jieba.dt
+    if tokenizer.initialized:
+        return
+    dict_path = os.path.abspath(tokenizer.dictionary or os.path.join(os.path.dirname(jieba.__file__), 'dict.txt'))
+    stat = os.stat(dict_path)
+    signature = f"{JIEBA_CACHE_VERSION}:{jieba.__version__}:{dict_path}:{stat.st_size}:{stat.st_mtime_ns}"
+    cache_path = os.path.join(cache_dir or tempfile.gettempdir(), 'jieba_freq.npz')
+
+    if os.path.isfile(cache_path):
+        try:
+            with np.load(cache_path) as arrays:
+                if str(arrays["signature"]) == signature:
+                    words = arrays["words"].tobytes().decode('utf-8').split('\n')
+                    freq = dict(zip(words, arrays["freq"].tolist()))
+                    with tokenizer.lock:
+                        tokenizer.FREQ, tokenizer.total = freq, int(arrays["total"])
+                        tokenizer.initialized = True
+                    return
+        except (OSError, ValueError, KeyError):
+            pass
+
+    jieba.initialize()
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = cache_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, signature=np.array(signature),
+                     words=np.frombuffer('\n'.join(tokenizer.FREQ).encode('utf-8'), dtype=np.uint8),
+                     freq=np.fromiter(tokenizer.FREQ.values(), dtype=np.int64, count=len(tokenizer.FREQ)),
+                     total=np.array(tokenizer.total, dtype=np.int64))
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"Warning: Failed to save jieba dictionary cache '{cache_path}': {e}")
+
+
+@instrumented('tokenization')
+def tokenize(text):
+    """
+    以 jieba 搜尋引擎模式斷詞
+    """
+    return list(jieba.cut_for_search(text))
 
 
 class RetrievalStrategy(ABC):
@@ -18,97 +105,439 @@ class RetrievalStrategy(ABC):
     def retrieve(self, query, source_id, source_context):
         pass
 
+    def score_documents(self, query, paragraphs_list):
+        """
+        計算每份文件段落的最高分，沒有段落的文件為 0
+        """
+        return [self.score(query, paragraphs) if paragraphs else 0
+                for paragraphs in paragraphs_list]
+
+    def score_pairs(self, pairs):
+        """
+        計算每個 (query, paragraph) 配對的分數，用於跨問題批次計算；
+        分數會受其他配對影響的策略（如 BM25）回傳 None
+        """
+        return None
+
+    def score_sources(self, query, category, source_id, by_paragraph=True):
+        """
+        若策略有預先建立的索引，直接以文件 id 計算每份文件的分數；
+        否則回傳 None，由呼叫端讀取文字後計算
+        """
+        return None
+
+    def search(self, query, category=None, k=1):
+        """
+        不指定候選文件，在整個語料中檢索前 k 份文件 [(category, id, score)]；
+        需要近似最近鄰索引，沒有時回傳 None
+        """
+        return None
+
+    def can_search(self):
+        """ 是否有近似最近鄰索引，可以處理沒有候選清單的題目 """
+        return False
+
 
 class BM25Retriever(RetrievalStrategy):
-    def __init__(self):
-        pass
+    def __init__(self, index=None, paragraph_index=None):
+        self.index = index
+        self.paragraph_index = paragraph_index
 
     def retrieve(self, query, source_id, source_context):
-        tokenized_corpus = [list(jieba.cut_for_search(doc))
+        tokenized_corpus = [tokenize(doc)
                             for doc in source_context]
         bm25 = BM25Okapi(tokenized_corpus)
-        tokenized_query = list(jieba.cut_for_search(query))
+        tokenized_query = tokenize(query)
         docs = bm25.get_top_n(tokenized_query, list(source_context), n=1)
         ans_id = source_id[source_context.index(docs[0])]
         return ans_id
 
+    def score(self, query, source_context):
+        return max(self.score_documents(query, [source_context]))
+
+    @instrumented('bm25.score')
+    def score_paragraphs(self, query, paragraphs):
+        """ 以所有段落建立一個 BM25，回傳每個段落的分數 """
+        if not paragraphs:
+            return []
+        bm25 = BM25Okapi([tokenize(paragraph) for paragraph in paragraphs])
+        return bm25.get_scores(tokenize(query))
+
+    def score_documents(self, query, paragraphs_list):
+        # 所有候選文件的段落共用一個 BM25，分數才能跨文件比較
+        paragraphs = [paragraph for paragraphs in paragraphs_list for paragraph in paragraphs]
+        if not paragraphs:
+            return [0] * len(paragraphs_list)
+        paragraph_score = self.score_paragraphs(query, paragraphs)
+
+        scores = []
+        i = 0
+        for doc_paragraphs in paragraphs_list:
+            n = len(doc_paragraphs)
+            scores.append(float(paragraph_score[i:i + n].max()) if n else 0)
+            i += n
+        return scores
+
+    def score_sources(self, query, category, source_id, by_paragraph=True):
+        index = self.paragraph_index if by_paragraph else self.index
+        if index is None:
+            return None
+        return self._index_score(index, query, category, source_id)
+
+    @instrumented('bm25.index_score')
+    def _index_score(self, index, query, category, source_id):
+        return index.score(tokenize(query), category, source_id)
+
 
 class BiEncorderRetriever(RetrievalStrategy):
-    def __init__(self, model_name, framework='sentence-transformers'):
-        if framework == 'sentence-transformers':
-            self.model = SentenceTransformer(model_name, trust_remote_code=True)
-        elif framework == 'flag':
-            self.model = FlagModel(model_name,
-                                   query_instruction_for_retrieval="为这个句子生成表示以用于检索相关文章：",
-                                   use_fp16=True)
+    def __init__(self, model_name, framework='sentence-transformers', index=None, model=None,
+                 ann=None, nprobe=8, model_cache_dir=None):
+        self.index = index
+        self.ann = ann
+        self.nprobe = nprobe
+        # model 可直接傳入外部建立的編碼器（需提供 encode），例如 benchmark 的 stub
+        self.model = model if model is not None else load_model(framework, model_name, model_cache_dir)
 
     def retrieve(self, query, source_id, source_context):
-        embedding = self.model.encode(
-            source_context, normalize_embeddings=True)
-        query_embedding = self.model.encode(
-            query, normalize_embeddings=True)
+        embedding = self._encode(source_context)
+        query_embedding = self._encode(query)
         similarity = (embedding @ query_embedding.T).squeeze()
         ans_id = source_id[similarity.argmax()]
         return ans_id
 
     def score(self, query, source_context):
-        embedding = self.model.encode(
-            source_context, normalize_embeddings=True)
-        query_embedding = self.model.encode(
-            query, normalize_embeddings=True)
+        embedding = self._encode(source_context)
+        query_embedding = self._encode(query)
         similarity = (embedding @ query_embedding.T)
         return max(similarity)
 
+    def score_pairs(self, pairs):
+        # 相同的問題與段落只編碼一次
+        queries = list(dict.fromkeys(query for query, _ in pairs))
+        paragraphs = list(dict.fromkeys(paragraph for _, paragraph in pairs))
+        query_embedding = self._encode(queries)
+        embedding = self._encode(paragraphs)
+        query_row = {query: i for i, query in enumerate(queries)}
+        paragraph_row = {paragraph: i for i, paragraph in enumerate(paragraphs)}
+        return [float(embedding[paragraph_row[paragraph]] @ query_embedding[query_row[query]])
+                for query, paragraph in pairs]
+
+    def score_sources(self, query, category, source_id, by_paragraph=True):
+        if self.index is None or not by_paragraph:
+            return None
+        query_embedding = self._encode(query)
+        return self._index_score(query_embedding, category, source_id)
+
+    def search(self, query, category=None, k=1):
+        if self.ann is None:
+            return None
+        return self._ann_search(self._encode(query), category, k)
+
+    def can_search(self):
+        return self.ann is not None
+
+    @instrumented('biencoder.ann_search')
+    def _ann_search(self, query_embedding, category, k):
+        return self.ann.search(query_embedding, k, self.nprobe, category)
+
+    @instrumented('biencoder.index_score')
+    def _index_score(self, query_embedding, category, source_id):
+        return self.index.score(query_embedding, category, source_id)
+
+    @instrumented('biencoder.encode')
+    def _encode(self, texts):
+        if metrics.enabled:
+            metrics.count('characters_encoded', len(texts) if isinstance(texts, str) else sum(map(len, texts)))
+        return self.model.encode(texts, normalize_embeddings=True)
+
 
 class RerankRetriever(RetrievalStrategy):
-    def __init__(self, model_name):
-        self.reranker = FlagReranker(model_name, use_fp16=True)
+    def __init__(self, model_name, batch_size=256, reranker=None, model_cache_dir=None):
+        # reranker 可直接傳入外部建立的物件（需提供 compute_score），例如 benchmark 的 stub
+        self.reranker = reranker if reranker is not None else load_model('flag-reranker', model_name,
+                                                                           model_cache_dir)
+        self.batch_size = batch_size
 
     def retrieve(self, query, source_id, source_context):
         query_doc_pairs = [[query, doc] for doc in source_context]
-        score = self.reranker.compute_score(query_doc_pairs, normalize=True)
+        score = self._compute_score(query_doc_pairs)
         ans_id = source_id[score.index(max(score))]
         return ans_id
 
     def score(self, query, source_context):
         query_doc_pairs = [[query, doc] for doc in source_context]
-        score = self.reranker.compute_score(query_doc_pairs, normalize=True)
+        score = self._compute_score(query_doc_pairs)
         return max(score)
 
+    def score_pairs(self, pairs):
+        # 以內容雜湊去除重複的配對
+        unique_pairs = {}
+        pair_keys = []
+        for query, paragraph in pairs:
+            key = hashlib.sha1(f"{query}\0{paragraph}".encode('utf-8')).digest()
+            unique_pairs.setdefault(key, [query, paragraph])
+            pair_keys.append(key)
+
+        # 依長度排序，讓同一批的長度相近以減少 padding
+        keys = sorted(unique_pairs, key=lambda key: len(unique_pairs[key][0]) + len(unique_pairs[key][1]))
+        score = self._compute_score([unique_pairs[key] for key in keys])
+        key_score = dict(zip(keys, score))
+        return [key_score[key] for key in pair_keys]
+
+    @instrumented('reranker.compute_score')
+    def _compute_score(self, pairs):
+        if metrics.enabled:
+            metrics.count('pairs_scored', len(pairs))
+            metrics.count('characters_encoded', sum(len(query) + len(doc) for query, doc in pairs))
+        # 只有一個配對時 compute_score 會回傳單一數值
+        score = self.reranker.compute_score(pairs, batch_size=self.batch_size, normalize=True)
+        if not isinstance(score, list):
+            score = [score]
+        return score
+
+
+class MultiVectorRetriever(RetrievalStrategy):
+    """
+    bge-m3 的多向量（ColBERT MaxSim）計分：問題與段落各自編碼成 token 向量，
+    段落分數為問題每個 token 與段落最相似 token 的相似度平均；
+    與 cross-encoder 不同，段落向量與問題無關，可由索引預先計算，每題只需編碼一次問題
+    """
+    def __init__(self, model_name, batch_size=256, index=None, model=None, model_cache_dir=None):
+        self.index = index
+        self.batch_size = batch_size
+        # model 可直接傳入外部建立的編碼器（需提供與 BGEM3FlagModel 相同的 encode），例如 benchmark 的 stub
+        self.model = model if model is not None else load_model('flag-m3', model_name, model_cache_dir)
+
+    def retrieve(self, query, source_id, source_context):
+        score = self.score_pairs([(query, doc) for doc in source_context])
+        return source_id[score.index(max(score))]
+
+    def score(self, query, source_context):
+        return max(self.score_pairs([(query, paragraph) for paragraph in source_context]))
+
+    def score_pairs(self, pairs):
+        """
+        相同的問題與段落只編碼一次；段落每 batch_size 個為一組編碼後即計算所有相關問題的 MaxSim，
+        計算完就釋放該組的 token 向量，整個題目檔一起計算時記憶體也只需保留一組
+        """
+        queries = list(dict.fromkeys(query for query, _ in pairs))
+        query_vectors = dict(zip(queries, self._encode(queries)))
+        paragraph_pairs = {}
+        for i, (_, paragraph) in enumerate(pairs):
+            paragraph_pairs.setdefault(paragraph, []).append(i)
+        paragraphs = list(paragraph_pairs)
+
+        scores = [0.0] * len(pairs)
+        for start in range(0, len(paragraphs), self.batch_size):
+            chunk = paragraphs[start:start + self.batch_size]
+            paragraph_vectors = self._encode(chunk)
+            offsets = np.zeros(len(chunk) + 1, dtype=np.int64)
+            np.cumsum([len(vectors) for vectors in paragraph_vectors], out=offsets[1:])
+            tokens = np.concatenate(paragraph_vectors).astype(np.float32, copy=False)
+            del paragraph_vectors
+
+            # 問題 -> (配對位置, 段落在這一組中的位置)
+            query_rows = {}
+            for row, paragraph in enumerate(chunk):
+                for i in paragraph_pairs[paragraph]:
+                    indices, rows = query_rows.setdefault(pairs[i][0], ([], []))
+                    indices.append(i)
+                    rows.append(row)
+            for query, (indices, rows) in query_rows.items():
+                query_score = self._maxsim(query_vectors[query], tokens,
+                                           [(offsets[row], offsets[row + 1]) for row in rows])
+                for i, score in zip(indices, query_score):
+                    scores[i] = float(score)
+            del tokens
+        return scores
+
+    def score_sources(self, query, category, source_id, by_paragraph=True):
+        if self.index is None or not by_paragraph:
+            return None
+        return self._index_score(self._encode([query])[0], category, source_id)
+
+    @instrumented('multivector.maxsim')
+    def _maxsim(self, query_vectors, tokens, ranges):
+        return maxsim(query_vectors, tokens, ranges)
+
+    @instrumented('multivector.index_score')
+    def _index_score(self, query_vectors, category, source_id):
+        return self.index.score(query_vectors, category, source_id)
+
+    @instrumented('multivector.encode')
+    def _encode(self, texts):
+        """ 回傳每個字串的 token 向量矩陣 (token 數, 維度) """
+        if metrics.enabled:
+            metrics.count('characters_encoded', sum(map(len, texts)))
+        output = self.model.encode(texts, batch_size=self.batch_size, return_dense=False,
+                                   return_sparse=False, return_colbert_vecs=True)
+        return [np.asarray(vectors, dtype=np.float32) for vectors in output["colbert_vecs"]]
+
+
+class CascadeRetriever(RetrievalStrategy):
+    """
+    逐層篩選段落：BM25 保留前 bm25_k 段，再以 bi-encoder 保留前 biencoder_k 段，
+    只有最後留下的段落交給 reranker 計算，未留下段落的文件分數為 0
+    """
+    def __init__(self, bm25: BM25Retriever, biencoder: RetrievalStrategy, reranker: RetrievalStrategy,
+                 bm25_k=50, biencoder_k=10):
+        self.bm25 = bm25
+        self.biencoder = biencoder
+        self.reranker = reranker
+        self.bm25_k = bm25_k
+        self.biencoder_k = biencoder_k
+        self.stats = {"pairs": 0, "bm25_pruned": 0, "biencoder_pruned": 0, "reranked": 0}
+
+    def retrieve(self, query, source_id, source_context):
+        score = self.score_documents(query, [[doc] if doc else [] for doc in source_context])
+        return source_id[score.index(max(score))]
+
+    def score(self, query, source_context):
+        return max(self.score_documents(query, [source_context]))
+
+    def score_documents(self, query, paragraphs_list):
+        candidates = [(doc, paragraph) for doc, paragraphs in enumerate(paragraphs_list)
+                      for paragraph in paragraphs]
+        self.stats["pairs"] += len(candidates)
+
+        bm25_score = self.bm25.score_paragraphs(query, [paragraph for _, paragraph in candidates])
+        candidates = self._top_k(candidates, bm25_score, self.bm25_k, "bm25_pruned")
+        if candidates:
+            biencoder_score = self.biencoder.score_pairs([(query, paragraph) for _, paragraph in candidates])
+            candidates = self._top_k(candidates, biencoder_score, self.biencoder_k, "biencoder_pruned")
+
+        scores = [0] * len(paragraphs_list)
+        if candidates:
+            self.stats["reranked"] += len(candidates)
+            rerank_score = self.reranker.score_pairs([(query, paragraph) for _, paragraph in candidates])
+            for (doc, _), score in zip(candidates, rerank_score):
+                scores[doc] = max(scores[doc], score)
+        return scores
+
+    def report(self):
+        """ 回傳各層刪去的配對數 """
+        return (f"Cascade: {self.stats['pairs']} pairs, "
+                f"BM25 pruned {self.stats['bm25_pruned']}, "
+                f"bi-encoder pruned {self.stats['biencoder_pruned']}, "
+                f"reranked {self.stats['reranked']}")
+
+    def _top_k(self, candidates, score, k, stat):
+        if len(candidates) <= k:
+            return candidates
+        order = sorted(range(len(candidates)), key=lambda i: score[i], reverse=True)[:k]
+        self.stats[stat] += len(candidates) - k
+        metrics.count(f"cascade_{stat}", len(candidates) - k)
+        return [candidates[i] for i in sorted(order)]
+
+
+class CachedRetriever(RetrievalStrategy):
+    """
+    在其他策略外加上持久化的分數快取，先查快取，未命中的配對再交給原策略計算並寫回
+    分數會受其他段落影響的策略（如 BM25）不快取
+    """
+    def __init__(self, strategy: RetrievalStrategy, cache: ScoreCache, model_name):
+        self.strategy = strategy
+        self.cache = cache
+        self.model_name = model_name
+
+    def retrieve(self, query, source_id, source_context):
+        return self.strategy.retrieve(query, source_id, source_context)
+
+    def score(self, query, source_context):
+        return max(self.score_pairs([(query, paragraph) for paragraph in source_context]))
+
+    def score_documents(self, query, paragraphs_list):
+        pair_score = self.score_pairs([(query, paragraph)
+                                       for paragraphs in paragraphs_list for paragraph in paragraphs])
+        if pair_score is None:
+            return self.strategy.score_documents(query, paragraphs_list)
+        scores = []
+        i = 0
+        for paragraphs in paragraphs_list:
+            n = len(paragraphs)
+            scores.append(max(pair_score[i:i + n]) if n else 0)
+            i += n
+        return scores
+
+    def score_pairs(self, pairs):
+        keys = [ScoreCache.key(query, paragraph) for query, paragraph in pairs]
+        key_score = self.cache.get_many(self.model_name, keys)
+        metrics.count('score_cache_hits', len(key_score))
+
+        missing = {}
+        for key, pair in zip(keys, pairs):
+            if key not in key_score:
+                missing.setdefault(key, pair)
+        metrics.count('score_cache_misses', len(missing))
+        if missing:
+            missing_score = self.strategy.score_pairs(list(missing.values()))
+            if missing_score is None:
+                return None
+            new_items = list(zip(missing, missing_score))
+            self.cache.put_many(self.model_name, new_items)
+            key_score.update(new_items)
+        return [key_score[key] for key in keys]
+
+    def score_sources(self, query, category, source_id, by_paragraph=True):
+        return self.strategy.score_sources(query, category, source_id, by_paragraph)
+
+    def search(self, query, category=None, k=1):
+        return self.strategy.search(query, category, k)
+
+    def can_search(self):
+        return self.strategy.can_search()
+
 
 class Retriever:
-    def __init__(self, strategy: RetrievalStrategy):
+    def __init__(self, strategy: RetrievalStrategy, chunker: TokenChunker = None,
+                 paragraph_length=PARAGRAPH_LENGTH, paragraph_overlap=PARAGRAPH_OVERLAP,
+                 summary_threshold=0.9, dedup: DedupIndex = None, faq_index: FAQPairIndex = None):
         self.strategy = strategy
+        # 未指定 chunker 時以字數切段
+        self.chunker = chunker
+        # 重複段落的對應表，指定時重複的段落每題只計算一次
+        self.dedup = dedup
+        # FAQ 問答配對索引，指定時 FAQ 題目改以問題向量（或 BM25）查表
+        self.faq_index = faq_index
+        self.paragraph_length = paragraph_length
+        self.paragraph_overlap = paragraph_overlap
+        # 分數不低於此值的文件超過一份時，改以 summary 決定答案
+        self.summary_threshold = summary_threshold
 
+    @instrumented('question.retrieve')
     def retrieve(self, sample):
+        metrics.count('questions')
+        if not sample.get("source"):
+            return self.search(sample)
+        if self._use_faq_index(sample):
+            source_score = self._score_faq(sample)
+            return sample["source"][source_score.index(max(source_score))]
+        source_score = self.strategy.score_sources(
+            sample["query"], sample["category"], sample["source"], by_paragraph=False)
+        if source_score is not None:
+            return sample["source"][source_score.index(max(source_score))]
         return self.strategy.retrieve(sample["query"], sample["source"], sample["source_context"])
 
+    @instrumented('question.retrieve_by_paragraph')
     def retrieve_by_paragraph(self, sample):
-        source_context_score = []
-        for context in sample["source_context"]:
-            if context == '':
-                source_context_score.append(0)
-                continue
-            paragraphs = self._split_by_length_with_overlap(context, 450, 100)
-            score = self.strategy.score(
-                sample["query"], paragraphs)
-            source_context_score.append(score)
+        metrics.count('questions')
+        if not sample.get("source"):
+            return self.search(sample)
+        source_context_score = self._score_source_context(sample)
         return sample["source"][source_context_score.index(max(source_context_score))]
     
+    @instrumented('question.retrieve_by_paragraph_with_summary')
     def retrieve_by_paragraph_with_summary(self, sample):
-        source_context_score = []
-        for context in sample["source_context"]:
-            if context == '':
-                source_context_score.append(0)
-                continue
-            paragraphs = self._split_by_length_with_overlap(context, 450, 100)
-            score = self.strategy.score(
-                sample["query"], paragraphs)
-            source_context_score.append(score)
+        metrics.count('questions')
+        if not sample.get("source"):
+            return self.search(sample)
+        return self._rerank_with_summary(sample, self._score_source_context(sample))
+
+    def _rerank_with_summary(self, sample, source_context_score):
         cnt_score_over = 0
         index_list = []
         for i, score in enumerate(source_context_score):
-            if score >= 0.9:
+            if score >= self.summary_threshold:
                 cnt_score_over += 1
                 index_list.append((i, sample["source"][i]))
         summary_score = []
@@ -124,13 +553,320 @@ class Retriever:
             return max_tumple[0]
         return sample["source"][source_context_score.index(max(source_context_score))]
 
-    def _split_by_length_with_overlap(self, text, length=100, overlap=20):
-        paragraphs = []
+    @instrumented('question_batch.retrieve_by_paragraph')
+    def retrieve_by_paragraph_batch(self, samples):
+        """
+        收集所有問題的 (query, paragraph) 配對一次計算分數，
+        再取每份文件的段落最高分，結果與逐題 retrieve_by_paragraph 相同
+        """
+        pairs = []
+        distinct_pairs = set()
+        paragraph_counts = []
+        index_score = {}
+        for i, sample in enumerate(samples):
+            if not sample.get("source"):
+                paragraph_counts.append([])
+                continue
+            if self._use_faq_index(sample):
+                index_score[i] = self._score_faq(sample)
+                paragraph_counts.append([])
+                continue
+            source_score = self.strategy.score_sources(
+                sample["query"], sample["category"], sample["source"])
+            if source_score is not None:
+                index_score[i] = source_score
+                paragraph_counts.append([])
+                continue
+            counts = []
+            paragraphs_list = self._source_paragraphs(sample)
+            if self.dedup is not None:
+                distinct_pairs.update((sample["query"], p) for paragraphs in paragraphs_list for p in paragraphs)
+            for paragraphs in self._canonical_paragraphs(paragraphs_list):
+                pairs.extend((sample["query"], paragraph) for paragraph in paragraphs)
+                counts.append(len(paragraphs))
+            paragraph_counts.append(counts)
+
+        pair_score = self.strategy.score_pairs(pairs) if pairs else []
+        if pair_score is None:
+            return [self.retrieve_by_paragraph(sample) for sample in samples]
+        if self.dedup is not None:
+            self._record_dedup(len(pairs), len(distinct_pairs), len(set(pairs)))
+        metrics.count('questions', len(samples))
+
+        answers = []
         i = 0
-        while i < len(text):
-            paragraphs.append(text[i:i+length])
-            i += length - overlap
-        return paragraphs
+        for j, (sample, counts) in enumerate(zip(samples, paragraph_counts)):
+            if not sample.get("source"):
+                answers.append(self.search(sample))
+                continue
+            source_context_score = index_score.get(j, [])
+            for n in counts:
+                source_context_score.append(max(pair_score[i:i + n]) if n else 0)
+                i += n
+            answers.append(sample["source"][source_context_score.index(max(source_context_score))])
+        return answers
+
+    @instrumented('question.search')
+    def search(self, sample):
+        """ 沒有候選清單的題目：以近似最近鄰索引在整個語料（或指定的 category）中檢索 """
+        results = self.strategy.search(sample["query"], sample.get("category"), k=1)
+        if results is None:
+            raise ValueError(f"qid {sample.get('qid')} has no source candidates; open-candidate retrieval "
+                             f"needs --strategy biencoder/flag with an ANN index in --index_dir.")
+        if not results:
+            return None
+        _, id, _ = results[0]
+        return int(id) if id.isdigit() else id
+
+    def _score_source_context(self, sample):
+        """ 計算每份候選文件的段落最高分，有索引時直接查索引 """
+        if self._use_faq_index(sample):
+            return self._score_faq(sample)
+        source_context_score = self.strategy.score_sources(
+            sample["query"], sample["category"], sample["source"])
+        if source_context_score is not None:
+            return source_context_score
+
+        paragraphs_list = self._source_paragraphs(sample)
+        if self.dedup is not None:
+            source_context_score = self._score_deduplicated(sample["query"], paragraphs_list)
+            if source_context_score is not None:
+                return source_context_score
+        return self.strategy.score_documents(sample["query"], paragraphs_list)
+
+    def _use_faq_index(self, sample):
+        return self.faq_index is not None and sample.get("category") == 'faq'
+
+    @instrumented('question.faq_index')
+    def _score_faq(self, sample):
+        """ 每個候選 FAQ id 取其問答配對中問題的最高分 """
+        metrics.count('faq_index_questions')
+        return self.faq_index.score(sample["query"], sample["source"])
+
+    def _score_deduplicated(self, query, paragraphs_list):
+        """
+        將重複的段落換成代表段落，每個代表段落只計算一次分數，再分給所有包含它的文件；
+        分數會受其他段落影響的策略（如 BM25）回傳 None
+        """
+        canonical_list = self._canonical_paragraphs(paragraphs_list)
+        paragraphs = list(dict.fromkeys(paragraph for paragraphs in canonical_list for paragraph in paragraphs))
+        score = self.strategy.score_pairs([(query, paragraph) for paragraph in paragraphs]) if paragraphs else []
+        if score is None:
+            return None
+        distinct = len({paragraph for paragraphs in paragraphs_list for paragraph in paragraphs})
+        self._record_dedup(sum(map(len, paragraphs_list)), distinct, len(paragraphs))
+        paragraph_score = dict(zip(paragraphs, score))
+        return [max(paragraph_score[paragraph] for paragraph in paragraphs) if paragraphs else 0
+                for paragraphs in canonical_list]
+
+    def _canonical_paragraphs(self, paragraphs_list):
+        if self.dedup is None:
+            return paragraphs_list
+        return [[self.dedup.canonical(paragraph) for paragraph in paragraphs] for paragraphs in paragraphs_list]
+
+    def _record_dedup(self, paragraphs, distinct, scored):
+        self.dedup.record(paragraphs, distinct, scored)
+        metrics.count('dedup_paragraphs_saved', distinct - scored)
+
+    def prepare(self, sample):
+        """
+        預先切好段落存入 sample，讓切段可以在模型計算之外的執行緒進行
+        token 切段只存段落在原文中的範圍，計分組成配對時才取出文字，等待計算的題目不需保留段落字串
+        """
+        if self.chunker is not None:
+            sample["source_spans"] = [self.chunker.spans(context) for context in sample["source_context"]]
+        else:
+            sample["source_paragraphs"] = self._source_paragraphs(sample)
+        return sample
+
+    def _source_paragraphs(self, sample):
+        if "source_paragraphs" in sample:
+            return sample["source_paragraphs"]
+        if self.chunker is not None:
+            spans_list = sample.get("source_spans") or [self.chunker.spans(context)
+                                                        for context in sample["source_context"]]
+            return [[context[span.start:span.end] for span in spans]
+                    for context, spans in zip(sample["source_context"], spans_list)]
+        return [self._split_by_length_with_overlap(context, self.paragraph_length, self.paragraph_overlap)
+                for context in sample["source_context"]]
+
+    def _split_by_length_with_overlap(self, text, length=100, overlap=20):
+        return split_by_length_with_overlap(text, length, overlap)
+
+
+def build_retriever(args):
+    """
+    依照命令列參數建立檢索器
+    """
+    chunker = build_chunker(args)
+    _, length, overlap = paragraph_settings(chunker)
+    dedup = None
+    if args.dedup:
+        dedup = DedupIndex.load(args.index_dir, length, overlap, corpus_fingerprint(args.source_dir))
+    if args.strategy in ('bm25', 'cascade'):
+        # jieba 的詞典在第一次斷詞時才載入，先以較快的快取載入並計入啟動時間
+        with startup.stage('load jieba dictionary'):
+            initialize_jieba(args.model_cache_dir)
+    if args.strategy == 'bm25':
+        paragraph_index = None
+        if args.index_dir:
+            paragraph_index = BM25Index.load(args.index_dir, length, overlap,
+                                             name='bm25_paragraph')
+        retriever = Retriever(BM25Retriever(paragraph_index=paragraph_index), chunker=chunker)
+    elif args.strategy in ('biencoder', 'flag'):
+        index = None
+        ann = None
+        if args.index_dir:
+            index = EmbeddingIndex.load(args.index_dir, args.model_name, length, overlap,
+                                        name=args.strategy)
+            if index is not None and IVFIndex.read_meta(args.index_dir, args.strategy) is not None:
+                ann = IVFIndex.load(args.index_dir, index, name=args.strategy)
+            if index is not None and args.quantized:
+                # 候選文件的分數改以量化向量計算，IVF 索引仍使用 float 向量
+                index = QuantizedIndex.load(args.index_dir, index, args.quantized, name=args.strategy,
+                                            rescore_k=args.rescore_k) or index
+        framework = 'flag' if args.strategy == 'flag' else 'sentence-transformers'
+        retriever = Retriever(BiEncorderRetriever(args.model_name, framework=framework, index=index,
+                                                  ann=ann, nprobe=args.ann_nprobe,
+                                                  model_cache_dir=args.model_cache_dir),
+                              chunker=chunker)
+    elif args.strategy == 'multivector':
+        index = None
+        if args.index_dir:
+            index = MultiVectorIndex.load(args.index_dir, args.model_name, length, overlap)
+        retriever = Retriever(MultiVectorRetriever(args.model_name, batch_size=args.batch_size, index=index,
+                                                   model_cache_dir=args.model_cache_dir),
+                              chunker=chunker)
+    elif args.strategy == 'reranker':
+        retriever = Retriever(RerankRetriever(args.model_name, batch_size=args.batch_size,
+                                              model_cache_dir=args.model_cache_dir),
+                              chunker=chunker)
+    elif args.strategy == 'cascade':
+        biencoder = BiEncorderRetriever(args.biencoder_model_name, model_cache_dir=args.model_cache_dir)
+        reranker = RerankRetriever(args.model_name, batch_size=args.batch_size,
+                                   model_cache_dir=args.model_cache_dir)
+        if args.score_cache:
+            cache = ScoreCache(args.score_cache, args.score_cache_size)
+            biencoder = CachedRetriever(biencoder, cache, f"biencoder:{args.biencoder_model_name}")
+            reranker = CachedRetriever(reranker, cache, f"reranker:{args.model_name}")
+        retriever = Retriever(CascadeRetriever(BM25Retriever(), biencoder, reranker,
+                                               bm25_k=args.cascade_bm25_k,
+                                               biencoder_k=args.cascade_biencoder_k),
+                              chunker=chunker)
+
+    if args.faq_pairs:
+        retriever.faq_index = load_faq_index(args, retriever.strategy)
+    if args.score_cache and args.strategy not in ('bm25', 'cascade'):
+        retriever = Retriever(CachedRetriever(retriever.strategy,
+                                              ScoreCache(args.score_cache, args.score_cache_size),
+                                              f"{args.strategy}:{args.model_name}"),
+                              chunker=chunker, faq_index=retriever.faq_index)
+    retriever.dedup = dedup
+    return retriever
+
+
+def load_faq_index(args, strategy):
+    """
+    載入 FAQ 問答配對索引；指定 --faq_model_name 時以問題向量查詢，
+    與 biencoder 策略的模型相同時共用已載入的模型，否則以問題的 BM25 查詢
+    """
+    encode = None
+    if args.faq_model_name:
+        if args.strategy == 'biencoder' and args.faq_model_name == args.model_name:
+            encoder = strategy
+        else:
+            encoder = BiEncorderRetriever(args.faq_model_name, model_cache_dir=args.model_cache_dir)
+        encode = encoder._encode
+    return FAQPairIndex.load(args.index_dir, args.faq_model_name, encode, tokenize)
+
+
+def build_chunker(args):
+    """ --chunking tokens 時依 tokenizer 的 token 數切段，否則回傳 None（以字數切段） """
+    if args.chunking != 'tokens':
+        return None
+    tokenizer_name = args.tokenizer_name or args.model_name
+    if tokenizer_name is None or tokenizer_name == 'chars':
+        return TokenChunker(max_tokens=args.chunk_tokens, overlap_tokens=args.chunk_overlap_tokens)
+    return TokenChunker.from_pretrained(tokenizer_name, max_tokens=args.chunk_tokens,
+                                        overlap_tokens=args.chunk_overlap_tokens)
+
+
+def paragraph_settings(chunker):
+    """
+    回傳 (split, length, overlap)，索引以 length / overlap 判斷建立時的切段方式是否與目前相同
+    """
+    if chunker is None:
+        return split_by_length_with_overlap, PARAGRAPH_LENGTH, PARAGRAPH_OVERLAP
+    return (lambda text, length, overlap: chunker.split(text)), chunker.signature, chunker.overlap_tokens
+
+
+def add_chunking_arguments(parser):
+    parser.add_argument('--chunking', type=str, default='chars', choices=['chars', 'tokens'],
+                        help='切段方式：chars 依字數（450 字、重疊 100 字），tokens 依 tokenizer 的 token 數並盡量在句尾切開')
+    parser.add_argument('--tokenizer_name', type=str, default=None,
+                        help='tokens 切段使用的 tokenizer，預設與 --model_name 相同；為 chars 或皆未指定時以字元計數')
+    parser.add_argument('--chunk_tokens', type=int, default=384,
+                        help='tokens 切段時每段最多的 token 數')
+    parser.add_argument('--chunk_overlap_tokens', type=int, default=64,
+                        help='tokens 切段時相鄰段落重疊的 token 數')
+
+
+def add_retriever_arguments(parser):
+    """
+    加入建立檢索器所需的命令列參數，retrieval.py 與 server.py 共用
+    """
+    parser.add_argument('--strategy', type=str, default='bm25', choices=['bm25', 'biencoder', 'reranker', 'flag', 'cascade', 'multivector'],
+                        help='選擇檢索策略，預設為bm25；multivector 以 bge-m3 的多向量（ColBERT MaxSim）計分')
+    parser.add_argument('--model_name', type=str, default=None,
+                        help='選擇模型名稱，當使用 bm25 以外的策略時需要指定')
+    parser.add_argument('--biencoder_model_name', type=str, default='BAAI/bge-m3',
+                        help='cascade 策略第二層使用的 bi-encoder 模型')
+    parser.add_argument('--cascade_bm25_k', type=int, default=50,
+                        help='cascade 策略中 BM25 每題保留的段落數')
+    parser.add_argument('--cascade_biencoder_k', type=int, default=10,
+                        help='cascade 策略中 bi-encoder 每題保留的段落數（即 reranker 計算的段落數）')
+    parser.add_argument('--batch_size', type=int, default=256,
+                        help='模型每次計算的配對數')
+    parser.add_argument('--score_cache', type=str, default=None,
+                        help='分數快取的 SQLite 檔案路徑，重複執行時沿用已計算的分數')
+    parser.add_argument('--score_cache_size', type=int, default=5_000_000,
+                        help='分數快取最多保留的配對數')
+    parser.add_argument('--index_dir', type=str, default=None,
+                        help='預先建立的索引路徑（由 build_index.py 產生）')
+    parser.add_argument('--model_cache_dir', type=str, default=None,
+                        help='模型 warm cache 路徑，第一次載入後存成 fp16 safetensors，之後直接從本機載入')
+    parser.add_argument('--profile_startup', '--profile-startup', action='store_true',
+                        help='印出匯入模組、載入模型與讀取資料的耗時')
+    parser.add_argument('--ann_nprobe', type=int, default=8,
+                        help='沒有候選清單的題目以 IVF 索引檢索時探查的群數，越大召回率越高、速度越慢')
+    parser.add_argument('--quantized', type=str, default=None, choices=['int8', 'pq'],
+                        help='以量化的段落向量計算候選文件分數（需先以 build_index.py --quantize 建立）')
+    parser.add_argument('--dedup', action='store_true',
+                        help='以 build_index.py --dedup 建立的對應表，將近似重複的段落換成代表段落，每題只計算一次')
+    parser.add_argument('--faq_pairs', action='store_true',
+                        help='FAQ 題目改以 build_index.py --faq_pairs 建立的問答配對索引查詢，每個 FAQ id 取其問題的最高分')
+    parser.add_argument('--faq_model_name', type=str, default=None,
+                        help='FAQ 問答配對索引的問題向量模型，需與建立索引時相同；未指定時以問題的 BM25 查詢')
+    parser.add_argument('--rescore_k', type=int, default=32,
+                        help='使用量化向量時，近似分數最高的幾段再以 float 向量精確重算，0 表示不重算')
+    add_chunking_arguments(parser)
+
+
+def check_retriever_arguments(parser, args):
+    if args.strategy != 'bm25' and not args.model_name:
+        parser.error("當選擇非 'bm25' 策略時，必須指定 --model_name")
+    if args.quantized and (args.strategy not in ('biencoder', 'flag') or not args.index_dir):
+        parser.error("--quantized 需搭配 biencoder / flag 策略與 --index_dir")
+    if args.dedup and not args.index_dir:
+        parser.error("--dedup 需搭配 --index_dir")
+    if args.faq_pairs and not args.index_dir:
+        parser.error("--faq_pairs 需搭配 --index_dir")
+
+
+def get_output_file_name(args):
+    if args.model_name:
+        return 'pred_retrieve.json'
+    return 'bm25.json'
 
 
 if __name__ == "__main__":
@@ -142,41 +878,73 @@ if __name__ == "__main__":
                         required=True, help='讀取參考資料路徑')
     parser.add_argument('--output_dir', type=str,
                         required=True, help='輸出符合參賽格式的答案路徑')
-    parser.add_argument('--strategy', type=str, default='bm25', choices=['bm25', 'biencoder', 'reranker', 'flag'],
-                        help='選擇檢索策略，預設為bm25')
-    parser.add_argument('--model_name', type=str, default=None,
-                        help='選擇模型名稱，當使用 bm25 以外的策略時需要指定')
+    add_retriever_arguments(parser)
     parser.add_argument('--is_use_summary', type=str, default='False',
                         help='是否要使用 Summary 來進行檢索')
+    parser.add_argument('--batch_mode', action='store_true',
+                        help='一次收集所有問題的段落配對，去除重複後批次計算分數')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='以串流管線執行：背景執行緒預先讀檔與切段，模型逐批計算並即時寫出 jsonl')
+    parser.add_argument('--pipeline_threads', type=int, default=4,
+                        help='管線模式下讀檔與切段的執行緒數')
+    parser.add_argument('--prefetch', type=int, default=64,
+                        help='管線模式下最多預先準備的題數')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='以多個行程分片執行，每題完成即寫入檢查點，重新執行時會略過已完成的題目')
+    parser.add_argument('--threads_per_worker', type=int, default=None,
+                        help='分片模式下每個行程的運算執行緒數，預設為 CPU 數除以行程數')
+    parser.add_argument('--metrics_dir', type=str, default=None,
+                        help='記錄各階段耗時與計數，結束時輸出 metrics.json 與 Prometheus 格式的 metrics.prom')
 
     args = parser.parse_args()
 
-    if args.strategy != 'bm25' and not args.model_name:
-        parser.error("當選擇非 'bm25' 策略時，必須指定 --model_name")
-
-    dataset = MyDataset(args.question_path, args.source_dir)
+    check_retriever_arguments(parser, args)
 
-    if args.strategy == 'bm25':
-        retriever = Retriever(BM25Retriever())
-        output_file_name = 'bm25.json'
-    elif args.strategy == 'biencoder':
-        retriever = Retriever(BiEncorderRetriever(args.model_name))
-    elif args.strategy == 'reranker':
-        retriever = Retriever(RerankRetriever(args.model_name))
-    elif args.strategy == 'flag':
-        retriever = Retriever(BiEncorderRetriever(args.model_name, framework='flag'))
+    if args.metrics_dir:
+        os.makedirs(args.metrics_dir, exist_ok=True)
+        metrics.enable()
 
-    if args.model_name:
-        model_name = args.model_name.replace('/', '_').replace('-', '_')
-        output_file_name = f'pred_retrieve.json'
+    output_file_name = get_output_file_name(args)
+    output_path = os.path.join(args.output_dir, output_file_name)
 
     answer_dict = {"answers": []}  # 初始化字典
-    for i in tqdm(range(len(dataset))):
-        sample = dataset.__getitem__(i, args.is_use_summary)
-        ans = retriever.retrieve_by_paragraph(sample)
-        answer_dict["answers"].append({"qid": sample["qid"], "retrieve": ans})
+    if args.workers > 0:
+        answer_dict["answers"] = run_sharded(args, output_path)
+    else:
+        with startup.stage('load dataset'):
+            dataset = MyDataset(args.question_path, args.source_dir)
+        with startup.stage('build retriever'):
+            retriever = build_retriever(args)
+        if args.profile_startup:
+            print(startup.report())
+        if args.pipeline:
+            stream_path = output_path.replace('.json', '.jsonl')
+            answer_dict["answers"] = run_pipeline(dataset, retriever, args.is_use_summary, stream_path,
+                                                  threads=args.pipeline_threads, prefetch=args.prefetch)
+        elif args.batch_mode:
+            samples = [dataset.__getitem__(i, args.is_use_summary) for i in tqdm(range(len(dataset)))]
+            answers = retriever.retrieve_by_paragraph_batch(samples)
+            for sample, ans in zip(samples, answers):
+                answer_dict["answers"].append({"qid": sample["qid"], "retrieve": ans})
+        else:
+            for i in tqdm(range(len(dataset))):
+                sample = dataset.__getitem__(i, args.is_use_summary)
+                ans = retriever.retrieve_by_paragraph(sample)
+                answer_dict["answers"].append({"qid": sample["qid"], "retrieve": ans})
+
+        if isinstance(retriever.strategy, CascadeRetriever):
+            print(retriever.strategy.report())
+        if retriever.dedup is not None:
+            print(retriever.dedup.report())
+        if retriever.chunker is not None and retriever.chunker.lengths:
+            print(retriever.chunker.report(args.batch_size))
 
-    output_path = os.path.join(args.output_dir, output_file_name)
     with open(output_path, 'w', encoding='utf8') as f:
         json.dump(answer_dict, f, ensure_ascii=False,
-                  indent=4)  # 儲存檔案，確保格式和非ASCII字符
\ No newline at end of file
+                  indent=4)  # 儲存檔案，確保格式和非ASCII字符
+    if args.workers > 0:
+        remove_checkpoints(output_path)
+
+    if args.metrics_dir:
+        metrics.export_json(os.path.join(args.metrics_dir, 'metrics.json'))
+        metrics.export_prometheus(os.path.join(args.metrics_dir, 'metrics.prom'))
\ No newline at end of file
@@ -0,0 +1,102 @@
+import atexit
+import hashlib
+import os
+import sqlite3
+import threading
+
+
+class ScoreCache:
+    """
+    以 SQLite 儲存 (模型, 問題, 段落) 的分數
+    key 為問題與段落內容雜湊的串接，超過 max_entries 時淘汰最久未使用的分數
+    讀取時的使用時間先暫存在記憶體，與下一次寫入一起提交，或累積 flush_size 筆、關閉時再寫回
+    連線可在建立以外的執行緒使用（如檢索服務的模型執行緒），所有存取以鎖串行化
+    """
+    def __init__(self, path, max_entries=5_000_000, flush_size=10_000):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.max_entries = max_entries
+        self.flush_size = flush_size
+        # {(model, key): last_used}，尚未寫回的使用時間
+        self.pending = {}
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS scores (
+                model TEXT NOT NULL,
+                key BLOB NOT NULL,
+                score REAL NOT NULL,
+                last_used INTEGER NOT NULL,
+                PRIMARY KEY (model, key)
+            ) WITHOUT ROWID""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS scores_last_used ON scores (last_used)")
+        self.conn.commit()
+        self.size, clock = self.conn.execute(
+            "SELECT COUNT(*), COALESCE(MAX(last_used), 0) FROM scores").fetchone()
+        self.clock = clock
+        atexit.register(self.close)
+
+    @staticmethod
+    def key(query, paragraph):
+        return (hashlib.sha1(query.encode('utf-8')).digest()
+                + hashlib.sha1(paragraph.encode('utf-8')).digest())
+
+    def get_many(self, model, keys, chunk_size=500):
+        """ 回傳 {key: score}，只包含已快取的 key，並更新其使用時間 """
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        with self.lock:
+            for start in range(0, len(keys), chunk_size):
+                chunk = keys[start:start + chunk_size]
+                placeholders = ','.join('?' * len(chunk))
+                found.update(self.conn.execute(
+                    f"SELECT key, score FROM scores WHERE model = ? AND key IN ({placeholders})",
+                    [model, *chunk]))
+            if found:
+                self.clock += 1
+                self.pending.update(((model, key), self.clock) for key in found)
+                if len(self.pending) >= self.flush_size:
+                    self.flush()
+        return found
+
+    def _write_pending(self):
+        """ 將暫存的使用時間寫入目前的交易，由呼叫端提交 """
+        if self.pending:
+            self.conn.executemany("UPDATE scores SET last_used = ? WHERE model = ? AND key = ?",
+                                  [(clock, model, key) for (model, key), clock in self.pending.items()])
+            self.pending.clear()
+
+    def flush(self):
+        with self.lock:
+            self._write_pending()
+            self.conn.commit()
+
+    def put_many(self, model, items):
+        """ 寫入 [(key, score)]，超過容量時淘汰最久未使用的分數；暫存的使用時間在同一次提交寫回 """
+        with self.lock:
+            self._write_pending()
+            self.clock += 1
+            before = self.conn.total_changes
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO scores (model, key, score, last_used) VALUES (?, ?, ?, ?)",
+                [(model, key, float(score), self.clock) for key, score in items])
+            self.size += self.conn.total_changes - before
+            if self.size > self.max_entries:
+                # 多淘汰 10% 避免每次寫入都觸發
+                excess = self.size - int(self.max_entries * 0.9)
+                self.conn.execute(
+                    "DELETE FROM scores WHERE (model, key) IN "
+                    "(SELECT model, key FROM scores ORDER BY last_used LIMIT ?)", (excess,))
+                self.size -= excess
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            if self.conn is None:
+                return
+            self.flush()
+            self.conn.close()
+            self.conn = None
+        atexit.unregister(self.close)
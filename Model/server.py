@@ -0,0 +1,222 @@
+import argparse
+import asyncio
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from data_interface import MyDataset
+from instrumentation import metrics, startup
+from retrieval import add_retriever_arguments, build_retriever, check_retriever_arguments
+
+REQUIRED_FIELDS = ('query', 'category')
+CATEGORIES = ('finance', 'insurance', 'faq')
+STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+               413: 'Payload Too Large', 500: 'Internal Server Error'}
+MAX_BODY_SIZE = 1 << 20
+
+
+class MicroBatcher:
+    """
+    將同時到達的請求合併成一批再交給模型計算
+    收到第一個請求後最多再等 max_wait_ms，或湊滿 max_batch 題就送出；
+    模型計算在單一執行緒中進行，讀檔與切段則交給其他執行緒，不阻塞事件迴圈
+    """
+    def __init__(self, retriever, max_batch=32, max_wait_ms=5):
+        self.retriever = retriever
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.queue = asyncio.Queue()
+        self.model_executor = ThreadPoolExecutor(max_workers=1)
+        self.batches = 0
+        self.requests = 0
+
+    async def submit(self, sample):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((sample, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            samples = [sample for sample, _ in batch]
+            try:
+                answers = await loop.run_in_executor(
+                    self.model_executor, self.retriever.retrieve_by_paragraph_batch, samples)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.batches += 1
+            self.requests += len(batch)
+            metrics.count('server_batches')
+            for (_, future), ans in zip(batch, answers):
+                if not future.done():
+                    future.set_result(ans)
+
+    def close(self):
+        self.model_executor.shutdown(wait=False)
+
+
+class RetrievalServer:
+    """
+    常駐的檢索服務，模型只在啟動時載入一次
+    POST /retrieve 接受 {"query", "source", "category"}（可附 "qid"），回傳 {"qid", "retrieve"}；
+    有近似最近鄰索引時 source 可省略或為空，在該 category 的整個語料中檢索；
+    GET /health 回傳已處理的請求數與批次數
+    """
+    def __init__(self, dataset, retriever, is_use_summary='False', max_batch=32, max_wait_ms=5, io_threads=4):
+        self.dataset = dataset
+        self.retriever = retriever
+        self.is_use_summary = is_use_summary
+        self.batcher = MicroBatcher(retriever, max_batch, max_wait_ms)
+        self.io_executor = ThreadPoolExecutor(max_workers=io_threads)
+
+    def prepare(self, request):
+        sample = {field: request[field] for field in REQUIRED_FIELDS}
+        sample["source"] = request.get("source") or []
+        sample["qid"] = request.get("qid")
+        return self.retriever.prepare(self.dataset.load_sample(sample, self.is_use_summary))
+
+    async def retrieve(self, request):
+        missing = [field for field in REQUIRED_FIELDS if field not in request]
+        if missing:
+            return 400, {"error": f"missing fields {missing}"}
+        if request["category"] not in CATEGORIES:
+            return 400, {"error": f"category must be one of {list(CATEGORIES)}"}
+        source = request.get("source")
+        if source is not None and not isinstance(source, list):
+            return 400, {"error": "source must be a list"}
+        if not source and not self.retriever.strategy.can_search():
+            return 400, {"error": "source must be a non-empty list unless the server has an ANN index"}
+        loop = asyncio.get_running_loop()
+        sample = await loop.run_in_executor(self.io_executor, self.prepare, request)
+        if source and not sample["source_context"]:
+            return 400, {"error": "none of the sources could be read"}
+        ans = await self.batcher.submit(sample)
+        return 200, {"qid": request.get("qid"), "retrieve": ans}
+
+    async def dispatch(self, method, path, body):
+        if path == '/health':
+            return 200, {"status": "ok", "requests": self.batcher.requests, "batches": self.batcher.batches}
+        if path != '/retrieve':
+            return 404, {"error": f"unknown path {path}"}
+        if method != 'POST':
+            return 405, {"error": "use POST"}
+        try:
+            request = json.loads(body)
+        except (json.JSONDecodeError, UnicodeDecodeError) as e:
+            return 400, {"error": f"invalid json: {e}"}
+        if not isinstance(request, dict):
+            return 400, {"error": "request body must be a json object"}
+        return await self.retrieve(request)
+
+    async def handle(self, reader, writer):
+        """ 簡易的 HTTP/1.1 處理，支援 keep-alive 讓壓測客戶端可以重複使用連線 """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get('content-length', 0))
+                if length > MAX_BODY_SIZE:
+                    status, response = 413, {"error": "request body too large"}
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(length) if length else b''
+                    keep_alive = headers.get('connection', '').lower() != 'close'
+                    try:
+                        status, response = await self.dispatch(method, path, body)
+                    except Exception as e:
+                        status, response = 500, {"error": str(e)}
+
+                payload = json.dumps(response, ensure_ascii=False).encode('utf-8')
+                writer.write(f"HTTP/1.1 {status} {STATUS_TEXT[status]}\r\n"
+                             f"Content-Type: application/json; charset=utf-8\r\n"
+                             f"Content-Length: {len(payload)}\r\n"
+                             f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+                             .encode('latin-1') + payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8000, unix_socket=None):
+        batch_task = asyncio.create_task(self.batcher.run())
+        if unix_socket:
+            if os.path.exists(unix_socket):
+                os.remove(unix_socket)
+            server = await asyncio.start_unix_server(self.handle, path=unix_socket)
+            print(f"Serving on unix socket {unix_socket}")
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+            print(f"Serving on http://{host}:{port}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batch_task.cancel()
+            self.batcher.close()
+            self.io_executor.shutdown(wait=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Long-running retrieval service with dynamic micro-batching.')
+    parser.add_argument('--source_dir', type=str,
+                        required=True, help='讀取參考資料路徑')
+    add_retriever_arguments(parser)
+    parser.add_argument('--is_use_summary', type=str, default='False',
+                        help='是否要使用 Summary 來進行檢索')
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='服務監聽的位址')
+    parser.add_argument('--port', type=int, default=8000,
+                        help='服務監聽的埠號')
+    parser.add_argument('--unix_socket', type=str, default=None,
+                        help='改為監聽 Unix socket 的路徑')
+    parser.add_argument('--max_batch', type=int, default=32,
+                        help='每批最多合併的請求數')
+    parser.add_argument('--max_wait_ms', type=float, default=5,
+                        help='收到第一個請求後最多等待多少毫秒湊批')
+    parser.add_argument('--io_threads', type=int, default=4,
+                        help='讀檔與切段的執行緒數')
+
+    args = parser.parse_args()
+    check_retriever_arguments(parser, args)
+
+    with startup.stage('load dataset'):
+        dataset = MyDataset(None, args.source_dir)
+    with startup.stage('build retriever'):
+        retriever = build_retriever(args)
+    if args.profile_startup:
+        print(startup.report())
+    server = RetrievalServer(dataset, retriever, args.is_use_summary,
+                             max_batch=args.max_batch, max_wait_ms=args.max_wait_ms,
+                             io_threads=args.io_threads)
+    try:
+        asyncio.run(server.serve(args.host, args.port, args.unix_socket))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,153 @@
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+
+from tqdm import tqdm
+
+THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS')
+# 影響答案的參數，任一項不同時既有的檢查點即不可沿用
+SIGNATURE_ARGS = ('source_dir', 'is_use_summary', 'strategy', 'model_name', 'biencoder_model_name',
+                  'cascade_bm25_k', 'cascade_biencoder_k', 'index_dir', 'ann_nprobe', 'quantized', 'rescore_k',
+                  'dedup', 'faq_pairs', 'faq_model_name', 'chunking', 'tokenizer_name', 'chunk_tokens',
+                  'chunk_overlap_tokens')
+
+
+def checkpoint_path(output_path, shard):
+    return f"{output_path}.shard{shard}.jsonl"
+
+
+def checkpoint_paths(output_path):
+    return glob.glob(f"{glob.escape(output_path)}.shard*.jsonl")
+
+
+def run_signature(args):
+    """ 題目檔內容的雜湊加上影響答案的參數，寫在每個分片檢查點的第一行 """
+    with open(args.question_path, 'rb') as f:
+        question_hash = hashlib.sha1(f.read()).hexdigest()
+    settings = {name: getattr(args, name, None) for name in SIGNATURE_ARGS}
+    return hashlib.sha1(json.dumps([question_hash, settings], sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def load_checkpoints(output_path, signature):
+    """
+    讀取所有分片檢查點，回傳 {qid: retrieve}
+    第一行的執行簽章與本次不同（題目或參數已改變）的檢查點直接刪除；
+    中斷時最後一行可能寫到一半，解析失敗的行直接略過
+    """
+    answers = {}
+    for path in checkpoint_paths(output_path):
+        with open(path, 'r', encoding='utf8') as f:
+            try:
+                header = json.loads(f.readline())
+            except json.JSONDecodeError:
+                header = None
+            if not isinstance(header, dict) or header.get("signature") != signature:
+                f.close()
+                print(f"Warning: Removing checkpoint '{path}' from a run with different questions or arguments.")
+                os.remove(path)
+                continue
+            for line in f:
+                try:
+                    answer = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                answers[answer["qid"]] = answer["retrieve"]
+    return answers
+
+
+def truncate_partial_line(path):
+    """ 中斷時檢查點最後一行可能只寫了一半，續跑前截斷到最後一個換行，避免新答案接在殘行後面 """
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb+') as f:
+        data = f.read()
+        if data and not data.endswith(b'\n'):
+            f.truncate(data.rfind(b'\n') + 1)
+
+
+def remove_checkpoints(output_path):
+    """ 答案寫出後刪除分片檢查點，避免下次執行誤用 """
+    for path in checkpoint_paths(output_path):
+        os.remove(path)
+
+
+def run_shard(args, shard, num_shards, output_path, done_qids, threads, signature):
+    """
+    單一分片的工作行程：自行載入資料與模型，依序處理 index % num_shards == shard 的題目
+    """
+    from data_interface import MyDataset
+    from instrumentation import metrics
+    from retrieval import build_retriever
+
+    if args.strategy != 'bm25':
+        import torch
+        torch.set_num_threads(threads)
+
+    if args.metrics_dir:
+        metrics.enable()
+
+    dataset = MyDataset(args.question_path, args.source_dir)
+    retriever = build_retriever(args)
+    indices = [i for i in range(shard, len(dataset), num_shards)
+               if dataset.data[i]["qid"] not in done_qids]
+    path = checkpoint_path(output_path, shard)
+    truncate_partial_line(path)
+    with open(path, 'a', encoding='utf8') as f:
+        if f.tell() == 0:
+            f.write(json.dumps({"signature": signature}) + '\n')
+            f.flush()
+        for i in tqdm(indices, desc=f"shard {shard}", position=shard):
+            sample = dataset.__getitem__(i, args.is_use_summary)
+            ans = retriever.retrieve_by_paragraph(sample)
+            f.write(json.dumps({"qid": sample["qid"], "retrieve": ans}, ensure_ascii=False) + '\n')
+            f.flush()
+
+    if args.metrics_dir:
+        metrics.export_json(os.path.join(args.metrics_dir, f"metrics.shard{shard}.json"))
+        metrics.export_prometheus(os.path.join(args.metrics_dir, f"metrics.shard{shard}.prom"))
+
+
+def run_sharded(args, output_path):
+    """
+    將題目分給 args.workers 個行程處理，每題完成即寫入該分片的 jsonl 檢查點，
+    重新執行時略過簽章相同的檢查點中已完成的 qid，最後依題目順序合併成答案列表
+    """
+    with open(args.question_path, 'r', encoding='utf-8') as f:
+        qids = [question["qid"] for question in json.load(f).get("questions", [])]
+
+    signature = run_signature(args)
+    done_qids = set(load_checkpoints(output_path, signature))
+    if len(done_qids) < len(qids):
+        print(f"{len(done_qids)} questions already done, {len(qids) - len(done_qids)} remaining.")
+        threads = args.threads_per_worker or max(1, (os.cpu_count() or 1) // args.workers)
+
+        # 子行程在匯入 torch 前就需要設定好執行緒數，因此透過環境變數傳遞
+        saved_env = {name: os.environ.get(name) for name in THREAD_ENV_VARS}
+        os.environ.update({name: str(threads) for name in THREAD_ENV_VARS})
+        context = multiprocessing.get_context('spawn')
+        processes = [context.Process(target=run_shard,
+                                     args=(args, shard, args.workers, output_path, done_qids, threads, signature))
+                     for shard in range(args.workers)]
+        try:
+            for process in processes:
+                process.start()
+        finally:
+            for name, value in saved_env.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+        for process in processes:
+            process.join()
+
+        failed = [shard for shard, process in enumerate(processes) if process.exitcode != 0]
+        if failed:
+            raise RuntimeError(f"Shards {failed} failed, rerun to resume from checkpoints.")
+
+    answers = load_checkpoints(output_path, signature)
+    missing = [qid for qid in qids if qid not in answers]
+    if missing:
+        raise RuntimeError(f"Missing answers for qid {missing[:10]}, rerun to resume from checkpoints.")
+    return [{"qid": qid, "retrieve": answers[qid]} for qid in qids]
@@ -1,5 +1,7 @@
 import os
+import re
 import json
+import hashlib
 import argparse
 from concurrent.futures import ProcessPoolExecutor
 from concurrent.futures import ThreadPoolExecutor, as_completed
@@ -7,9 +9,13 @@ from concurrent.futures import ThreadPoolExecutor, as_completed
 import pdfplumber
 import pytesseract
 from tqdm import tqdm
-from pdf2image import convert_from_path
+from pdf2image import convert_from_path, pdfinfo_from_path
 from PIL import Image, ImageEnhance
 
+# 抽取邏輯有變動時需遞增，舊版本的輸出會被重新處理
+EXTRACTOR_VERSION = 2
+MANIFEST_NAME = 'manifest.json'
+
 
 def preprocess_image(image):
     """
@@ -29,76 +35,232 @@ def ocr_image(image):
     text = pytesseract.image_to_string(image, lang='chi_tra', config=custom_config)
     return text
 
-def ocr_pdf(pdf_loc):
+def ocr_page(pdf_loc, page_number):
     """
-    使用圖片轉換和 OCR 對 PDF 進行文字辨識。
+    只將 PDF 的單一頁（從 1 開始）轉成圖片後進行 OCR，避免一次載入所有頁面的圖片。
     """
     try:
-        images = convert_from_path(pdf_loc)
+        images = convert_from_path(pdf_loc, first_page=page_number, last_page=page_number)
     except Exception as e:
-        print(f"Error converting PDF to images: {e}")
+        print(f"Error converting PDF page {page_number} to image: {e}")
         return ""
 
-    all_text = ""
+    page_text = ""
     for image in images:
         try:
             processed_image = preprocess_image(image)
             text = ocr_image(processed_image)
-            all_text += text + "\n"
+            page_text += text + "\n"
         except Exception as e:
             print(f"Error processing image for OCR: {e}")
-    
-    return all_text
+    return page_text
 
-def extract_text_from_pdf(pdf_loc, page_infos=None):
+def ocr_pages(pdf_loc, page_numbers, workers=2):
     """
-    優先嘗試直接從 PDF 提取文字，失敗則使用 OCR。
+    以執行緒平行對多個頁面 OCR，依傳入的頁碼順序回傳文字列表。
+    同時轉成圖片的頁數不超過 workers。
+    """
+    if not page_numbers:
+        return []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(lambda page_number: ocr_page(pdf_loc, page_number), page_numbers))
+
+def ocr_pdf(pdf_loc, workers=2):
+    """
+    使用圖片轉換和 OCR 對 PDF 進行文字辨識。
     """
-    pdf_text = ""
+    try:
+        page_count = pdfinfo_from_path(pdf_loc)["Pages"]
+    except Exception as e:
+        print(f"Error converting PDF to images: {e}")
+        return ""
+    return "".join(ocr_pages(pdf_loc, list(range(1, page_count + 1)), workers))
+
+def is_garbage_text(text, min_ratio=0.3):
+    """
+    判斷 pdfplumber 抽出的頁面文字是否無法使用：
+    空白、字型對應失敗的 (cid:xx)，或中英數字比例過低。
+    """
+    if not text or not text.strip():
+        return True
+    text = re.sub(r'\(cid:\d+\)', '\ufffd', text)
+    chars = [c for c in text if not c.isspace()]
+    meaningful = sum(1 for c in chars if c.isalnum())
+    return meaningful / len(chars) < min_ratio
+
+def extract_text_from_pdf(pdf_loc, page_infos=None, ocr_workers=2):
+    """
+    優先嘗試直接從 PDF 逐頁提取文字，無法提取或文字為亂碼的頁面才使用 OCR。
+    """
+    page_texts = []
+    ocr_page_numbers = []
     try:
         with pdfplumber.open(pdf_loc) as pdf:
+            first_page = page_infos[0] if page_infos else 0
             pages = pdf.pages[page_infos[0]:page_infos[1]] if page_infos else pdf.pages
-            for page in pages:
+            for i, page in enumerate(pages):
                 text = page.extract_text()
-                if text:
-                    pdf_text += text
+                if is_garbage_text(text):
+                    ocr_page_numbers.append(first_page + i + 1)
+                    page_texts.append(None)
+                else:
+                    page_texts.append(text)
     except Exception as e:
         print(f"Error extracting text from PDF: {e}")
+        # 無法開啟時整份 PDF 使用 OCR
+        return ocr_pdf(pdf_loc, ocr_workers)
 
-    # 如果無法從 PDF 提取文字，則使用 OCR
-    if not pdf_text.strip():
-        pdf_text = ocr_pdf(pdf_loc)
-    
+    # 依頁面順序組合文字
+    ocr_texts = iter(ocr_pages(pdf_loc, ocr_page_numbers, ocr_workers))
+    pdf_text = ""
+    for text in page_texts:
+        pdf_text += text if text is not None else next(ocr_texts)
     return pdf_text
 
 def write_text_to_file(text, output_folder, file_name):
     """
-    將文字寫入檔案。
+    將文字寫入檔案，成功時回傳輸出的檔名。
     """
     file_name = file_name.replace('.pdf', '_text.txt')
     file_path = os.path.join(output_folder, file_name)
     try:
         with open(file_path, 'w', encoding='utf-8') as f:
             f.write(text)
+        return file_name
     except Exception as e:
         print(f"Error writing file {file_name}: {e}")
+    return None
 
-def main(source_folder, output_folder):
+def file_sha256(file_path):
+    """
+    計算檔案內容的 SHA-256。
+    """
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+def text_sha256(text):
+    """
+    計算抽取文字的 SHA-256，用來判斷重新抽取後文字是否真的有變動。
+    """
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def existing_text_sha256(entry, output_folder, file_name):
+    """
+    回傳上次輸出文字的雜湊；舊版 manifest 沒有記錄時讀取磁碟上的文字檔計算，沒有輸出時回傳 None。
+    """
+    if entry is not None and entry.get("text_sha256"):
+        return entry["text_sha256"]
+    file_path = os.path.join(output_folder, file_name.replace('.pdf', '_text.txt'))
+    if not os.path.isfile(file_path):
+        return None
+    with open(file_path, 'r', encoding='utf-8', errors='replace') as f:
+        return text_sha256(f.read())
+
+def load_manifest(output_folder):
+    """
+    讀取記錄每個 PDF 內容雜湊、抽取版本與輸出檔案的 manifest。
+    """
+    manifest_path = os.path.join(output_folder, MANIFEST_NAME)
+    if not os.path.isfile(manifest_path):
+        return {}
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except json.JSONDecodeError as e:
+        print(f"Error decoding manifest '{manifest_path}', reprocessing all files: {e}")
+        return {}
+
+def save_manifest(manifest, output_folder):
+    manifest_path = os.path.join(output_folder, MANIFEST_NAME)
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=4)
+    os.replace(tmp_path, manifest_path)
+
+def remove_outputs(outputs, output_folder):
+    """
+    刪除輸出的文字檔，以及 generate_summary.py 由其產生的 summary 檔（內容已過期）。
+    """
+    for output in outputs:
+        for name in (output, output.replace('_text.txt', '_text_summary.txt')):
+            output_path = os.path.join(output_folder, name)
+            if os.path.isfile(output_path):
+                os.remove(output_path)
+
+def is_up_to_date(entry, sha256, output_folder):
+    return (entry is not None
+            and entry.get("sha256") == sha256
+            and entry.get("extractor_version") == EXTRACTOR_VERSION
+            and all(os.path.isfile(os.path.join(output_folder, output)) for output in entry.get("outputs", [])))
+
+def main(source_folder, output_folder, force=False, ocr_workers=2):
     os.makedirs(output_folder, exist_ok=True)
 
     pdf_files = [file for file in os.listdir(source_folder) if file.endswith('.pdf')]
-    pdf_locs = [os.path.join(source_folder, file) for file in pdf_files]
+    manifest = load_manifest(output_folder)
+
+    # 移除已刪除 PDF 的輸出
+    removed = 0
+    for file in set(manifest) - set(pdf_files):
+        remove_outputs(manifest.pop(file).get("outputs", []), output_folder)
+        removed += 1
+
+    # 只處理新增或內容有變動的 PDF，force 時全部重新處理
+    hashes = {}
+    pdf_locs = []
+    for file in tqdm(pdf_files, desc='hashing'):
+        pdf_loc = os.path.join(source_folder, file)
+        hashes[file] = file_sha256(pdf_loc)
+        if force or not is_up_to_date(manifest.get(file), hashes[file], output_folder):
+            pdf_locs.append(pdf_loc)
 
+    failed = 0
+    summaries_removed = 0
     cpu_count = os.cpu_count()
-    with ProcessPoolExecutor(max_workers=cpu_count // 2) as executor:
-        futures = {executor.submit(extract_text_from_pdf, pdf_loc): pdf_loc for pdf_loc in pdf_locs}
-        for future in tqdm(as_completed(futures), total=len(pdf_files)):
-            pdf_loc = futures[future]
-            try:
-                text = future.result()
-                write_text_to_file(text, output_folder, os.path.basename(pdf_loc))
-            except Exception as e:
-                print(f"Error processing {pdf_loc}: {e}")
+    try:
+        with ProcessPoolExecutor(max_workers=max(1, cpu_count // 2)) as executor:
+            futures = {executor.submit(extract_text_from_pdf, pdf_loc, None, ocr_workers): pdf_loc for pdf_loc in pdf_locs}
+            for i, future in enumerate(tqdm(as_completed(futures), total=len(pdf_locs))):
+                pdf_loc = futures[future]
+                file = os.path.basename(pdf_loc)
+                entry = manifest.get(file)
+                try:
+                    text = future.result()
+                    previous_sha256 = existing_text_sha256(entry, output_folder, file)
+                    output = write_text_to_file(text, output_folder, file)
+                except Exception as e:
+                    print(f"Error processing {pdf_loc}: {e}")
+                    output = None
+                if output is None:
+                    # PDF 內容未變（如 --force）時保留舊的輸出，否則舊的輸出已過期
+                    if entry is None or entry.get("sha256") != hashes[file]:
+                        remove_outputs(entry.get("outputs", []) if entry else [], output_folder)
+                        manifest.pop(file, None)
+                    failed += 1
+                    continue
+                # 只有文字真的改變時，舊的 summary 才過期需重新產生（例如只是沒有 manifest 或抽取版本更新時保留）
+                new_sha256 = text_sha256(text)
+                if new_sha256 != previous_sha256:
+                    summary_path = os.path.join(output_folder, output.replace('_text.txt', '_text_summary.txt'))
+                    if os.path.isfile(summary_path):
+                        os.remove(summary_path)
+                        summaries_removed += 1
+                manifest[file] = {
+                    "sha256": hashes[file],
+                    "extractor_version": EXTRACTOR_VERSION,
+                    "text_sha256": new_sha256,
+                    "outputs": [output],
+                }
+                if (i + 1) % 50 == 0:
+                    save_manifest(manifest, output_folder)
+    finally:
+        save_manifest(manifest, output_folder)
+
+    print(f"Cache hits: {len(pdf_files) - len(pdf_locs)}, misses: {len(pdf_locs)}, "
+          f"failed: {failed}, removed: {removed}, stale summaries removed: {summaries_removed}")
 
 
 if __name__ == "__main__":
@@ -108,7 +270,11 @@ if __name__ == "__main__":
                         required=True, help='讀取 PDF 檔案的資料夾路徑')
     parser.add_argument('--output_folder', type=str,
                         required=True, help='輸出文字檔案的資料夾路徑')
+    parser.add_argument('--force', action='store_true',
+                        help='重新處理所有 PDF（仍沿用 manifest，失敗的檔案保留舊的輸出）')
+    parser.add_argument('--ocr_workers', type=int, default=2,
+                        help='每個 PDF 同時進行 OCR 的頁數')
 
     args = parser.parse_args()
 
-    main(args.source_folder, args.output_folder)
\ No newline at end of file
+    main(args.source_folder, args.output_folder, args.force, args.ocr_workers)
\ No newline at end of file
@@ -3,9 +3,11 @@ import json
 import argparse
 from tqdm import tqdm
 
-def process_faq_data(source_path, output_path):
+def process_faq_data(source_path, output_path, pairs_output_path=None):
     """
     處理 FAQ 資料，將問題和答案合併成一個 JSON 檔案。
+    指定 pairs_output_path 時另外輸出每個問答配對一筆的 {"pairs": [{"faq_id", "question", "answer"}]}，
+    供建立問題粒度的 FAQ 索引
     """
     # 檢查來源檔案是否存在
     if not os.path.isfile(source_path):
@@ -38,13 +40,26 @@ def process_faq_data(source_path, output_path):
         print(f"Error writing file '{output_path}': {e}")
         return
 
+    if pairs_output_path:
+        pairs = [{"faq_id": key, "question": item['question'], "answer": '、'.join(item['answers'])}
+                 for key in sorted(key_to_source_dict, key=int) for item in key_to_source_dict[key]]
+        try:
+            with open(pairs_output_path, 'w', encoding='utf-8') as f:
+                json.dump({"version": 1, "pairs": pairs}, f, ensure_ascii=False, indent=4)
+            print(f"Successfully written {len(pairs)} QA pairs to '{pairs_output_path}'.")
+        except Exception as e:
+            print(f"Error writing file '{pairs_output_path}': {e}")
+            return
+
     return sorted_corpus_dict_faq
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Process FAQ JSON data.')
     parser.add_argument('--source_path', type=str, required=True, help='讀取 JSON 檔案參考資料路徑')
     parser.add_argument('--output_path', type=str, required=True, help='輸出處理後的 JSON 檔案路徑')
+    parser.add_argument('--pairs_output_path', type=str, default=None,
+                        help='另外輸出每個問答配對一筆的 JSON 檔案路徑（例如 Data/faq_pairs.json），供建立 FAQ 問題索引')
     
     args = parser.parse_args()
 
-    process_faq_data(args.source_path, args.output_path)
\ No newline at end of file
+    process_faq_data(args.source_path, args.output_path, args.pairs_output_path)
\ No newline at end of file
@@ -1,25 +1,147 @@
 import os
 import json
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 
 from tqdm import tqdm
 import pdfplumber  # 用於從PDF文件中提取文字的工具
 import re
-import torch
-from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
 
+SUMMARY_MODEL_NAME = "csebuetnlp/mT5_multilingual_XLSum"
+WHITESPACE_HANDLER = lambda k: re.sub('\s+', ' ', re.sub('\n+', ' ', k.strip()))
 
-def load_data(source_path):
+
+class SummaryEngine:
+    """
+    只載入一次 summary 模型，將多份文件的段落依長度排序後批次產生摘要，
+    每批只 padding 到該批最長的段落
+    """
+    def __init__(self, model_name=SUMMARY_MODEL_NAME, batch_size=16, device=None):
+        # torch 與 transformers 只在 summary 行程中匯入，主行程讀取 PDF 時不需要
+        import torch
+        from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.model = AutoModelForSeq2SeqLM.from_pretrained(model_name)
+        # 使用 GPU 如果可用
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        self.model = self.model.to(self.device).eval()
+        self.batch_size = batch_size
+
+    def summarize(self, texts):
+        """
+        回傳每份文件各段落的摘要列表
+        """
+        import torch
+
+        paragraphs = []
+        for doc, text in enumerate(texts):
+            for paragraph in _split_by_length_with_overlap(text, length=256, overlap=100):
+                paragraphs.append((doc, len(paragraphs), WHITESPACE_HANDLER(paragraph)))
+        # 全部都是空白文件（如未 OCR 的掃描檔）時沒有段落，tokenizer 不接受空的批次
+        if not paragraphs:
+            return [[] for _ in texts]
+        # 依 token 數（而非字數）排序，同一批 padding 到的長度才會接近
+        lengths = [len(ids) for ids in self.tokenizer([paragraph for _, _, paragraph in paragraphs],
+                                                      truncation=True, max_length=512)["input_ids"]]
+        paragraphs = [paragraphs[i] for i in sorted(range(len(paragraphs)), key=lengths.__getitem__)]
+
+        summaries = [[] for _ in texts]
+        results = {}
+        for start in range(0, len(paragraphs), self.batch_size):
+            batch = paragraphs[start:start + self.batch_size]
+            input_ids = self.tokenizer(
+                            [paragraph for _, _, paragraph in batch],
+                            return_tensors="pt",
+                            padding="longest",
+                            truncation=True,
+                            max_length=512
+                        )
+            with torch.no_grad():
+                output_ids = self.model.generate(
+                                input_ids=input_ids["input_ids"].to(self.device),
+                                attention_mask=input_ids["attention_mask"].to(self.device),
+                                max_length=512,
+                                no_repeat_ngram_size=2,
+                                num_beams=4
+                            )
+            decoded = self.tokenizer.batch_decode(
+                            output_ids,
+                            skip_special_tokens=True,
+                            clean_up_tokenization_spaces=False
+                        )
+            for (doc, order, _), summary in zip(batch, decoded):
+                results[order] = (doc, summary)
+
+        # 依原本段落順序放回各文件
+        for order in sorted(results):
+            doc, summary = results[order]
+            summaries[doc].append(summary)
+        return summaries
+
+
+_engine = None
+
+
+def _get_engine(model_name=SUMMARY_MODEL_NAME, batch_size=16):
+    """ 每個行程只建立一個 SummaryEngine """
+    global _engine
+    if _engine is None:
+        _engine = SummaryEngine(model_name, batch_size)
+    return _engine
+
+
+def _init_worker(model_name, batch_size, threads):
+    """ 每個行程只使用分配到的 CPU 執行緒數，避免多個行程同時用滿所有核心 """
+    import torch
+    torch.set_num_threads(threads)
+    _get_engine(model_name, batch_size)
+
+
+def summarize_files(txt_locs):
+    """
+    以同一個模型一次處理多個文字檔，寫出各自的 summary 檔並回傳檔名
+    """
+    texts = []
+    for txt_loc in txt_locs:
+        with open(txt_loc, 'r', encoding='utf8') as f:
+            texts.append(f.read())
+
+    summary_filenames = []
+    for txt_loc, summaries in zip(txt_locs, _get_engine().summarize(texts)):
+        summary_filenames.append(write_summary(txt_loc, summaries))
+    return summary_filenames
+
+
+def load_data(source_path, executor=None, docs_per_task=4):
     """
     載入參考資料，返回一個字典，key為檔案名稱，value為PDF檔內容的文本
+    有 executor 時，每讀完 docs_per_task 份 PDF 就將文字檔交給 summary 行程處理，返回 (字典, futures)
     """
     masked_file_ls = os.listdir(source_path)  # 獲取資料夾中的檔案列表
-    corpus_dict = {int(file.replace('.pdf', '')): read_pdf(os.path.join(source_path, file)) for file in tqdm(masked_file_ls)}  # 讀取每個PDF文件的文本，並以檔案名作為鍵，文本內容作為值存入字典
+    corpus_dict = {}
+    futures = []
+    pending = []
+    for file in tqdm(masked_file_ls):
+        # 讀取每個PDF文件的文本，並以檔案名作為鍵，文本內容作為值存入字典
+        pdf_text, text_filename = read_pdf(os.path.join(source_path, file))
+        corpus_dict[int(file.replace('.pdf', ''))] = pdf_text
+        if executor is None:
+            summarize_text(text_filename)
+            continue
+        pending.append(text_filename)
+        if len(pending) >= docs_per_task:
+            futures.append(executor.submit(summarize_files, pending))
+            pending = []
+    if executor is not None:
+        if pending:
+            futures.append(executor.submit(summarize_files, pending))
+        return corpus_dict, futures
     return corpus_dict
 
 def read_pdf(pdf_loc, page_infos: list = None):
     """
-    讀取單個PDF文件，總結內容儲存成txt檔並返回其文本內容
+    讀取單個PDF文件，內容儲存成txt檔並返回 (文本內容, txt 檔名)
     """
     pdf = pdfplumber.open(pdf_loc)  # 打開指定的PDF文件
 
@@ -68,11 +190,8 @@ def read_pdf(pdf_loc, page_infos: list = None):
     if pdf_images:
         with open(image_filename, 'w', encoding='utf8') as f:
             f.write(str(pdf_images))
-    
-    # 產生 Summary 檔案
-    summarize_text(text_filename)
 
-    return pdf_text  # 返回萃取出的文本
+    return pdf_text, text_filename  # 返回萃取出的文本與文字檔名
 
 def summarize_text(txt_loc):
     """
@@ -80,42 +199,15 @@ def summarize_text(txt_loc):
     """
     with open(txt_loc, 'r', encoding='utf8') as f:
         article_text = f.read()
-    
-    # 讀入 summary 模型
-    WHITESPACE_HANDLER = lambda k: re.sub('\s+', ' ', re.sub('\n+', ' ', k.strip()))
-    model_name = "csebuetnlp/mT5_multilingual_XLSum"
-    tokenizer = AutoTokenizer.from_pretrained(model_name)
-    model = AutoModelForSeq2SeqLM.from_pretrained(model_name)
-
-    # 使用 GPU 如果可用
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    model = model.to(device)  # 將模型移動到 GPU
-
-    summaries = []
-    paragraphs = _split_by_length_with_overlap(article_text, length=256, overlap=100)
-    for paragraph in paragraphs:
-        input_ids = tokenizer(
-                        [WHITESPACE_HANDLER(paragraph)],
-                        return_tensors="pt",
-                        padding="max_length",
-                        truncation=True,
-                        max_length=512
-                    )["input_ids"].to(device)  # 將 input_ids 也移動到 GPU
-
-        output_ids = model.generate(
-                        input_ids=input_ids,
-                        max_length=512,
-                        no_repeat_ngram_size=2,
-                        num_beams=4
-                    )[0]
-
-        summary = tokenizer.decode(
-                        output_ids,
-                        skip_special_tokens=True,
-                        clean_up_tokenization_spaces=False
-                    )
-        summaries.append(summary)
-    
+
+    summaries = _get_engine().summarize([article_text])[0]
+    write_summary(txt_loc, summaries)
+    return summaries
+
+def write_summary(txt_loc, summaries):
+    """
+    將 summary 寫入 txt_loc 同一個資料夾，回傳檔名
+    """
     # 檔案名字，摘取 txt_loc 並加上後綴 _summary.txt，txt_loc 是 Data/finance/*.txt 或 Data/insurance/*.txt ，存到txt_loc同一個資料夾
     base_filename = os.path.splitext(os.path.basename(txt_loc))[0]
     sub_dir = os.path.basename(os.path.dirname(txt_loc))  # 這裡抓取 'finance' 或 'insurance'
@@ -126,7 +218,7 @@ def summarize_text(txt_loc):
     with open(summary_filename, 'w', encoding='utf8') as f:
         for summary in summaries:
             f.write(summary + '\n')
-    return summaries
+    return summary_filename
 
 def _split_by_length_with_overlap(text, length=100, overlap=20):
     """
@@ -143,11 +235,29 @@ if __name__ == "__main__":
     # 使用argparse解析命令列參數
     parser = argparse.ArgumentParser(description='Process some paths and files.')
     parser.add_argument('--source_path', type=str, required=True, help='讀取finance 和 insurance 參考資料路徑')  # 參考資料的路徑
+    parser.add_argument('--workers', type=int, default=None, help='產生 summary 的行程數，每個行程各載入一次模型')
+    parser.add_argument('--batch_size', type=int, default=16, help='每次送進模型的段落數')
+    parser.add_argument('--docs_per_task', type=int, default=4, help='每個 summary 工作合併處理的文件數')
 
     args = parser.parse_args()  # 解析參數
 
-    source_path_insurance = os.path.join(args.source_path, 'insurance')  # 設定參考資料路徑
-    corpus_dict_insurance = load_data(source_path_insurance)             # 處理insurance資料
+    # GPU 上只使用一個行程，避免重複載入模型到顯示卡
+    workers = args.workers
+    if workers is None:
+        import torch
+        workers = 1 if torch.cuda.is_available() else max(1, os.cpu_count() // 4)
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(SUMMARY_MODEL_NAME, args.batch_size, threads)) as executor:
+        source_path_insurance = os.path.join(args.source_path, 'insurance')  # 設定參考資料路徑
+        corpus_dict_insurance, futures_insurance = load_data(source_path_insurance, executor, args.docs_per_task)  # 處理insurance資料
+
+        source_path_finance = os.path.join(args.source_path, 'finance')  # 設定參考資料路徑
+        corpus_dict_finance, futures_finance = load_data(source_path_finance, executor, args.docs_per_task)  # 處理finance資料
 
-    source_path_finance = os.path.join(args.source_path, 'finance')  # 設定參考資料路徑
-    corpus_dict_finance = load_data(source_path_finance)             # 處理finance資料
\ No newline at end of file
+        futures = futures_insurance + futures_finance
+        for future in tqdm(futures, desc='summary'):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Error generating summary: {e}")
\ No newline at end of file
@@ -0,0 +1,71 @@
+import os
+import sys
+import json
+import argparse
+from tqdm import tqdm
+
+# 語料檔的格式與過期判斷以讀取端（Model/data_interface.py）為準，只保留一份定義
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Model'))
+from data_interface import CORPUS_CATEGORIES, CORPUS_VERSION, CorpusStore  # noqa: E402
+
+
+def pack_corpus(data_dir, output_name='corpus'):
+    """
+    將前處理後的 {id}_text.txt、{id}_text_summary.txt 與 faq.json 打包成單一檔案
+    {output_name}.bin 為所有文字的 UTF-8 內容串接，
+    {output_name}.json 記錄 {category: {kind: {id: [offset, length]}}} 的位移表與來源檔案的大小、修改時間，
+    來源檔案有變動時讀取端會改讀原始檔案，需重新執行打包
+    """
+    bin_path = os.path.join(data_dir, f"{output_name}.bin")
+    meta_path = os.path.join(data_dir, f"{output_name}.json")
+    tmp_path = bin_path + '.tmp'
+
+    # 打包前先記錄，打包途中來源檔案被修改時會被視為過期
+    sources = CorpusStore.source_files(data_dir)
+    entries = {}
+    offset = 0
+    with open(tmp_path, 'wb') as out:
+        def append(category, kind, id, text):
+            nonlocal offset
+            data = text.encode('utf-8')
+            out.write(data)
+            entries.setdefault(category, {}).setdefault(kind, {})[str(id)] = [offset, len(data)]
+            offset += len(data)
+
+        for category in CORPUS_CATEGORIES:
+            base_path = os.path.join(data_dir, category)
+            if not os.path.isdir(base_path):
+                print(f"Error: Folder '{base_path}' does not exist.")
+                continue
+            for file in tqdm(sorted(os.listdir(base_path)), desc=category):
+                if file.endswith('_text_summary.txt'):
+                    kind, id = 'summary', file[:-len('_text_summary.txt')]
+                elif file.endswith('_text.txt'):
+                    kind, id = 'text', file[:-len('_text.txt')]
+                else:
+                    continue
+                with open(os.path.join(base_path, file), 'r', encoding='utf-8') as f:
+                    append(category, kind, id, f.read())
+
+        faq_path = os.path.join(data_dir, 'faq.json')
+        if os.path.isfile(faq_path):
+            with open(faq_path, 'r', encoding='utf-8') as f:
+                for key, value in json.load(f).items():
+                    append('faq', 'text', key, value)
+        else:
+            print(f"Error: FAQ file '{faq_path}' does not exist.")
+
+    os.replace(tmp_path, bin_path)
+    with open(meta_path, 'w', encoding='utf-8') as f:
+        json.dump({"version": CORPUS_VERSION, "sources": sources, "entries": entries}, f, ensure_ascii=False)
+    print(f"Successfully packed {sum(len(ids) for kinds in entries.values() for ids in kinds.values())} "
+          f"files to '{bin_path}'.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Pack preprocessed text files into one corpus file.')
+    parser.add_argument('--data_dir', type=str, default='Data', help='前處理後的資料夾路徑')
+
+    args = parser.parse_args()
+
+    pack_corpus(args.data_dir)